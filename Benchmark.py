@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+
+# measures the poller, the pages and the database against a FakeBtpd
+# full of synthetic torrents and a database full of synthetic users;
+# > python3 Benchmark.py --torrents 100 10000 100000 --users 50
+# each torrent count is run in a process of its own, so its memory
+# figures are its own. --bencode times reading .torrent files instead;
+# > python3 Benchmark.py --bencode 1 8 32
+
+import argparse, json, os, random, re, resource, socket, subprocess
+import hashlib, sys, tempfile, threading, time, types
+import Bencode, Btpd, Cache
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+ADMIN_PAGES = ["/", "/?page=2&orderby=3", "/?orderby=-4",
+	"/?q=torrent+12&state=seed", "/view?id=%(id)d",
+	"/api/torrents?per_page=100", "/api/torrent?id=%(id)d", "/users",
+	"/stats"]
+USER_PAGES = ["/", "/?page=2&orderby=3", "/?q=torrent+12",
+	"/view?id=%(id)d", "/api/torrents?per_page=100"]
+
+BTCLI_SCRIPT = """#!%(python)s
+import sys
+sys.path.insert(0, %(root)r)
+import Benchmark
+Benchmark.btcli(sys.argv[1:])
+"""
+BTCLI_FIELDS = {"#": lambda t: t.id, "t": lambda t: t.state,
+	"p": lambda t: "%.1f%%" % t.percent, "S": lambda t: t.size,
+	"r": lambda t: "%.2f" % t.ratio, "s": lambda t: t.pretty_size,
+	"h": lambda t: t.info_hash, "P": lambda t: t.peers,
+	"^": lambda t: t.upload_speed, "v": lambda t: t.download_speed,
+	"u": lambda t: t.uploaded, "g": lambda t: t.downloaded,
+	"H": lambda t: t.have_pieces, "T": lambda t: t.total_pieces,
+	"n": lambda t: t.title}
+
+def btcli(argv):
+	# just enough of btcli for Utils.Btcli, answered by FakeBtpd
+	client = Btpd.Client(argv[argv.index("-d")+1])
+	command = argv[2]
+	if command == "list":
+		format = argv[argv.index("-f")+1].replace("\\n", "\n")
+		sys.stdout.write("".join(re.sub("%(.)", lambda match: str(
+			BTCLI_FIELDS[match.group(1)](torrent)), format)
+			for torrent in client.list()))
+	elif command in ["start", "stop", "del"]:
+		for id in argv[3:]:
+			client.request(command, int(id))
+	else:
+		sys.exit("unsupported btcli command %r" % command)
+
+def percentiles(samples, points=[50, 90, 99]):
+	samples = sorted(samples)
+	if not samples:
+		return {}
+	return {str(point): samples[min(len(samples)-1, len(samples
+		)*point//100)] for point in points}
+def timed(function, *args, **kwargs):
+	start = time.perf_counter()
+	result = function(*args, **kwargs)
+	return (time.perf_counter()-start)*1000, result
+def rss():
+	with open("/proc/self/statm") as file:
+		return int(file.read().split()[1])*resource.getpagesize()
+
+def start_fake(btpd_dir, torrents, seed, churn, delay=0):
+	process = subprocess.Popen([sys.executable, os.path.join(ROOT,
+		"FakeBtpd.py"), btpd_dir, "--torrents", str(torrents),
+		"--seed", str(seed), "--churn", str(churn), "--delay",
+		str(delay)])
+	path = os.path.join(btpd_dir, "sock")
+	while True:
+		if not process.poll() is None:
+			raise RuntimeError("FakeBtpd exited")
+		try:
+			sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			sock.connect(path)
+			sock.close()
+			return process
+		except OSError:
+			time.sleep(0.1)
+
+def load_main(work, btpd_dirs, backend, poll_timeout=10):
+	# main.py reads Config at import, so give it one pointing at the
+	# fake daemons and a database in the scratch directory.
+	config = types.ModuleType("Config")
+	config.BTPD_DIRS = btpd_dirs
+	config.BTPD_POLL_TIMEOUT = poll_timeout
+	config.BTPD_BACKEND = backend
+	config.BASE_DIR = work
+	config.PER_PAGE = 40
+	config.SCRYPT_N, config.SCRYPT_R, config.SCRYPT_P = 16, 1, 1
+	config.HISTORY_MAX_TORRENTS = 1 << 20
+	sys.modules["Config"] = config
+	os.chdir(work)
+	sys.path.insert(0, ROOT)
+	import main
+	return main
+
+def seed_users(main, count, seed):
+	database = main.database
+	salt = database.make_salt()
+	hash = database.make_hash("password", salt)
+	cursor = database.cursor()
+	cursor.execute("BEGIN IMMEDIATE")
+	cursor.executemany("""INSERT INTO users (username, hash, salt,
+		admin) VALUES (?, ?, ?, 0)""", [("user%d" % n, hash, salt)
+		for n in range(count)])
+	cursor.execute("COMMIT")
+	sessions = {}
+	for username in ["root", "user0"]:
+		sessions[username] = database.make_session()
+		database.add_session(username, sessions[username])
+	return sessions
+def spread_torrents(main, seed):
+	# hand the torrents the first poll gave root out among everyone
+	database = main.database
+	cursor = database.cursor()
+	ids = [id for id, in cursor.execute("SELECT id FROM users"
+		).fetchall()]
+	info_hashes = [info_hash for info_hash, in cursor.execute(
+		"SELECT info_hash FROM torrents").fetchall()]
+	generator = random.Random(seed)
+	cursor.execute("BEGIN IMMEDIATE")
+	cursor.executemany("UPDATE torrents SET user_id=? WHERE info_hash=?",
+		[(generator.choice(ids), info_hash) for info_hash in info_hashes])
+	cursor.execute("COMMIT")
+	with database.owners_lock:
+		database.owners = None
+
+def run(args, torrents):
+	work = tempfile.mkdtemp(prefix="btpd-web-bench-")
+	btpd_dirs = [os.path.join(work, "btpd%d" % index) for index in
+		range(args.daemons)]
+	for btpd_dir in btpd_dirs:
+		os.makedirs(btpd_dir)
+	if args.backend == "btcli":
+		bin = os.path.join(work, "bin")
+		os.makedirs(bin)
+		path = os.path.join(bin, "btcli")
+		with open(path, "w") as file:
+			file.write(BTCLI_SCRIPT % {"python": sys.executable,
+				"root": ROOT})
+		os.chmod(path, 0o755)
+		os.environ["PATH"] = bin+os.pathsep+os.environ["PATH"]
+	# the torrents are split between the daemons, and the last one is
+	# --slow to list them
+	fakes = [start_fake(btpd_dir, torrents//args.daemons+(index <
+		torrents%args.daemons), args.seed+index, args.churn, args.slow
+		if index and index == args.daemons-1 else 0)
+		for index, btpd_dir in enumerate(btpd_dirs)]
+	try:
+		return measure(args, torrents, load_main(work, btpd_dirs,
+			args.backend, args.poll_timeout))
+	finally:
+		for fake in fakes:
+			fake.kill()
+			fake.wait()
+
+def measure(args, torrents, main):
+	result = {"torrents": torrents, "users": args.users,
+		"backend": args.backend, "daemons": args.daemons}
+	queries = [0]
+	def count(statement):
+		queries[0] += 1
+	def counted(function, *args, **kwargs):
+		queries[0] = 0
+		took, value = timed(function, *args, **kwargs)
+		return took, queries[0], value
+	main.database.cursor().connection.set_trace_callback(count)
+	sessions = seed_users(main, args.users, args.seed)
+
+	result["first_poll_ms"], result["first_poll_queries"], _ = counted(
+		main.poll_torrent_list)
+	spread_torrents(main, args.seed)
+	result["owners_poll_ms"], result["owners_poll_queries"], _ = counted(
+		main.poll_torrent_list)
+	polls = [counted(main.poll_torrent_list)[:2] for _ in range(
+		args.polls)]
+	result["poll_ms"] = percentiles([took for took, _ in polls])
+	result["queries_per_poll"] = max(count for _, count in polls)
+	result["version"] = main.snapshots.current.version
+
+	database = main.database
+	def owners():
+		with database.owners_lock:
+			database.owners = None
+		return database.torrent_owners()
+	result["database_ms"] = {name: timed(function)[0] for name, function
+		in [("torrent_owners", owners), ("list_users_with_counts",
+		database.list_users_with_counts), ("session_user",
+		lambda: database.session_user(sessions["user0"]))]}
+
+	current = main.snapshots.current
+	ids = {"root": min(current.torrents) if current.torrents else 0,
+		"user0": min(current.owners.get(database.get_user_id("user0"
+		), [0]))}
+	client = main.app.test_client(use_cookies=False)
+	pages = {}
+	for username, paths in [("root", ADMIN_PAGES), ("user0",
+			USER_PAGES)]:
+		headers = {"Cookie": "btpd-session=%s" % sessions[username]}
+		for path in paths:
+			path = path % {"id": ids[username]}
+			samples = []
+			for _ in range(args.requests):
+				took, used, response = counted(client.get, path,
+					headers=headers)
+				if not response.status_code == 200:
+					raise RuntimeError("%s %s gave %d" % (username,
+						path, response.status_code))
+				samples.append(took)
+			pages["%s %s" % (username, path)] = dict(percentiles(
+				samples), queries=used)
+	result["pages_ms"] = pages
+	result["page_cache"] = main.fragments.stats()
+	if args.clients:
+		result["concurrent"] = concurrent(args, main, sessions, ids)
+	result["rss_mb"] = rss()/(1 << 20)
+	result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF
+		).ru_maxrss/1024
+	return result
+
+def concurrent(args, main, sessions, ids):
+	# the poller going flat out (no scheduler waits) while `clients`
+	# threads fetch pages, to see what publishing snapshots costs
+	# readers; they never wait on the poller for a lock, only on the
+	# interpreter.
+	stop = threading.Event()
+	polls = []
+	latencies = []
+	def poller():
+		while not stop.is_set():
+			polls.append(timed(main.poll_torrent_list)[0])
+	def reader(index):
+		username = "root" if index%2 else "user0"
+		paths = [path % {"id": ids[username]} for path in (
+			ADMIN_PAGES if username == "root" else USER_PAGES)]
+		headers = {"Cookie": "btpd-session=%s" % sessions[username]}
+		client = main.app.test_client(use_cookies=False)
+		samples = []
+		while not stop.is_set():
+			for path in paths:
+				samples.append(timed(client.get, path, headers=
+					headers)[0])
+		latencies.extend(samples)
+	threads = [threading.Thread(target=poller)]+[threading.Thread(
+		target=reader, args=[index]) for index in range(args.clients)]
+	for thread in threads:
+		thread.start()
+	time.sleep(args.duration)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	return {"clients": args.clients, "polls": len(polls),
+		"poll_ms": percentiles(polls), "requests": len(latencies),
+		"requests_per_second": len(latencies)/args.duration,
+		"page_ms": percentiles(latencies)}
+
+def make_metainfo(size, files, seed):
+	# a .torrent of about `size` bytes, most of it piece hashes, with
+	# `files` files in it (or a single-file torrent for 0)
+	random_ = random.Random(seed)
+	info = {"name": "benchmark %d" % seed, "piece length": 1 << 18}
+	if files:
+		info["files"] = [{"length": random_.randrange(1 << 30), "path": [
+			"directory %d" % (index%100), "file %d.bin" % index]}
+			for index in range(files)]
+	else:
+		info["length"] = random_.randrange(1 << 40)
+	pieces = max(size-len(Bencode.encode(info))-80, 0)//20
+	info["pieces"] = random_.randbytes(pieces*20)
+	return Bencode.encode({"announce": "http://tracker.example/announce",
+		"info": info})
+def bencode(args):
+	# the info hash and the parts /view shows, against decoding the
+	# whole thing and encoding the info dict again to hash it
+	results = []
+	for megabytes in args.bencode:
+		for files in [0, args.files]:
+			data = make_metainfo(int(megabytes*(1 << 20)), files,
+				args.seed)
+			def decoded():
+				return hashlib.sha1(Bencode.encode(Bencode.decode(data)[
+					b"info"])).hexdigest()
+			assert Bencode.info_hash(data) == decoded()
+			result = {"bytes": len(data), "files": files}
+			for name, function in [("info_hash", Bencode.info_hash),
+					("metadata", lambda data: Cache.Metadata(
+					Bencode.Metainfo(data))), ("decode", lambda data:
+					decoded())]:
+				result[name+"_ms"] = min(timed(function, data)[0]
+					for _ in range(args.rounds))
+			results.append(result)
+	return results
+
+def report(result):
+	print("== %d torrents, %d users, %s backend, %d btpd" % (
+		result["torrents"], result["users"], result["backend"],
+		result["daemons"]))
+	print("first poll   %9.1fms %5d queries" % (
+		result["first_poll_ms"], result["first_poll_queries"]))
+	print("owners poll  %9.1fms %5d queries" % (
+		result["owners_poll_ms"], result["owners_poll_queries"]))
+	print("poll p50/p90/p99  %s ms, %d queries, version %d" % ("/".join(
+		"%.1f" % result["poll_ms"][point] for point in ["50", "90",
+		"99"]), result["queries_per_poll"], result["version"]))
+	for name, took in sorted(result["database_ms"].items()):
+		print("db %-24s %8.2fms" % (name, took))
+	print("%-48s %8s %8s %8s %4s" % ("page", "p50", "p90", "p99", "sql"))
+	for page, stats in result["pages_ms"].items():
+		print("%-48s %8.2f %8.2f %8.2f %4d" % (page[:48], stats["50"],
+			stats["90"], stats["99"], stats["queries"]))
+	print("page cache %(hits)d hits, %(misses)d misses" % result[
+		"page_cache"])
+	if "concurrent" in result:
+		concurrent = result["concurrent"]
+		print("%d clients: %d polls (p50 %.1fms, p99 %.1fms), %.0f "
+			"requests/s (p50 %.2fms, p99 %.2fms)" % (concurrent[
+			"clients"], concurrent["polls"], concurrent["poll_ms"].get(
+			"50", 0), concurrent["poll_ms"].get("99", 0), concurrent[
+			"requests_per_second"], concurrent["page_ms"].get("50", 0),
+			concurrent["page_ms"].get("99", 0)))
+	print("rss %.1fMB, max rss %.1fMB" % (result["rss_mb"],
+		result["max_rss_mb"]))
+	print()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=
+		"Benchmark btpd-web against synthetic torrents and users")
+	parser.add_argument("--torrents", type=int, nargs="+",
+		default=[100, 10000, 100000])
+	parser.add_argument("--users", type=int, default=50)
+	parser.add_argument("--backend", choices=["ipc", "btcli"],
+		default="ipc")
+	parser.add_argument("--daemons", type=int, default=1,
+		help="fake btpds to split the torrents between")
+	parser.add_argument("--slow", type=float, default=0,
+		help="seconds the last of several daemons takes to list")
+	parser.add_argument("--poll-timeout", type=float, default=10,
+		help="BTPD_POLL_TIMEOUT")
+	parser.add_argument("--polls", type=int, default=10)
+	parser.add_argument("--requests", type=int, default=20,
+		help="requests per page")
+	parser.add_argument("--churn", type=float, default=0.1,
+		help="fraction of torrents that change between polls")
+	parser.add_argument("--clients", type=int, default=0,
+		help="concurrent clients to run against a busy poller")
+	parser.add_argument("--duration", type=float, default=10)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--json", action="store_true",
+		help="print results as json lines")
+	parser.add_argument("--bencode", type=float, nargs="+",
+		help="time reading .torrent files of these many MB instead")
+	parser.add_argument("--files", type=int, default=10000,
+		help="files in the multi-file .torrent for --bencode")
+	parser.add_argument("--rounds", type=int, default=5,
+		help="best of how many runs for --bencode")
+	parser.add_argument("--child", action="store_true",
+		help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.bencode:
+		if not args.json:
+			print("%10s %7s %12s %12s %12s" % ("bytes", "files",
+				"info_hash", "metadata", "decode"))
+		for result in bencode(args):
+			if args.json:
+				print(json.dumps(result))
+				continue
+			print("%10d %7d %10.2fms %10.2fms %10.2fms" % (
+				result["bytes"], result["files"], result["info_hash_ms"],
+				result["metadata_ms"], result["decode_ms"]))
+		sys.exit()
+
+	if args.child:
+		result = run(args, args.torrents[0])
+		sys.stdout.write("\n%s\n" % json.dumps(result))
+		sys.exit()
+	for torrents in args.torrents:
+		# the last --torrents given wins
+		process = subprocess.run([sys.executable, os.path.abspath(
+			__file__), "--child"]+sys.argv[1:]+["--torrents", str(
+			torrents)],
+			stdout=subprocess.PIPE, check=True)
+		result = json.loads(process.stdout.decode("utf8"
+			).strip().split("\n")[-1])
+		if args.json:
+			print(json.dumps(result))
+		else:
+			report(result)
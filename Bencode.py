@@ -0,0 +1,191 @@
+import hashlib, os
+
+class BencodeError(ValueError):
+	pass
+
+def encode(obj):
+	out = []
+	_encode(obj, out)
+	return b"".join(out)
+def _encode(obj, out):
+	if isinstance(obj, bool):
+		obj = int(obj)
+	if isinstance(obj, int):
+		out.append(b"i%de" % obj)
+	elif isinstance(obj, str):
+		obj = obj.encode("utf8")
+		out.append(b"%d:%s" % (len(obj), obj))
+	elif isinstance(obj, (bytes, bytearray)):
+		out.append(b"%d:%s" % (len(obj), obj))
+	elif isinstance(obj, (list, tuple)):
+		out.append(b"l")
+		for item in obj:
+			_encode(item, out)
+		out.append(b"e")
+	elif isinstance(obj, dict):
+		out.append(b"d")
+		keys = {(key.encode("utf8") if isinstance(key, str
+			) else key): value for key, value in obj.items()}
+		for key in sorted(keys):
+			out.append(b"%d:%s" % (len(key), key))
+			_encode(keys[key], out)
+		out.append(b"e")
+	else:
+		raise BencodeError("cannot bencode %r" % type(obj))
+
+def decode(data):
+	data = bytes(data)
+	try:
+		obj, offset = _decode(data, 0)
+	except (IndexError, ValueError) as e:
+		raise BencodeError("invalid bencoding: %s" % e)
+	if not offset == len(data):
+		raise BencodeError("trailing data after offset %d" % offset)
+	return obj
+def _decode(data, offset):
+	char = data[offset:offset+1]
+	if char == b"i":
+		end = data.index(b"e", offset)
+		return int(data[offset+1:end]), end+1
+	elif char == b"l":
+		offset += 1
+		items = []
+		while not data[offset:offset+1] == b"e":
+			item, offset = _decode(data, offset)
+			items.append(item)
+		return items, offset+1
+	elif char == b"d":
+		offset += 1
+		items = {}
+		while not data[offset:offset+1] == b"e":
+			key, offset = _decode(data, offset)
+			if not isinstance(key, bytes):
+				raise BencodeError("non-string dict key at offset %d" %
+					offset)
+			items[key], offset = _decode(data, offset)
+		return items, offset+1
+	elif char.isdigit():
+		colon = data.index(b":", offset)
+		end = colon+1+int(data[offset:colon])
+		if end > len(data):
+			raise BencodeError("string overruns data")
+		return data[colon+1:end], end
+	raise BencodeError("unexpected %r at offset %d" % (char, offset))
+
+# everything below works on the encoded bytes directly, finding where
+# values start and end without building them, so e.g. hashing the info
+# dict of a torrent never decodes its (potentially huge) piece table.
+
+def skip(data, offset=0):
+	# offset just past the value starting at `offset`
+	depth = 0
+	try:
+		while True:
+			char = data[offset]
+			if char == 105: # i
+				offset = data.index(b"e", offset)+1
+			elif char == 108 or char == 100: # l, d
+				depth += 1
+				offset += 1
+				continue
+			elif char == 101: # e
+				if not depth:
+					raise BencodeError("unexpected end at offset %d"
+						% offset)
+				depth -= 1
+				offset += 1
+			elif 48 <= char <= 57: # 0-9
+				colon = data.index(b":", offset)
+				offset = colon+1+int(data[offset:colon])
+			else:
+				raise BencodeError("unexpected %r at offset %d" % (
+					chr(char), offset))
+			if offset > len(data):
+				raise BencodeError("value overruns data")
+			if not depth:
+				return offset
+	except (IndexError, ValueError) as e:
+		if isinstance(e, BencodeError):
+			raise
+		raise BencodeError("invalid bencoding: %s" % e)
+
+def dict_spans(data, offset=0):
+	# key -> (start, end) for each value in the dict at `offset`
+	if not data[offset:offset+1] == b"d":
+		raise BencodeError("expected a dict at offset %d" % offset)
+	spans = {}
+	offset += 1
+	try:
+		while not data[offset:offset+1] == b"e":
+			if offset >= len(data):
+				raise BencodeError("unterminated dict")
+			key, offset = _decode(data, offset)
+			if not isinstance(key, bytes):
+				raise BencodeError("non-string dict key")
+			end = skip(data, offset)
+			spans[key] = (offset, end)
+			offset = end
+	except (IndexError, ValueError) as e:
+		if isinstance(e, BencodeError):
+			raise
+		raise BencodeError("invalid bencoding: %s" % e)
+	return spans
+
+def info_span(data):
+	spans = dict_spans(data)
+	if not b"info" in spans or not data[spans[b"info"][0]] == 100:
+		raise BencodeError("no info dict")
+	return spans[b"info"]
+def info_hash(data):
+	start, end = info_span(data)
+	return hashlib.sha1(memoryview(data)[start:end]).hexdigest()
+
+class Metainfo(object):
+	# lazy access to the parts of a .torrent we actually look at
+	def __init__(self, data):
+		self.data = bytes(data)
+		self.spans = dict_spans(self.data)
+		if not b"info" in self.spans:
+			raise BencodeError("no info dict")
+		self.info_spans = dict_spans(self.data, self.spans[b"info"][0])
+	def _value(self, spans, key, default=None):
+		if not key in spans:
+			return default
+		start, end = spans[key]
+		return decode(self.data[start:end])
+	def get(self, key, default=None):
+		return self._value(self.spans, key, default)
+	def info(self, key, default=None):
+		return self._value(self.info_spans, key, default)
+
+	@property
+	def info_hash(self):
+		start, end = self.spans[b"info"]
+		return hashlib.sha1(memoryview(self.data)[start:end]
+			).hexdigest()
+	@property
+	def name(self):
+		name = self.info(b"name.utf-8") or self.info(b"name", b"")
+		return name.decode("utf8", "replace")
+	@property
+	def piece_length(self):
+		return self.info(b"piece length", 0)
+	@property
+	def piece_count(self):
+		start, end = self.info_spans.get(b"pieces", (0, 0))
+		if not end:
+			return 0
+		return (end-self.data.index(b":", start)-1)//20
+	@property
+	def files(self):
+		# [(path, length)], paths relative to the content directory
+		name = self.name
+		files = self.info(b"files")
+		if files is None:
+			return [(name, self.info(b"length", 0))]
+		return [(os.path.join(name, *[part.decode("utf8", "replace")
+			for part in (file.get(b"path.utf-8") or file[b"path"])]),
+			file[b"length"]) for file in files]
+	@property
+	def size(self):
+		return sum(length for path, length in self.files)
@@ -0,0 +1,269 @@
+import codecs, collections.abc, math, operator, os, socket, struct, threading
+import Bencode
+
+IPC_OK = 0
+IPC_COMMERR = 1
+
+TWC_ALL = 0
+TWC_ACTIVE = 1
+TWC_INACTIVE = 2
+
+(TVAL_CGOT, TVAL_CSIZE, TVAL_DIR, TVAL_IHASH, TVAL_NAME, TVAL_NUM,
+	TVAL_PCOUNT, TVAL_PCCOUNT, TVAL_PCGOT, TVAL_PCSEEN, TVAL_RATEDWN,
+	TVAL_RATEUP, TVAL_SESSDWN, TVAL_SESSUP, TVAL_STATE, TVAL_TOTDWN,
+	TVAL_TOTUP, TVAL_TRERR, TVAL_TRGOOD) = range(19)
+
+TYPE_ERR = 0
+TYPE_BIN = 1
+TYPE_NUM = 2
+TYPE_STR = 3
+
+TSTATE_CHARS = {0: "I", 1: "+", 2: "-", 3: "L", 4: "S"}
+
+LIST_KEYS = [TVAL_NAME, TVAL_NUM, TVAL_STATE, TVAL_CGOT, TVAL_CSIZE,
+	TVAL_IHASH, TVAL_PCOUNT, TVAL_RATEUP, TVAL_RATEDWN, TVAL_TOTUP,
+	TVAL_TOTDWN, TVAL_PCGOT, TVAL_PCCOUNT]
+
+LENGTH = struct.Struct("=I")
+
+class BtpdError(Exception):
+	def __init__(self, code):
+		Exception.__init__(self, "btpd returned error code %d" % code)
+		self.code = code
+class ProtocolError(Exception):
+	pass
+
+def pretty_size(size):
+	if size >= 999.995*(1 << 20):
+		return "%.2fG" % (size/(1 << 30))
+	elif size >= 999.995*(1 << 10):
+		return "%.2fM" % (size/(1 << 20))
+	return "%.2fK" % (size/(1 << 10))
+def parse_size(text):
+	# the reverse of pretty_size, as near as its rounding allows
+	units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+	text = text.strip().rstrip("B/s")
+	if text[-1:].upper() in units:
+		return int(float(text[:-1])*units[text[-1:].upper()])
+	return int(float(text or 0))
+def percent(part, whole):
+	if not whole:
+		return 0.0
+	return math.floor(1000.0*part/whole)/10
+def ratio(part, whole):
+	if not whole:
+		return 0.0
+	return round(part/whole, 2)
+
+class Torrent(collections.abc.Mapping):
+	# one torrent in a list from btpd. everything is stored parsed (sizes
+	# in bytes, rates in bytes/s) and the display strings are made when
+	# something asks for them. reads like a dict, for templates and
+	# json; once published it isn't changed, replace() makes a copy.
+	__slots__ = ["id", "title", "name", "state", "info_hash", "size",
+		"percent", "ratio", "peers", "upload_rate", "download_rate",
+		"uploaded_bytes", "downloaded_bytes", "have_pieces",
+		"total_pieces", "owner", "uploader"]
+	FORMATTED = ["pretty_size", "pretty_percent", "pretty_ratio",
+		"upload_speed", "download_speed", "uploaded", "downloaded"]
+	def __init__(self, id, title, state, info_hash, size, percent, ratio,
+			peers, upload_rate, download_rate, uploaded_bytes,
+			downloaded_bytes, have_pieces, total_pieces, owner=1,
+			uploader=None):
+		self.id = id
+		self.title = title
+		self.name = title.lower()
+		self.state = state
+		self.info_hash = info_hash
+		self.size = size
+		self.percent = percent
+		self.ratio = ratio
+		self.peers = peers
+		self.upload_rate = upload_rate
+		self.download_rate = download_rate
+		self.uploaded_bytes = uploaded_bytes
+		self.downloaded_bytes = downloaded_bytes
+		self.have_pieces = have_pieces
+		self.total_pieces = total_pieces
+		self.owner = owner
+		self.uploader = uploader
+	def pack(self):
+		return PACK(self)
+	@staticmethod
+	def unpack(values):
+		# spelled out in __slots__ order rather than setattr()ed in a
+		# loop, since workers unpack every torrent in every snapshot
+		torrent = Torrent.__new__(Torrent)
+		(torrent.id, torrent.title, torrent.name, torrent.state,
+			torrent.info_hash, torrent.size, torrent.percent, torrent.ratio,
+			torrent.peers, torrent.upload_rate, torrent.download_rate,
+			torrent.uploaded_bytes, torrent.downloaded_bytes,
+			torrent.have_pieces, torrent.total_pieces, torrent.owner,
+			torrent.uploader) = values
+		return torrent
+	def replace(self, **fields):
+		torrent = Torrent.__new__(Torrent)
+		for key in self.__slots__:
+			setattr(torrent, key, fields.get(key, getattr(self, key)))
+		if "title" in fields:
+			torrent.name = torrent.title.lower()
+		return torrent
+
+	def __getitem__(self, key):
+		if not key in KEYS:
+			raise KeyError(key)
+		return getattr(self, key)
+	def __iter__(self):
+		return iter(Torrent.__slots__+Torrent.FORMATTED)
+	def __len__(self):
+		return len(KEYS)
+	def __eq__(self, other):
+		if self is other:
+			return True
+		if not isinstance(other, Torrent):
+			return NotImplemented
+		return PACK(self) == PACK(other)
+	def __ne__(self, other):
+		equal = self.__eq__(other)
+		return equal if equal is NotImplemented else not equal
+	def __repr__(self):
+		return "Torrent(%d, %r)" % (self.id, self.title)
+
+	@property
+	def pretty_size(self):
+		return pretty_size(self.size)
+	@property
+	def pretty_percent(self):
+		return "%.1f%%" % self.percent
+	@property
+	def pretty_ratio(self):
+		return "%.2f" % self.ratio
+	@property
+	def upload_speed(self):
+		return pretty_size(self.upload_rate)
+	@property
+	def download_speed(self):
+		return pretty_size(self.download_rate)
+	@property
+	def uploaded(self):
+		return pretty_size(self.uploaded_bytes)
+	@property
+	def downloaded(self):
+		return pretty_size(self.downloaded_bytes)
+KEYS = frozenset(Torrent.__slots__+Torrent.FORMATTED)
+PACK = operator.attrgetter(*Torrent.__slots__)
+
+def make_torrents(results):
+	# Torrents from what tget(LIST_KEYS) returned
+	torrents = []
+	for values in results:
+		if not values:
+			continue
+		size = values[TVAL_CSIZE] or 0
+		torrents.append(Torrent(values[TVAL_NUM], values[
+			TVAL_NAME] or "", TSTATE_CHARS.get(values[TVAL_STATE],
+			"?"), codecs.encode(values[TVAL_IHASH], "hex").decode(
+			"utf8"), size, percent(values[TVAL_CGOT] or 0, size),
+			ratio(values[TVAL_TOTUP] or 0, size), values[
+			TVAL_PCOUNT] or 0, values[TVAL_RATEUP] or 0, values[
+			TVAL_RATEDWN] or 0, values[TVAL_TOTUP] or 0, values[
+			TVAL_TOTDWN] or 0, values[TVAL_PCGOT] or 0, values[
+			TVAL_PCCOUNT] or 0))
+	return torrents
+
+class Client(object):
+	def __init__(self, btpd_dir, timeout=10):
+		self.path = os.path.join(btpd_dir, "sock")
+		self.timeout = timeout
+		self.socket = None
+		self.lock = threading.Lock()
+	def connect(self):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(self.timeout)
+		try:
+			sock.connect(self.path)
+		except:
+			sock.close()
+			raise
+		self.socket = sock
+	def close(self):
+		if self.socket:
+			try:
+				self.socket.close()
+			finally:
+				self.socket = None
+	def _read(self, size):
+		data = bytearray()
+		while len(data) < size:
+			chunk = self.socket.recv(size-len(data))
+			if not chunk:
+				raise ConnectionResetError(
+					"btpd closed the connection")
+			data += chunk
+		return bytes(data)
+	def _round_trip(self, data):
+		if not self.socket:
+			self.connect()
+		self.socket.sendall(LENGTH.pack(len(data))+data)
+		size, = LENGTH.unpack(self._read(LENGTH.size))
+		return self._read(size)
+
+	def request(self, *args):
+		data = Bencode.encode(list(args))
+		with self.lock:
+			try:
+				response = self._round_trip(data)
+			except OSError:
+				# the connection may simply have gone stale
+				# (btpd restarted), so reconnect once.
+				self.close()
+				try:
+					response = self._round_trip(data)
+				except:
+					self.close()
+					raise
+		try:
+			response = Bencode.decode(response)
+			code = response[b"code"]
+		except (Bencode.BencodeError, KeyError, TypeError):
+			raise ProtocolError("malformed response from btpd")
+		if not code == IPC_OK:
+			raise BtpdError(code)
+		return response
+
+	def tget(self, keys, torrents=TWC_ALL):
+		response = self.request("tget", {"from": torrents,
+			"keys": keys})
+		results = []
+		for result in response.get(b"result", []):
+			if isinstance(result, int):
+				results.append(None)
+				continue
+			values = {}
+			for i, key in enumerate(keys):
+				type, value = result[i*2], result[i*2+1]
+				if type == TYPE_STR:
+					value = value.decode("utf8", "replace")
+				elif type == TYPE_ERR:
+					value = None
+				values[key] = value
+			results.append(values)
+		return results
+	def list(self):
+		return make_torrents(self.tget(LIST_KEYS))
+
+	def add(self, directory, torrent, name=None):
+		arguments = {"content": directory, "torrent": torrent}
+		if name:
+			arguments["name"] = name
+		return self.request("add", arguments)[b"num"]
+	def start(self, id):
+		self.request("start", int(id))
+	def stop(self, id):
+		self.request("stop", int(id))
+	def delete(self, id):
+		self.request("del", int(id))
+	def start_all(self):
+		self.request("start-all")
+	def stop_all(self):
+		self.request("stop-all")
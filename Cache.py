@@ -0,0 +1,126 @@
+import array, collections, os, threading
+import Bencode
+
+class FragmentCache(object):
+	# rendered page fragments for the newest snapshot version seen.
+	# everything cached goes the first time a newer version (or any
+	# version of another epoch) is asked for; requests still holding an
+	# older snapshot render without caching.
+	def __init__(self, size=256):
+		self.size = size
+		self.epoch = None
+		self.version = -1
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+	def get(self, version, key, render, epoch=0):
+		with self.lock:
+			if not epoch == self.epoch or version > self.version:
+				self.entries.clear()
+				self.epoch = epoch
+				self.version = version
+			elif version == self.version and key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key]
+			self.misses += 1
+		value = render()
+		with self.lock:
+			if epoch == self.epoch and version == self.version:
+				self.entries[key] = value
+				while len(self.entries) > self.size:
+					self.entries.popitem(last=False)
+		return value
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses,
+				"entries": len(self.entries), "version": self.version}
+
+class Metadata(object):
+	# the parts of a .torrent /view shows. piece hashes aren't kept,
+	# and file paths are kept end to end in one string (with where
+	# each starts) and their lengths in an array, rather than as a
+	# pair of objects per file.
+	__slots__ = ["name", "piece_length", "piece_count", "size", "comment",
+		"created_by", "creation_date", "paths", "starts", "lengths"]
+	def __init__(self, metainfo):
+		self.name = metainfo.name
+		self.piece_length = metainfo.piece_length
+		self.piece_count = metainfo.piece_count
+		comment = metainfo.get(b"comment")
+		self.comment = comment.decode("utf8", "replace") if isinstance(
+			comment, bytes) else None
+		created_by = metainfo.get(b"created by")
+		self.created_by = created_by.decode("utf8", "replace"
+			) if isinstance(created_by, bytes) else None
+		creation_date = metainfo.get(b"creation date")
+		self.creation_date = creation_date if isinstance(creation_date,
+			int) else None
+		# multi-file paths all start with the torrent's name
+		prefix = len(self.name)+1 if b"files" in metainfo.info_spans else 0
+		self.starts = array.array("q", [0])
+		self.lengths = array.array("q")
+		paths = []
+		for path, length in metainfo.files:
+			paths.append(path[prefix:])
+			self.starts.append(self.starts[-1]+len(paths[-1]))
+			self.lengths.append(length)
+		self.paths = "".join(paths)
+		self.size = sum(self.lengths)
+	@property
+	def file_count(self):
+		return len(self.lengths)
+	def files(self, start, stop):
+		# [(path, length)] for files[start:stop]
+		return [(self.paths[self.starts[index]:self.starts[index+1]],
+			self.lengths[index]) for index in range(*slice(start, stop
+			).indices(len(self.lengths)))]
+
+class MetainfoCache(object):
+	# Metadata for .torrent files, read the first time each is asked
+	# for and kept, by info hash, for as long as the file's unchanged.
+	# the least recently used go once there are more than `size` or
+	# more than `max_files` files between them.
+	def __init__(self, size=64, max_files=500000):
+		self.size = size
+		self.max_files = max_files
+		self.entries = collections.OrderedDict()
+		self.files = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+	def get(self, info_hash, path):
+		# None when there's no (readable) .torrent at `path`
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		identity = (stat.st_mtime_ns, stat.st_size)
+		with self.lock:
+			entry = self.entries.get(info_hash)
+			if entry and entry[0] == identity:
+				self.entries.move_to_end(info_hash)
+				self.hits += 1
+				return entry[1]
+			self.misses += 1
+		try:
+			with open(path, "rb") as file:
+				metadata = Metadata(Bencode.Metainfo(file.read()))
+		except (OSError, ValueError, KeyError, TypeError):
+			return None
+		with self.lock:
+			old = self.entries.pop(info_hash, None)
+			if old:
+				self.files -= old[1].file_count
+			self.entries[info_hash] = (identity, metadata)
+			self.files += metadata.file_count
+			while len(self.entries) > 1 and (len(self.entries) >
+					self.size or self.files > self.max_files):
+				_, (_, evicted) = self.entries.popitem(last=False)
+				self.files -= evicted.file_count
+		return metadata
+	def stats(self):
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses,
+				"entries": len(self.entries), "files": self.files}
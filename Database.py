@@ -1,69 +1,192 @@
-import base64, json, os, sqlite3, threading
+import base64, collections, hmac, json, os, sqlite3, sys, threading, time
+import weakref
 import scrypt
 
+# scrypt's own defaults, which every hash made before costs were
+# recorded alongside it was made with.
+DEFAULT_SCRYPT_PARAMS = (1 << 14, 8, 1)
+
+PRAGMAS = ["foreign_keys=ON", "synchronous=NORMAL", "busy_timeout=10000",
+	"temp_store=MEMORY", "cache_size=-8192"]
+
+# each entry moves the schema up one version (PRAGMA user_version).
+# never edit one that's been released, add another.
+MIGRATIONS = [
+	["""CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY,
+		username text UNIQUE, hash text, salt text, admin bool)""",
+	"""CREATE TABLE IF NOT EXISTS settings (user_id INTEGER,
+		setting TEXT, value TEXT, PRIMARY KEY (user_id, setting),
+		FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE
+		CASCADE)""",
+	"""CREATE TABLE IF NOT EXISTS sessions (user_id INTEGER,
+		session TEXT UNIQUE, FOREIGN KEY(user_id) REFERENCES
+		users(id) ON DELETE CASCADE)""",
+	"""CREATE TABLE IF NOT EXISTS torrents (info_hash TEXT PRIMARY
+		KEY, user_id INTEGER, FOREIGN KEY(user_id) REFERENCES
+		users(id) ON DELETE CASCADE)"""],
+	["CREATE INDEX IF NOT EXISTS torrents_user_id ON torrents(user_id)",
+	"CREATE INDEX IF NOT EXISTS sessions_user_id ON sessions(user_id)",
+	"""CREATE INDEX IF NOT EXISTS users_username_nocase ON
+		users(username COLLATE NOCASE)""",
+	"""CREATE INDEX IF NOT EXISTS users_username_upper ON
+		users(UPPER(username))"""]
+]
+
+SessionUser = collections.namedtuple("SessionUser",
+	["id", "username", "admin"])
+
+class ObservedCursor(object):
+	# stands in for a sqlite3 cursor, timing every statement and
+	# telling each observer(frame of the Database method that ran it,
+	# statement, seconds).
+	def __init__(self, cursor, observers):
+		self.cursor = cursor
+		self.observers = observers
+	def _run(self, method, statement, args):
+		frame = sys._getframe(2)
+		start = time.perf_counter()
+		try:
+			getattr(self.cursor, method)(statement, *args)
+		finally:
+			seconds = time.perf_counter()-start
+			for observer in self.observers:
+				observer(frame, statement, seconds)
+		return self
+	def execute(self, statement, *args):
+		return self._run("execute", statement, args)
+	def executemany(self, statement, *args):
+		return self._run("executemany", statement, args)
+	def __iter__(self):
+		return iter(self.cursor)
+	def __getattr__(self, name):
+		return getattr(self.cursor, name)
+
+class Lease(object):
+	# a thread's hold on a pooled connection, see Database.cursor()
+	pass
+
 class Database(object):
-	def __init__(self):
-		self.location = "btpd-web.db"
-		self.database = sqlite3.connect(self.location,
-			isolation_level=None, check_same_thread=False)
-		self.cursors = {}
-		self.make_users_table()
-		self.make_settings_table()
-		self.make_sessions_table()
-		self.make_torrents_table()
+	def __init__(self, session_cache_size=1024, scrypt_params=None,
+			shared=False, observers=(), pool_size=8,
+			location="btpd-web.db"):
+		self.location = location
+		# when other processes write to the database too, the caches
+		# below can't be kept in step by hand and are dropped
+		# whenever anything else has written.
+		self.shared = shared
+		self.watch = None
+		self.watch_lock = threading.Lock()
+		self.data_versions = {}
+		# told about every statement run, see ObservedCursor
+		self.observers = list(observers)
+		self.scrypt_params = tuple(scrypt_params or
+			DEFAULT_SCRYPT_PARAMS)
+		self.connections = threading.local()
+		# connections left by threads that have finished, for the next
+		# threads to use rather than each connecting afresh. at most
+		# `pool_size` are kept.
+		self.pool = []
+		self.pool_size = pool_size
+		self.pool_lock = threading.Lock()
+		self.owners = None
+		self.owners_lock = threading.Lock()
+		self.sessions = collections.OrderedDict()
+		self.sessions_size = session_cache_size
+		self.sessions_lock = threading.Lock()
+		self.sessions_generation = 0
+		self.migrate()
 		if not self.has_username("root"):
 			password = base64.b64encode(
 				os.urandom(16)).decode("utf8")
 			self.add_user("root", password, True)
 			print("added root user.")
 			print("password: %s" % password)
+	def connect(self):
+		# only ever used by one thread at a time, but not always the
+		# same one, see cursor()
+		database = sqlite3.connect(self.location,
+			isolation_level=None, timeout=10, check_same_thread=False)
+		for pragma in PRAGMAS:
+			database.execute("PRAGMA %s" % pragma)
+		return database
 	def cursor(self):
-		id = threading.current_thread().ident
-		if not id in self.cursors:
-			self.cursors[id] = self.database.cursor()
-			self.cursors[id].execute(
-				"PRAGMA foreign_keys=ON")
-		return self.cursors[id]
-	def make_users_table(self):
-		try:
-			self.cursor().execute("""CREATE TABLE users (
-				id INTEGER PRIMARY KEY, username text
-				UNIQUE, hash text, salt text, admin
-				bool)""")
-		except sqlite3.OperationalError:
-			pass
-	def make_settings_table(self):
-		try:
-			self.cursor().execute("""CREATE TABLE settings (
-				user_id INTEGER, setting TEXT, value TEXT,
-				PRIMARY KEY (user_id, setting), FOREIGN
-				KEY(user_id) REFERENCES users(id) ON DELETE
-				CASCADE)""")
-		except sqlite3.OperationalError:
-			pass
-	def make_sessions_table(self):
-		try:
-			self.cursor().execute("""CREATE TABLE sessions (
-				user_id INTEGER, session TEXT UNIQUE, FOREIGN
-				KEY(user_id) REFERENCES users(id) ON DELETE
-				CASCADE)""")
-		except sqlite3.OperationalError:
-			pass
-	def make_torrents_table(self):
-		try:
-			self.cursor().execute("""CREATE TABLE torrents (
-				info_hash TEXT PRIMARY KEY, user_id INTEGER,
-				FOREIGN KEY(user_id) REFERENCES users(id)
-				ON DELETE CASCADE)""")
-		except sqlite3.OperationalError:
-			pass
+		# one connection (and cursor) per thread, taken from the pool
+		# when there is one and given back when the thread finishes.
+		# werkzeug runs each request on a thread of its own, which
+		# would otherwise connect and run PRAGMAS every request.
+		if not hasattr(self.connections, "cursor"):
+			with self.pool_lock:
+				database, cursor = self.pool.pop() if self.pool else (
+					None, None)
+			if database is None:
+				database = self.connect()
+				cursor = database.cursor()
+			# dropped along with the thread's other locals
+			self.connections.lease = Lease()
+			weakref.finalize(self.connections.lease, self._release,
+				database, cursor)
+			self.connections.database = database
+			self.connections.cursor = cursor
+			if self.observers:
+				self.connections.cursor = ObservedCursor(cursor,
+					self.observers)
+		return self.connections.cursor
+	def _release(self, database, cursor):
+		with self.pool_lock:
+			if len(self.pool) < self.pool_size:
+				self.pool.append((database, cursor))
+				return
+		database.close()
+	def changed_elsewhere(self, cache):
+		# whether the database has been written to since the last time
+		# we asked on behalf of `cache`. data_version moves on for
+		# every write except the asking connection's own, so it gets
+		# a connection that never writes.
+		with self.watch_lock:
+			if self.watch is None:
+				self.watch = sqlite3.connect(self.location,
+					check_same_thread=False)
+			version = self.watch.execute("PRAGMA data_version"
+				).fetchone()[0]
+			changed = not self.data_versions.get(cache, version
+				) == version
+			self.data_versions[cache] = version
+			return changed
+	def migrate(self):
+		cursor = self.cursor()
+		cursor.execute("PRAGMA journal_mode=WAL")
+		version = cursor.execute("PRAGMA user_version").fetchone()[0]
+		for version, statements in enumerate(MIGRATIONS[version:],
+				version+1):
+			cursor.execute("BEGIN IMMEDIATE")
+			try:
+				for statement in statements:
+					cursor.execute(statement)
+				cursor.execute("PRAGMA user_version=%d" % version)
+				cursor.execute("COMMIT")
+			except:
+				cursor.execute("ROLLBACK")
+				raise
 	def make_salt(self):
 		return base64.b64encode(os.urandom(32)).decode("utf8")
 	def make_session(self):
 		return base64.b64encode(os.urandom(32)).decode("utf8")
-	def make_hash(self, password, salt):
-		return base64.b64encode(scrypt.hash(password, salt)
-			).decode("utf8")
+	def make_hash(self, password, salt, params=None):
+		n, r, p = params or self.scrypt_params
+		return "scrypt$%d$%d$%d$%s" % (n, r, p, base64.b64encode(
+			scrypt.hash(password, salt, N=n, r=r, p=p)).decode("utf8"))
+	def hash_params(self, hash):
+		if hash.startswith("scrypt$"):
+			return tuple(int(n) for n in hash.split("$")[1:4])
+		return None
+	def check_hash(self, hash, password, salt):
+		params = self.hash_params(hash)
+		if params:
+			expected = self.make_hash(password, salt, params)
+		else:
+			expected = base64.b64encode(scrypt.hash(password, salt)
+				).decode("utf8")
+		return hmac.compare_digest(hash, expected)
 	def get_user_id(self, username):
 		self.cursor().execute(
 			"SELECT id FROM users WHERE username=?",
@@ -79,17 +202,60 @@ class Database(object):
 		self.cursor().execute(
 			"DELETE FROM sessions WHERE session=?",
 			[session])
+		with self.sessions_lock:
+			self.sessions.pop(session, None)
+			self.sessions_generation += 1
+	def session_user(self, session):
+		# who a session belongs to, from a bounded LRU in front of
+		# the sessions table. anything that changes a user has to
+		# go through forget_user() to keep this honest.
+		if not session:
+			return None
+		if self.shared and self.changed_elsewhere("sessions"):
+			with self.sessions_lock:
+				self.sessions.clear()
+				self.sessions_generation += 1
+		with self.sessions_lock:
+			if session in self.sessions:
+				self.sessions.move_to_end(session)
+				return self.sessions[session]
+			generation = self.sessions_generation
+		self.cursor().execute("""SELECT users.id, users.username,
+			users.admin FROM sessions JOIN users ON
+			sessions.user_id=users.id WHERE sessions.session=?""",
+			[session])
+		user = self.cursor().fetchone()
+		if not user:
+			return None
+		user = SessionUser(user[0], user[1], bool(user[2]))
+		with self.sessions_lock:
+			# don't cache what a concurrent forget_user() or
+			# del_session() may have just made stale
+			if not generation == self.sessions_generation:
+				return user
+			self.sessions[session] = user
+			while len(self.sessions) > self.sessions_size:
+				self.sessions.popitem(last=False)
+		return user
+	def forget_user(self, id):
+		with self.sessions_lock:
+			self.sessions_generation += 1
+			for session, user in list(self.sessions.items()):
+				if str(user.id) == str(id):
+					del self.sessions[session]
 	def authenticate(self, username, password):
 		self.cursor().execute(
 			"SELECT hash, salt FROM users WHERE username=?",
 			[username])
 		hash, salt = self.cursor().fetchone() or [None, None]
-		if hash and salt:
-			hashed = self.make_hash(password, salt)
-			if hash and hash == self.make_hash(
-					password, salt):
-				return True
-		return False
+		if not hash or not salt or not self.check_hash(hash,
+				password, salt):
+			return False
+		if not self.hash_params(hash) == self.scrypt_params:
+			# made with old costs, we've got the password now so
+			# bring it up to date.
+			self.set_password(username, password)
+		return True
 	def is_authenticated(self, session):
 		id = self.id_from_session(session)
 		return bool(id)
@@ -102,8 +268,11 @@ class Database(object):
 	def del_user(self, id):
 		if id == 1:
 			raise ValueError("cannot delete root user")
-		self.cursor().execute(
-			"DELETE FROM users WHERE id=?", [id])
+		with self.owners_lock:
+			self.cursor().execute(
+				"DELETE FROM users WHERE id=?", [id])
+			self.owners = None
+		self.forget_user(id)
 	def set_password(self, username, new_password):
 		salt = self.make_salt()
 		hash = self.make_hash(new_password, salt)
@@ -111,9 +280,16 @@ class Database(object):
 		self.cursor().execute("""UPDATE users SET hash=?,salt=?
 			WHERE id=?""", [hash, salt, id])
 	def change_username(self, old_username, new_username):
-		id = self.username_from_id(old_username)
-		self.cursor().execute("""UPDATE users SET username=?
-			WHERE id=?""", [new_username, id])
+		id = self.id_from_username(old_username)
+		with self.owners_lock:
+			self.cursor().execute("""UPDATE users SET username=?
+				WHERE id=?""", [new_username, id])
+			self.owners = None
+		self.forget_user(id)
+	def set_admin(self, id, admin):
+		self.cursor().execute("UPDATE users SET admin=? WHERE id=?",
+			[bool(admin), id])
+		self.forget_user(id)
 	def user_count(self):
 		self.cursor().execute(
 			"SELECT COUNT(*) FROM users")
@@ -157,16 +333,72 @@ class Database(object):
 			"SELECT id, username, admin FROM users")
 		users = self.cursor().fetchall()
 		return users
+	def list_users_with_counts(self):
+		self.cursor().execute("""SELECT users.id, users.username,
+			users.admin, COUNT(torrents.info_hash) FROM users LEFT
+			JOIN torrents ON torrents.user_id=users.id GROUP BY
+			users.id ORDER BY users.id""")
+		return [{"id": id, "username": username, "admin": bool(admin),
+			"torrent_count": count} for id, username, admin, count in
+			self.cursor().fetchall()]
 	def add_torrent(self, info_hash, username):
 		id = self.id_from_username(username)
 		if id:
-			self.cursor().execute("""INSERT INTO torrents (
-				info_hash, user_id) VALUES (?, ?)""",
-				[info_hash, id])
+			with self.owners_lock:
+				self.cursor().execute("""INSERT OR REPLACE INTO
+					torrents (info_hash, user_id) VALUES (?, ?)""",
+					[info_hash, id])
+				if self.owners is not None:
+					self.owners[info_hash] = (id,
+						self.username_from_id(id))
 	def del_torrent(self, info_hash):
-		self.cursor().execute(
-			"DELETE FROM torrents WHERE info_hash=?",
-			[info_hash])
+		with self.owners_lock:
+			self.cursor().execute(
+				"DELETE FROM torrents WHERE info_hash=?",
+				[info_hash])
+			if self.owners is not None:
+				self.owners.pop(info_hash, None)
+	def del_torrents(self, info_hashes):
+		self.update_torrents([], info_hashes)
+	def torrent_owners(self):
+		# info_hash -> (user id, username), loaded once and kept in
+		# step with every write that goes through this class.
+		with self.owners_lock:
+			if self.shared and self.changed_elsewhere("owners"):
+				self.owners = None
+			if self.owners is None:
+				self.cursor().execute("""SELECT
+					torrents.info_hash, users.id, users.username
+					FROM torrents JOIN users ON
+					torrents.user_id=users.id""")
+				self.owners = {info_hash: (id, username) for
+					info_hash, id, username in
+					self.cursor().fetchall()}
+			return self.owners
+	def update_torrents(self, added, removed, user_id=1):
+		if not added and not removed:
+			return
+		with self.owners_lock:
+			cursor = self.cursor()
+			cursor.execute("BEGIN IMMEDIATE")
+			try:
+				cursor.executemany("""INSERT OR IGNORE INTO
+					torrents (info_hash, user_id) VALUES (?, ?)""",
+					[(info_hash, user_id) for info_hash in added])
+				cursor.executemany(
+					"DELETE FROM torrents WHERE info_hash=?",
+					[(info_hash,) for info_hash in removed])
+				cursor.execute("COMMIT")
+			except:
+				cursor.execute("ROLLBACK")
+				self.owners = None
+				raise
+			if self.owners is not None:
+				owner = (user_id, self.username_from_id(user_id))
+				for info_hash in added:
+					self.owners.setdefault(info_hash, owner)
+				for info_hash in removed:
+					self.owners.pop(info_hash, None)
 	def get_torrent_owner(self, info_hash):
 		self.cursor().execute(
 			"SELECT user_id FROM torrents WHERE info_hash=?",
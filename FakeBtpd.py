@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# a stand-in for btpd's control socket, for exercising Btpd.Client (and
+# everything above it) without a real daemon.
+
+import argparse, hashlib, os, random, socket, socketserver, threading, time
+import Bencode, Btpd
+
+class Torrent(object):
+	def __init__(self, num, name, info_hash, directory, size,
+			piece_count):
+		self.num = num
+		self.name = name
+		self.info_hash = info_hash
+		self.directory = directory
+		self.size = size
+		self.got = 0
+		self.piece_count = piece_count
+		self.state = 0
+		self.peers = 0
+		self.rate_up = 0
+		self.rate_down = 0
+		self.total_up = 0
+		self.total_down = 0
+	def value(self, key):
+		if key == Btpd.TVAL_NAME:
+			return Btpd.TYPE_STR, self.name.encode("utf8")
+		elif key == Btpd.TVAL_DIR:
+			return Btpd.TYPE_STR, self.directory.encode("utf8")
+		elif key == Btpd.TVAL_IHASH:
+			return Btpd.TYPE_BIN, self.info_hash
+		values = {Btpd.TVAL_NUM: self.num, Btpd.TVAL_STATE:
+			self.state, Btpd.TVAL_CSIZE: self.size,
+			Btpd.TVAL_CGOT: self.got, Btpd.TVAL_PCOUNT: self.peers,
+			Btpd.TVAL_PCCOUNT: self.piece_count, Btpd.TVAL_PCGOT:
+			self.piece_count*self.got//max(self.size, 1),
+			Btpd.TVAL_PCSEEN: self.piece_count, Btpd.TVAL_RATEUP:
+			self.rate_up, Btpd.TVAL_RATEDWN: self.rate_down,
+			Btpd.TVAL_TOTUP: self.total_up, Btpd.TVAL_TOTDWN:
+			self.total_down, Btpd.TVAL_SESSUP: self.total_up,
+			Btpd.TVAL_SESSDWN: self.total_down, Btpd.TVAL_TRERR:
+			0, Btpd.TVAL_TRGOOD: 1}
+		if not key in values:
+			return Btpd.TYPE_ERR, 1
+		return Btpd.TYPE_NUM, values[key]
+
+class FakeBtpd(object):
+	def __init__(self, btpd_dir, churn=0.0, delay=0.0):
+		self.btpd_dir = btpd_dir
+		# the fraction of torrents whose transfer moves along each
+		# time the whole list is asked for
+		self.churn = churn
+		# seconds to stall before answering for the whole list, to play
+		# a slow daemon
+		self.delay = delay
+		self.generator = random.Random()
+		self.torrents = {}
+		self.next_num = 1
+		self.lock = threading.Lock()
+		self.server = None
+	def populate(self, count, seed=0):
+		generator = random.Random(seed)
+		with self.lock:
+			for _ in range(count):
+				num = self.next_num
+				self.next_num += 1
+				size = generator.randint(1 << 20, 1 << 34)
+				torrent = Torrent(num, "synthetic torrent %d" % num,
+					hashlib.sha1(b"%d:%d" % (seed, num)).digest(), "/tmp",
+					size, size//(1 << 18)+1)
+				torrent.state = generator.choice([0, 3, 4])
+				if torrent.state:
+					torrent.got = generator.randint(0, size)
+					torrent.peers = generator.randint(0, 50)
+					torrent.rate_up = generator.randint(0, 1 << 20)
+					torrent.rate_down = generator.randint(0,
+						1 << 20)
+				torrent.total_up = generator.randint(0, size*3)
+				torrent.total_down = torrent.got
+				self.torrents[num] = torrent
+
+	def tick(self):
+		torrents = list(self.torrents.values())
+		for torrent in self.generator.sample(torrents, int(len(
+				torrents)*self.churn)):
+			torrent.rate_up = self.generator.randint(0, 1 << 20)
+			torrent.total_up += torrent.rate_up
+			if torrent.got < torrent.size:
+				torrent.rate_down = self.generator.randint(0, 1 << 20)
+				torrent.got = min(torrent.got+torrent.rate_down,
+					torrent.size)
+				torrent.total_down += torrent.rate_down
+
+	def _find(self, spec):
+		for torrent in self.torrents.values():
+			if spec == torrent.num or spec == torrent.info_hash:
+				return torrent
+	def handle(self, request):
+		command, args = request[0], request[1:]
+		with self.lock:
+			if command == b"tget":
+				return self.tget(args[0])
+			elif command == b"add":
+				return self.add(args[0])
+			elif command in [b"start", b"stop", b"del"]:
+				torrent = self._find(args[0])
+				if not torrent:
+					return {"code": 8}
+				if command == b"del":
+					del self.torrents[torrent.num]
+				else:
+					torrent.state = 3 if command == b"start" else 0
+				return {"code": Btpd.IPC_OK}
+			elif command in [b"start-all", b"stop-all"]:
+				for torrent in self.torrents.values():
+					torrent.state = 3 if command == b"start-all" else 0
+				return {"code": Btpd.IPC_OK}
+			elif command == b"die":
+				threading.Thread(target=self.server.shutdown).start()
+				return {"code": Btpd.IPC_OK}
+		return {"code": Btpd.IPC_COMMERR}
+	def tget(self, args):
+		spec = args[b"from"]
+		if isinstance(spec, list):
+			torrents = [self._find(item) for item in spec]
+		else:
+			if self.delay and spec == Btpd.TWC_ALL:
+				time.sleep(self.delay)
+			if self.churn and spec == Btpd.TWC_ALL:
+				self.tick()
+			torrents = [torrent for torrent in sorted(
+				self.torrents.values(), key=lambda t: t.num) if (
+				spec == Btpd.TWC_ALL or (spec == Btpd.TWC_ACTIVE
+				) == bool(torrent.state))]
+		result = []
+		for torrent in torrents:
+			if not torrent:
+				result.append(8)
+				continue
+			values = []
+			for key in args[b"keys"]:
+				values.extend(torrent.value(key))
+			result.append(values)
+		return {"code": Btpd.IPC_OK, "result": result}
+	def add(self, args):
+		metainfo = Bencode.decode(args[b"torrent"])
+		info_hash = hashlib.sha1(Bencode.encode(metainfo[b"info"])
+			).digest()
+		for torrent in self.torrents.values():
+			if torrent.info_hash == info_hash:
+				return {"code": 11}
+		info = metainfo[b"info"]
+		size = info.get(b"length") or sum(file[b"length"
+			] for file in info.get(b"files", []))
+		name = args.get(b"name", info.get(b"name", b""))
+		num = self.next_num
+		self.next_num += 1
+		# btpd keeps a copy of the metainfo, which /view reads
+		directory = os.path.join(self.btpd_dir, "torrents",
+			info_hash.hex())
+		os.makedirs(directory, exist_ok=True)
+		with open(os.path.join(directory, "torrent"), "wb") as file:
+			file.write(args[b"torrent"])
+		self.torrents[num] = Torrent(num, name.decode("utf8",
+			"replace"), info_hash, args[b"content"].decode("utf8"),
+			size, len(info.get(b"pieces", b""))//20)
+		return {"code": Btpd.IPC_OK, "num": num}
+
+	def serve_forever(self):
+		fake = self
+		class Handler(socketserver.BaseRequestHandler):
+			def handle(self):
+				while True:
+					header = self.request.recv(Btpd.LENGTH.size,
+						socket.MSG_WAITALL)
+					if not len(header) == Btpd.LENGTH.size:
+						return
+					size, = Btpd.LENGTH.unpack(header)
+					data = self.request.recv(size,
+						socket.MSG_WAITALL)
+					try:
+						response = fake.handle(Bencode.decode(data))
+					except (Bencode.BencodeError, IndexError,
+							KeyError, TypeError):
+						response = {"code": Btpd.IPC_COMMERR}
+					response = Bencode.encode(response)
+					self.request.sendall(Btpd.LENGTH.pack(len(
+						response))+response)
+		path = os.path.join(self.btpd_dir, "sock")
+		if os.path.exists(path):
+			os.remove(path)
+		self.server = socketserver.ThreadingUnixStreamServer(path,
+			Handler)
+		self.server.daemon_threads = True
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			os.remove(path)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=
+		"Serve a fake btpd control socket")
+	parser.add_argument("btpd_dir")
+	parser.add_argument("--torrents", type=int, default=0,
+		help="number of synthetic torrents to start with")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--churn", type=float, default=0.0,
+		help="fraction of torrents that change between lists")
+	parser.add_argument("--delay", type=float, default=0.0,
+		help="seconds to take over listing every torrent")
+	args = parser.parse_args()
+	os.makedirs(args.btpd_dir, exist_ok=True)
+	fake = FakeBtpd(args.btpd_dir, args.churn, args.delay)
+	fake.populate(args.torrents, args.seed)
+	fake.serve_forever()
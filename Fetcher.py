@@ -0,0 +1,166 @@
+import collections, itertools, threading, time, urllib.parse, urllib.request
+
+QUEUED = "queued"
+FETCHING = "fetching"
+DONE = "done"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+USER_AGENT = "btpd-web"
+READ_SIZE = 1 << 16
+
+class Full(Exception):
+	pass
+
+def check_url(url):
+	if not urllib.parse.urlsplit(url).scheme in ["http", "https"]:
+		raise ValueError("only http and https urls are supported")
+
+class Job(object):
+	def __init__(self, id, url, username, directory, idle):
+		self.id = id
+		self.url = url
+		self.host = urllib.parse.urlsplit(url).hostname or ""
+		self.username = username
+		self.directory = directory
+		self.idle = idle
+		self.state = QUEUED
+		self.error = None
+		self.info_hash = None
+		self.created = time.time()
+		self.finished = None
+
+class Fetcher(object):
+	# fetches .torrent urls on a few worker threads, never more than
+	# `per_host` at a time from any one host, and hands the data to
+	# `add` unless `identify` says we already have (or are already
+	# adding) that info_hash.
+	def __init__(self, identify, exists, add, workers=4, queue=64,
+			per_host=2, timeout=30, max_size=10 << 20, history=200):
+		self.identify = identify
+		self.exists = exists
+		self.add = add
+		self.queue = queue
+		self.per_host = per_host
+		self.timeout = timeout
+		self.max_size = max_size
+		self.condition = threading.Condition()
+		self.pending = collections.deque()
+		self.active_hosts = collections.Counter()
+		self.adding = set()
+		self.jobs = collections.OrderedDict()
+		self.history = history
+		self.ids = itertools.count(1)
+		for _ in range(workers):
+			thread = threading.Thread(target=self.work)
+			thread.daemon = True
+			thread.start()
+
+	def submit(self, url, username, directory, idle=False):
+		return self.submit_many([url], username, directory, idle)[0]
+	def submit_many(self, urls, username, directory, idle=False):
+		# a job for each url, all queued or (when there isn't room for
+		# every one of them) none. a url that's already queued or being
+		# fetched gets the job it already has.
+		for url in urls:
+			check_url(url)
+		with self.condition:
+			active = {job.url: job for job in self.jobs.values() if
+				job.state in [QUEUED, FETCHING]}
+			new = [url for url in dict.fromkeys(urls) if not url in
+				active]
+			if len(self.pending)+len(new) > self.queue:
+				raise Full()
+			for url in new:
+				job = Job(next(self.ids), url, username, directory, idle)
+				self.jobs[job.id] = job
+				self.pending.append(job)
+				active[url] = job
+			self._forget()
+			self.condition.notify(len(new))
+		return [active[url] for url in urls]
+	def _forget(self):
+		finished = [id for id, job in self.jobs.items() if job.finished]
+		for id in finished[:max(len(self.jobs)-self.history, 0)]:
+			del self.jobs[id]
+	def list_jobs(self, username=None):
+		with self.condition:
+			return [job for job in reversed(self.jobs.values()) if
+				username is None or job.username == username]
+
+	def _next(self):
+		with self.condition:
+			while True:
+				for job in self.pending:
+					if self.active_hosts[job.host] < self.per_host:
+						self.pending.remove(job)
+						self.active_hosts[job.host] += 1
+						job.state = FETCHING
+						return job
+				self.condition.wait()
+	def fetch(self, url):
+		# urlopen's timeout is for each socket operation, which a server
+		# sending a byte at a time never runs into, so the whole fetch
+		# has a deadline too
+		deadline = time.monotonic()+self.timeout
+		request = urllib.request.Request(url, headers={
+			"User-Agent": USER_AGENT})
+		chunks = []
+		size = 0
+		with urllib.request.urlopen(request, timeout=self.timeout
+				) as response:
+			while size <= self.max_size:
+				if time.monotonic() > deadline:
+					raise TimeoutError("timed out after %ss" % self.timeout)
+				chunk = response.read1(min(READ_SIZE, self.max_size+1-size))
+				if not chunk:
+					break
+				chunks.append(chunk)
+				size += len(chunk)
+		if size > self.max_size:
+			raise ValueError("torrent file too large")
+		return b"".join(chunks)
+	def _finish(self, job, state, error=None):
+		with self.condition:
+			job.state = state
+			job.error = error
+			job.finished = time.time()
+	def work(self):
+		while True:
+			job = self._next()
+			try:
+				data = self.fetch(job.url)
+			except Exception as e:
+				data = None
+				error = str(e)
+			with self.condition:
+				self.active_hosts[job.host] -= 1
+				if self.active_hosts[job.host] <= 0:
+					del self.active_hosts[job.host]
+				self.condition.notify_all()
+			if data is None:
+				self._finish(job, FAILED, error)
+				continue
+
+			try:
+				job.info_hash = self.identify(data)
+			except Exception as e:
+				self._finish(job, FAILED, str(e))
+				continue
+			with self.condition:
+				duplicate = job.info_hash in self.adding
+				self.adding.add(job.info_hash)
+			if duplicate:
+				self._finish(job, DUPLICATE)
+				continue
+			try:
+				if self.exists(job.info_hash):
+					self._finish(job, DUPLICATE)
+				else:
+					self.add(job, data)
+					self._finish(job, DONE)
+			except Exception as e:
+				self._finish(job, FAILED, str(e))
+			finally:
+				with self.condition:
+					self.adding.discard(job.info_hash)
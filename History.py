@@ -0,0 +1,210 @@
+import array, threading, time
+
+FIELDS = ["upload_rate", "download_rate", "peers", "uploaded",
+	"downloaded"]
+# rates and peers are averaged over a bucket; the uploaded and
+# downloaded totals are kept as they were at its end, and need 64 bits.
+TYPECODES = {"upload_rate": "I", "download_rate": "I", "peers": "I",
+	"uploaded": "Q", "downloaded": "Q"}
+TOTALS = set(["uploaded", "downloaded"])
+# (seconds per bucket, buckets kept): an hour by the minute, a day by
+# the hour and a month by the day.
+TIERS = [(60, 60), (3600, 24), (86400, 30)]
+TIER_NAMES = ["hour", "day", "month"]
+SPARKS = "▁▂▃▄▅▆▇█"
+MAX_VALUES = {"I": 0xFFFFFFFF, "Q": 0xFFFFFFFFFFFFFFFF}
+NEVER = -1 << 62
+
+def zeros(typecode, length):
+	return array.array(typecode, bytes(array.array(typecode).itemsize
+		*length))
+
+def sparkline(values):
+	known = [value for value in values if value is not None]
+	top = max(known) if known else 0
+	return "".join(" " if value is None else SPARKS[(value*(len(SPARKS
+		)-1)//top) if top else 0] for value in values)
+
+class Tier(object):
+	def __init__(self, step, slots):
+		self.step = step
+		self.slots = slots
+		# row-major, `slots` values per row, one array per field
+		self.values = {field: zeros(TYPECODES[field], 0) for field in
+			FIELDS}
+		# the bucket in progress, one entry per row: sums of averaged
+		# fields and the latest of totals
+		self.sums = {field: zeros(TYPECODES[field] if field in TOTALS
+			else "d", 0) for field in FIELDS}
+		self.counts = zeros("I", 0)
+		# which bucket each slot currently holds, shared by every row
+		self.buckets = array.array("q", [NEVER]*slots)
+		self.bucket = None
+		# the first bucket each row holds, as rows are reused for other
+		# torrents and what's before it belonged to the last one
+		self.starts = array.array("q")
+	def grow(self, rows):
+		for field in FIELDS:
+			self.values[field].extend(zeros(TYPECODES[field],
+				rows*self.slots))
+			self.sums[field].extend(zeros(self.sums[field].typecode,
+				rows))
+		self.counts.extend(zeros("I", rows))
+		self.starts.extend(array.array("q", [NEVER]*rows))
+	def clear(self, row):
+		start = row*self.slots
+		for field in FIELDS:
+			self.values[field][start:start+self.slots] = zeros(
+				TYPECODES[field], self.slots)
+			self.sums[field][row] = 0
+		self.counts[row] = 0
+		self.starts[row] = NEVER if self.bucket is None else self.bucket
+
+class History(object):
+	# rolling rate/peer history for every torrent (and, under the key
+	# None, everything together) in preallocated arrays. memory is
+	# fixed per tracked torrent and capped at `max_rows` torrents;
+	# rows of torrents that go away are reused. the None row is always
+	# there.
+	def __init__(self, tiers=TIERS, max_rows=10000, grow_by=256, epoch=0):
+		self.tiers = [Tier(step, slots) for step, slots in tiers]
+		self.max_rows = max_rows
+		self.grow_by = grow_by
+		self.rows = {}
+		self.free = []
+		self.size = 0
+		# moves on whenever a bucket is completed, counting from 0 again
+		# in each epoch
+		self.epoch = epoch
+		self.version = 0
+		self.lock = threading.Lock()
+		self._allocate(None)
+
+	def memory(self):
+		with self.lock:
+			return sum(sum(array.itemsize*len(array) for array in list(
+				tier.values.values())+list(tier.sums.values())+[
+				tier.counts, tier.buckets]) for tier in self.tiers)
+	def _allocate(self, key):
+		if self.free:
+			row = self.free.pop()
+		elif self.size <= self.max_rows:
+			row = self.size
+			self.size += 1
+			if row >= len(self.tiers[0].counts):
+				grow = min(self.grow_by, self.max_rows+1-row)
+				for tier in self.tiers:
+					tier.grow(grow)
+		else:
+			return None
+		for tier in self.tiers:
+			tier.clear(row)
+		self.rows[key] = row
+		return row
+	def _roll(self, index, now):
+		tier = self.tiers[index]
+		bucket = int(now//tier.step)
+		if tier.bucket is None:
+			tier.bucket = bucket
+		if bucket == tier.bucket:
+			return
+		slot = tier.bucket%tier.slots
+		tier.buckets[slot] = tier.bucket
+		following = self.tiers[index+1] if index+1 < len(self.tiers
+			) else None
+		for row in range(len(tier.counts)):
+			count = tier.counts[row]
+			for field in FIELDS:
+				if field in TOTALS:
+					value = tier.sums[field][row]
+					if following and count:
+						following.sums[field][row] = value
+				else:
+					value = int(tier.sums[field][row]/count) if count else 0
+					tier.sums[field][row] = 0
+					if following and count:
+						following.sums[field][row] += value
+				tier.values[field][row*tier.slots+slot] = value
+			if following and count:
+				following.counts[row] += 1
+			tier.counts[row] = 0
+		tier.bucket = bucket
+		self.version += 1
+		if following:
+			self._roll(index+1, now)
+	def record(self, samples, now=None):
+		# samples is key -> (upload rate, download rate, peers,
+		# uploaded, downloaded)
+		now = time.time() if now is None else now
+		with self.lock:
+			for key in list(self.rows):
+				if not key is None and not key in samples:
+					self.free.append(self.rows.pop(key))
+			self._roll(0, now)
+			tier = self.tiers[0]
+			for key, values in samples.items():
+				row = self.rows.get(key)
+				if row is None:
+					row = self._allocate(key)
+					if row is None:
+						continue
+				for field, value in zip(FIELDS, values):
+					value = min(max(value, 0), MAX_VALUES[TYPECODES[field]])
+					if field in TOTALS:
+						tier.sums[field][row] = value
+					else:
+						tier.sums[field][row] += value
+				tier.counts[row] += 1
+
+	def dump(self):
+		# the completed buckets as plain data, enough for load() to
+		# answer series() elsewhere
+		with self.lock:
+			return {"epoch": self.epoch, "version": self.version,
+				"rows": self.rows,
+				"tiers": [(tier.bucket, tier.buckets.tobytes(), {field:
+				tier.values[field].tobytes() for field in FIELDS},
+				tier.starts.tobytes()) for tier in self.tiers]}
+	def load(self, state):
+		with self.lock:
+			self.epoch = state["epoch"]
+			self.version = state["version"]
+			self.rows = dict(state["rows"])
+			self.size = max(self.rows.values(), default=-1)+1
+			for tier, (bucket, buckets, values, starts) in zip(
+					self.tiers, state["tiers"]):
+				tier.bucket = bucket
+				tier.buckets = array.array("q")
+				tier.buckets.frombytes(buckets)
+				tier.starts = array.array("q")
+				tier.starts.frombytes(starts)
+				for field in FIELDS:
+					tier.values[field] = array.array(TYPECODES[field])
+					tier.values[field].frombytes(values[field])
+
+	def series(self, key):
+		# completed buckets, oldest first, for every tier; None where
+		# nothing was recorded for this key.
+		with self.lock:
+			row = self.rows.get(key)
+			if row is None:
+				return None
+			series = []
+			for name, tier in zip(TIER_NAMES, self.tiers):
+				current = tier.bucket or 0
+				buckets = range(current-tier.slots, current)
+				start = tier.starts[row]
+				values = {}
+				for field in FIELDS:
+					values[field] = [tier.values[field][row*tier.slots+(
+						bucket%tier.slots)] if tier.buckets[bucket%
+						tier.slots] == bucket and bucket >= start else None
+						for bucket in buckets]
+				series.append({"name": name, "step": tier.step,
+					"start": buckets.start*tier.step, "values": values})
+			return series
+	def sparklines(self, key):
+		series = self.series(key) or []
+		return [{"name": tier["name"], "lines": {field: sparkline(
+			tier["values"][field]) for field in FIELDS}}
+			for tier in series]
@@ -0,0 +1,101 @@
+import collections, concurrent.futures, threading, time
+
+class Busy(Exception):
+	pass
+class Throttled(Exception):
+	pass
+
+class Throttle(object):
+	# recent failed logins by username and by address. a worker serving
+	# alongside others keeps these in the poller, see
+	# Shared.RemoteThrottle.
+	def __init__(self, attempts=5, window=300, max_tracked=10000):
+		self.attempts = attempts
+		self.window = window
+		self.max_tracked = max_tracked
+		self.failures = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def _keys(self, username, address):
+		return ["user:%s" % username.lower(), "address:%s" % address]
+	def _recent(self, key, now):
+		failures = self.failures.get(key)
+		while failures and failures[0] < now-self.window:
+			failures.popleft()
+		if not failures:
+			self.failures.pop(key, None)
+			return 0
+		return len(failures)
+	def throttled(self, username, address):
+		now = time.monotonic()
+		with self.lock:
+			return any(self._recent(key, now) >= self.attempts
+				for key in self._keys(username, address))
+	def attempt(self, username, address):
+		# checks for throttling and counts the attempt as a failure
+		# under the one lock, so concurrent attempts can't all get past
+		# the check before any of them have failed. it's taken back off
+		# by withdraw() if it turns out not to be one.
+		now = time.monotonic()
+		keys = self._keys(username, address)
+		with self.lock:
+			if any(self._recent(key, now) >= self.attempts for key in keys):
+				raise Throttled()
+			for key in keys:
+				failures = self.failures.setdefault(key,
+					collections.deque(maxlen=self.attempts))
+				failures.append(now)
+				self.failures.move_to_end(key)
+			while len(self.failures) > self.max_tracked:
+				self.failures.popitem(last=False)
+		return now
+	def withdraw(self, username, address, attempt, keys=None):
+		with self.lock:
+			for key in keys or self._keys(username, address):
+				failures = self.failures.get(key)
+				if failures and attempt in failures:
+					failures.remove(attempt)
+					if not failures:
+						self.failures.pop(key)
+	def succeeded(self, username, address, attempt):
+		keys = self._keys(username, address)
+		with self.lock:
+			self.failures.pop(keys[0], None)
+		self.withdraw(username, address, attempt, keys[1:])
+
+class Login(object):
+	# password checks are scrypt, which is deliberately expensive, so
+	# they run on a small pool of their own with a cap on how many can
+	# be waiting, and repeated failures for a username or address are
+	# refused before any hashing happens.
+	def __init__(self, database, workers=2, queue=8, attempts=5,
+			window=300, max_tracked=10000, throttle=None):
+		self.database = database
+		self.pool = concurrent.futures.ThreadPoolExecutor(
+			max_workers=workers, thread_name_prefix="login")
+		self.slots = threading.BoundedSemaphore(workers+queue)
+		self.throttle = throttle or Throttle(attempts, window,
+			max_tracked)
+
+	def authenticate(self, username, password, address, timeout=30):
+		attempt = self.throttle.attempt(username, address)
+		if not self.slots.acquire(blocking=False):
+			self.throttle.withdraw(username, address, attempt)
+			raise Busy()
+		try:
+			future = self.pool.submit(self.database.authenticate,
+				username, password)
+		except:
+			self.slots.release()
+			self.throttle.withdraw(username, address, attempt)
+			raise
+		future.add_done_callback(lambda future: self.slots.release())
+		try:
+			authenticated = future.result(timeout)
+		except concurrent.futures.TimeoutError:
+			# still counted as a failure, we don't know it wasn't one
+			raise Busy()
+		if authenticated:
+			self.throttle.succeeded(username, address, attempt)
+			return True
+		return False
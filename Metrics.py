@@ -0,0 +1,121 @@
+import bisect, contextlib, threading, time
+
+SECONDS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+	0.25, 0.5, 1, 2.5, 5, 10, 30]
+COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100]
+
+NULL_TIMER = contextlib.nullcontext()
+
+def format_labels(labels, extra=()):
+	labels = list(labels)+list(extra)
+	if not labels:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace(
+		"\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+		for name, value in labels)
+def format_number(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Timer(object):
+	__slots__ = ["metrics", "name", "labels", "start"]
+	def __init__(self, metrics, name, labels):
+		self.metrics = metrics
+		self.name = name
+		self.labels = labels
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+	def __exit__(self, *exc_info):
+		self.metrics.observe(self.name, self.labels,
+			time.perf_counter()-self.start)
+
+class Metrics(object):
+	# histograms and counters keyed by (name, ((label, value), ...)),
+	# rendered in prometheus' text format. with enabled False nothing
+	# is recorded and timer() hands out a shared do-nothing context,
+	# so instrumented code costs next to nothing.
+	def __init__(self, enabled=False):
+		self.enabled = enabled
+		self.lock = threading.Lock()
+		self.histograms = {}
+		self.counters = {}
+		self.help = {}
+		self.local = threading.local()
+	def describe(self, name, text):
+		self.help[name] = text
+
+	def observe(self, name, labels, value, buckets=SECONDS_BUCKETS):
+		key = (name, labels)
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = [buckets, [0]*(len(
+					buckets)+1), 0, 0]
+			histogram[1][bisect.bisect_left(buckets, value)] += 1
+			histogram[2] += value
+			histogram[3] += 1
+	def count(self, name, labels, value=1):
+		key = (name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0)+value
+	def timer(self, name, **labels):
+		if not self.enabled:
+			return NULL_TIMER
+		return Timer(self, name, tuple(sorted(labels.items())))
+
+	def query(self, frame, statement, seconds):
+		# a Database observer
+		self.observe("btpdweb_db_query_seconds", (("method",
+			frame.f_code.co_name),), seconds)
+		self.local.queries = self.queries()+1
+	def queries(self):
+		return getattr(self.local, "queries", 0)
+	def reset_queries(self):
+		self.local.queries = 0
+
+	def dump(self):
+		with self.lock:
+			return {"histograms": {key: (list(buckets), list(counts), sum,
+				count) for key, (buckets, counts, sum, count) in
+				self.histograms.items()}, "counters": dict(self.counters),
+				"help": dict(self.help)}
+	def render(self, processes={}, process=None):
+		# processes is name -> dump() from other processes, shown
+		# alongside ours (called `process`) with a process label
+		dumps = [(process, self.dump())]+sorted(processes.items())
+		families = {}
+		help = {}
+		for process, dump in dumps:
+			extra = () if process is None else (("process", process),)
+			help.update(dump["help"])
+			for (name, labels), value in dump["histograms"].items():
+				families.setdefault((name, "histogram"), []).append((
+					tuple(labels), extra, value))
+			for (name, labels), value in dump["counters"].items():
+				families.setdefault((name, "counter"), []).append((
+					tuple(labels), extra, value))
+		lines = []
+		for (name, kind), series in sorted(families.items()):
+			if name in help:
+				lines.append("# HELP %s %s" % (name, help[name]))
+			lines.append("# TYPE %s %s" % (name, kind))
+			for labels, extra, value in sorted(series):
+				if kind == "counter":
+					lines.append("%s%s %s" % (name, format_labels(labels,
+						extra), format_number(value)))
+					continue
+				buckets, counts, sum, count = value
+				cumulative = 0
+				for bound, bucket_count in zip(list(buckets)+[float(
+						"inf")], counts):
+					cumulative += bucket_count
+					lines.append("%s_bucket%s %d" % (name, format_labels(
+						labels, tuple(extra)+(("le", format_number(
+						bound)),)), cumulative))
+				lines.append("%s_sum%s %s" % (name, format_labels(labels,
+					extra), format_number(sum)))
+				lines.append("%s_count%s %d" % (name, format_labels(
+					labels, extra), count))
+		return "\n".join(lines)+"\n"
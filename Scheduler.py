@@ -0,0 +1,60 @@
+import threading, time
+
+class Scheduler(object):
+	# decides when the poller next lists btpd: slowly when nobody has
+	# been around for a while, quickly while something is
+	# transferring, and shortly after a refresh is asked for, with
+	# every request inside the debounce window served by one poll.
+	def __init__(self, interval=4, idle_interval=60, active_interval=2,
+			idle_after=120, debounce=0.5):
+		self.interval = interval
+		self.idle_interval = idle_interval
+		self.active_interval = active_interval
+		self.idle_after = idle_after
+		self.debounce = debounce
+		self.condition = threading.Condition()
+		self.last_poll = None
+		self.last_activity = time.monotonic()
+		self.transferring = False
+		self.refresh_at = None
+
+	def idle(self, now=None):
+		now = time.monotonic() if now is None else now
+		return now-self.last_activity > self.idle_after
+	def next_interval(self, now=None):
+		if self.idle(now):
+			return self.idle_interval
+		elif self.transferring:
+			return self.active_interval
+		return self.interval
+	def touch(self):
+		now = time.monotonic()
+		with self.condition:
+			was_idle = self.idle(now)
+			self.last_activity = now
+			if was_idle:
+				# someone's back, don't leave them looking at a
+				# list from the idle interval ago.
+				self.condition.notify()
+	def refresh(self):
+		with self.condition:
+			if self.refresh_at is None:
+				self.refresh_at = time.monotonic()+self.debounce
+				self.condition.notify()
+	def polled(self, transferring):
+		with self.condition:
+			self.last_poll = time.monotonic()
+			self.transferring = transferring
+	def wait(self):
+		with self.condition:
+			while True:
+				now = time.monotonic()
+				if self.last_poll is None:
+					break
+				due = self.last_poll+self.next_interval(now)
+				if self.refresh_at is not None:
+					due = min(due, self.refresh_at)
+				if now >= due:
+					break
+				self.condition.wait(due-now)
+			self.refresh_at = None
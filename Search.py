@@ -0,0 +1,67 @@
+import collections, threading
+
+RANGE_COLUMNS = ["size", "percent", "ratio"]
+
+def trigrams(text):
+	return set(text[i:i+3] for i in range(len(text)-2))
+
+class NameIndex(object):
+	# trigram -> ids of torrents whose name contains it. kept up to date
+	# from each snapshot's delta rather than rebuilt, and only ever
+	# used to narrow down candidates; callers still check the name.
+	def __init__(self):
+		self.names = {}
+		self.trigrams = collections.defaultdict(set)
+		self.lock = threading.Lock()
+	def _remove(self, id):
+		name = self.names.pop(id, None)
+		if name is None:
+			return
+		for trigram in trigrams(name):
+			ids = self.trigrams[trigram]
+			ids.discard(id)
+			if not ids:
+				del self.trigrams[trigram]
+	def update(self, changed, removed):
+		with self.lock:
+			for id in removed:
+				self._remove(id)
+			for id, name in changed:
+				if self.names.get(id) == name:
+					continue
+				self._remove(id)
+				self.names[id] = name
+				for trigram in trigrams(name):
+					self.trigrams[trigram].add(id)
+	def search(self, query):
+		# candidate ids for a (lowercase) query, or None when it's too
+		# short for the index to help and everything is a candidate.
+		words = [word for word in query.split() if len(word) >= 3]
+		if not words:
+			return None
+		with self.lock:
+			sets = [self.trigrams.get(trigram, set()) for word in words
+				for trigram in trigrams(word)]
+			sets.sort(key=len)
+			return set(sets[0]).intersection(*sets[1:])
+
+def make_filter(name=None, state=None, ranges={}):
+	# a predicate for torrents, or None when there's nothing to filter
+	words = name.lower().split() if name else []
+	ranges = {column: bounds for column, bounds in ranges.items()
+		if not bounds == (None, None)}
+	if not words and not state and not ranges:
+		return None
+	def predicate(torrent):
+		if state and not torrent["state"] == state:
+			return False
+		for word in words:
+			if not word in torrent["name"]:
+				return False
+		for column, (low, high) in ranges.items():
+			if not low is None and torrent[column] < low:
+				return False
+			if not high is None and torrent[column] > high:
+				return False
+		return True
+	return predicate
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# serves btpd-web from several processes: one polls btpd and shares each
+# snapshot under RUN_DIR, the rest accept connections from one shared
+# listening socket and answer requests from those snapshots.
+# > python3 Serve.py --workers 4
+# workers can be run under another WSGI server instead, with
+# BTPD_WEB_ROLE=worker in their environment and main:app as the
+# application, next to "python3 Serve.py --workers 0".
+
+import argparse, os, signal, socket, sys, time
+import flask, werkzeug.serving
+import Config, Utils
+
+def start(role, index, target, *args):
+	pid = os.fork()
+	if pid:
+		return pid
+	# children import main (and start its threads) after the fork
+	status = 1
+	try:
+		os.environ["BTPD_WEB_ROLE"] = role
+		# a restarted worker keeps its number (and so its metrics'
+		# process label)
+		if not index is None:
+			os.environ["BTPD_WEB_WORKER"] = str(index)
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		signal.signal(signal.SIGINT, signal.SIG_DFL)
+		target(*args)
+		status = 0
+	finally:
+		os._exit(status)
+
+def poller():
+	import main
+	main.serve_poller()
+def worker(listener, config):
+	import main
+	server = werkzeug.serving.make_server(config.get("BINDHOST",
+		"127.0.0.1"), config.get("PORT", 5000), main.app,
+		threaded=True, ssl_context=Utils.tls_context(config),
+		fd=listener.fileno())
+	server.serve_forever()
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description=
+		"Serve btpd-web with a poller and several worker processes")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(),
+		help="web worker processes, 0 for just the poller")
+	args = parser.parse_args()
+
+	config = flask.Config(os.getcwd())
+	config.from_object(Config)
+	run_dir = config.get("RUN_DIR", "btpd-web.run")
+	os.makedirs(run_dir, mode=0o700, exist_ok=True)
+	control = os.path.join(run_dir, "control")
+	if os.path.exists(control):
+		os.remove(control)
+
+	listener = None
+	if args.workers:
+		listener = socket.create_server((config.get("BINDHOST",
+			"127.0.0.1"), config.get("PORT", 5000)), backlog=128)
+		listener.set_inheritable(True)
+
+	children = {start("poller", None, poller): ("poller", None)}
+	# the poller sets the database up, let it finish before anything
+	# else opens it
+	while not os.path.exists(control):
+		time.sleep(0.1)
+	for index in range(args.workers):
+		children[start("worker", index, worker, listener, config)] = (
+			"worker", index)
+
+	def stop(signum, frame):
+		for pid in children:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except ProcessLookupError:
+				pass
+		sys.exit(0)
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGINT, stop)
+	while True:
+		pid, status = os.wait()
+		role, index = children.pop(pid)
+		print("%s %d exited (%d), restarting" % (role, pid, status))
+		time.sleep(1)
+		if role == "poller":
+			children[start(role, index, poller)] = (role, index)
+		else:
+			children[start(role, index, worker, listener, config)] = (
+				role, index)
@@ -0,0 +1,231 @@
+import itertools, marshal, mmap, os, socket, struct, threading, time, types
+import Btpd, Fetcher, Login, Snapshot
+
+# how the poller process hands its work to the web workers when serving
+# with several processes (see Serve.py): each snapshot is written to a
+# file under RUN_DIR that workers map and read, and workers send what
+# they need from the poller as datagrams on a unix socket. what has to
+# be the same for every worker (background fetches, failed logins) is
+# kept in the poller and asked for that way too.
+
+MAGIC = b"btpdweb2"
+# magic, epoch, version, length
+HEADER = struct.Struct("=8sQQQ")
+UPDATE_CHUNK = 1000
+MAX_MESSAGE = 1 << 20
+
+class SharedFile(object):
+	# one versioned value behind a header. a new version is written
+	# beside the old one and renamed over it, so a reader always maps
+	# a whole version and unmarshals it straight out of the mapping.
+	# versions count up within an epoch, which the writer changes when
+	# it starts counting again from scratch.
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.Lock()
+		self.written = -1
+		self.written_epoch = None
+		self.identity = None
+		self.epoch = None
+		self.version = None
+		self.value = None
+	def write(self, version, value, epoch=0):
+		data = marshal.dumps(value)
+		with self.lock:
+			if epoch == self.written_epoch and version <= self.written:
+				return
+			temporary = "%s.%d.tmp" % (self.path, os.getpid())
+			fd = os.open(temporary, os.O_WRONLY|os.O_CREAT|os.O_TRUNC,
+				0o600)
+			with open(fd, "wb") as file:
+				file.write(HEADER.pack(MAGIC, epoch, version, len(data)))
+				file.write(data)
+			os.replace(temporary, self.path)
+			self.written = version
+			self.written_epoch = epoch
+	def read(self):
+		# (epoch, version, value), all None before anything's written
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			return None, None, None
+		identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+		with self.lock:
+			if identity == self.identity:
+				return self.epoch, self.version, self.value
+			with open(self.path, "rb") as file:
+				with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ
+						) as mapped:
+					magic, epoch, version, length = HEADER.unpack_from(
+						mapped)
+					if not magic == MAGIC:
+						raise ValueError("%s isn't a shared file" %
+							self.path)
+					with memoryview(mapped)[HEADER.size:HEADER.size+length
+							] as data:
+						value = marshal.loads(data)
+			self.identity = identity
+			self.epoch = epoch
+			self.version = version
+			self.value = value
+			return epoch, version, value
+
+class Control(object):
+	# messages from the web workers to the poller: ("touch",),
+	# ("refresh",) and ("update", {id: fields or None}), and those
+	# answered with call(): ("fetch", urls, username, directory, idle),
+	# ("jobs", username) and ("login", method, username, address, ...)
+	def __init__(self, path):
+		self.path = path
+		self.socket = None
+		self.lock = threading.Lock()
+		self.calls = itertools.count()
+	def send(self, *message):
+		with self.lock:
+			if self.socket is None:
+				self.socket = socket.socket(socket.AF_UNIX,
+					socket.SOCK_DGRAM)
+			try:
+				self.socket.sendto(marshal.dumps(message), self.path)
+			except OSError:
+				# the poller's being restarted, it'll catch up
+				pass
+	def call(self, *message, timeout=5):
+		# sends from a socket of its own, bound for the answer to come
+		# back to. OSError when there's none, as while the poller's
+		# being restarted.
+		path = "%s.%d.%d" % (self.path, os.getpid(), next(self.calls))
+		reply = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		try:
+			reply.bind(path)
+			reply.settimeout(timeout)
+			reply.sendto(marshal.dumps(message), self.path)
+			error, result = marshal.loads(reply.recv(MAX_MESSAGE))
+		finally:
+			reply.close()
+			if os.path.exists(path):
+				os.remove(path)
+		if error:
+			raise OSError(error)
+		return result
+	def serve(self, handle):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+		server.bind(self.path)
+		while True:
+			data, address = server.recvfrom(MAX_MESSAGE)
+			try:
+				message = marshal.loads(data)
+				answer = (None, handle(*message))
+			except Exception as e:
+				print("bad control message: %s" % e)
+				answer = (str(e) or type(e).__name__, None)
+			if address:
+				try:
+					server.sendto(marshal.dumps(answer), address)
+				except OSError:
+					# whoever asked has given up waiting
+					pass
+
+class RemoteScheduler(object):
+	# stands in for Scheduler.Scheduler in a web worker
+	def __init__(self, control, touch_every=1):
+		self.control = control
+		self.touch_every = touch_every
+		self.last_touch = None
+	def touch(self):
+		now = time.monotonic()
+		if self.last_touch is None or now-self.last_touch >= (
+				self.touch_every):
+			self.last_touch = now
+			self.control.send("touch")
+	def refresh(self):
+		self.control.send("refresh")
+
+class RemoteFetcher(object):
+	# stands in for Fetcher.Fetcher in a web worker. the poller fetches
+	# for every worker, so there's one queue and one set of jobs.
+	def __init__(self, control):
+		self.control = control
+	def submit_many(self, urls, username, directory, idle=False):
+		for url in urls:
+			Fetcher.check_url(url)
+		try:
+			ids = self.control.call("fetch", urls, username, directory,
+				idle)
+		except OSError:
+			ids = None
+		if ids is None:
+			raise Fetcher.Full()
+		return ids
+	def list_jobs(self, username=None):
+		try:
+			jobs = self.control.call("jobs", username)
+		except OSError:
+			return []
+		return [types.SimpleNamespace(**job) for job in jobs]
+
+class RemoteThrottle(object):
+	# stands in for Login.Throttle in a web worker, so failed logins
+	# count against the same limit whichever worker they're made on
+	def __init__(self, control):
+		self.control = control
+	def attempt(self, username, address):
+		try:
+			attempt = self.control.call("login", "attempt", username,
+				address)
+		except OSError:
+			raise Login.Busy()
+		if attempt is None:
+			raise Login.Throttled()
+		return attempt
+	def withdraw(self, username, address, attempt):
+		self.control.send("login", "withdraw", username, address,
+			attempt)
+	def succeeded(self, username, address, attempt):
+		self.control.send("login", "succeeded", username, address,
+			attempt)
+
+class FollowingPublisher(Snapshot.Publisher):
+	# a web worker's copy of the poller's snapshots, with the poller's
+	# epoch and version numbers. the poller shares the orders and stats
+	# it worked out along with the torrents, so they aren't sorted all
+	# over again in every worker. changes are sent to the poller to
+	# publish for everyone and we wait a moment for them to come back,
+	# so whoever made them sees them.
+	def __init__(self, columns, shared, control, history=32,
+			update_timeout=1):
+		Snapshot.Publisher.__init__(self, columns, history)
+		self.shared = shared
+		self.control = control
+		self.update_timeout = update_timeout
+		self.followed = (None, -1)
+		self.follow_lock = threading.Lock()
+	def follow(self):
+		with self.follow_lock:
+			epoch, version, shared = self.shared.read()
+			if version is None or (epoch == self.followed[0] and
+					version <= self.followed[1]):
+				return False
+			self.followed = (epoch, version)
+			# torrents that haven't changed keep their objects, which
+			# makes them quick to tell apart from those that have
+			previous = self.current.torrents
+			torrents = {}
+			for values in shared["torrents"]:
+				torrent = previous.get(values[0])
+				if torrent is None or not torrent.pack() == values:
+					torrent = Btpd.Torrent.unpack(values)
+				torrents[values[0]] = torrent
+			self.publish(torrents, version, epoch, shared["derived"])
+			return True
+	def update(self, changes):
+		changes = list(changes.items())
+		for start in range(0, len(changes), UPDATE_CHUNK):
+			self.control.send("update", dict(changes[
+				start:start+UPDATE_CHUNK]))
+		deadline = time.monotonic()+self.update_timeout
+		while not self.follow() and time.monotonic() < deadline:
+			time.sleep(0.02)
+		return self.current
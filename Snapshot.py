@@ -0,0 +1,310 @@
+import collections, threading, time, types
+import Btpd, Search
+
+def add_stats(stats, torrent, sign=1):
+	stats["count"] += sign
+	stats["size"] += sign*torrent.size
+	stats["upload_rate"] += sign*torrent.upload_rate
+	stats["download_rate"] += sign*torrent.download_rate
+	stats["uploaded"] += sign*torrent.uploaded_bytes
+	stats["downloaded"] += sign*torrent.downloaded_bytes
+def finish_stats(stats):
+	stats["ratio"] = Btpd.ratio(stats["uploaded"], stats["size"])
+	stats["pretty_ratio"] = "%.2f" % stats["ratio"]
+	for key in ["size", "upload_rate", "download_rate", "uploaded",
+			"downloaded"]:
+		stats["pretty_%s" % key] = Btpd.pretty_size(stats[key])
+	return types.MappingProxyType(stats)
+def make_stats(torrents):
+	stats = {"count": 0, "size": 0, "upload_rate": 0, "download_rate": 0,
+		"uploaded": 0, "downloaded": 0}
+	for torrent in torrents:
+		add_stats(stats, torrent)
+	return finish_stats(stats)
+
+def sort_key(torrents, column):
+	def key(id):
+		value = torrents[id][column]
+		return ("" if value is None else value, id)
+	return key
+
+class Snapshot(object):
+	# a read-only view of one poll of btpd. snapshots are never
+	# modified once built, so handlers can hold on to one without
+	# locking or copying while the poller publishes the next.
+	def __init__(self, version, torrents, columns=[], epoch=0,
+			derived=None, previous=None, changed=None, removed=None):
+		self.version = version
+		# versions only count up within one epoch, which changes when
+		# the poller is restarted
+		self.epoch = epoch
+		self.created = time.time()
+		# the Btpd.Torrent records are shared with the snapshots either
+		# side of this one, which is fine as nothing changes them.
+		self.torrents = types.MappingProxyType(dict(torrents))
+		self.columns = list(columns)
+		# ascending orderings (ties broken by id) by (owner, column),
+		# with None for everyone's. descending is the same sequence
+		# read from the other end. only the first column's is sorted
+		# up front, the rest when they're first asked for.
+		self.orders = {}
+		self.sorting = threading.Lock()
+		if derived:
+			# worked out already by whoever published these torrents
+			# first, see derived()
+			orders, self.owners, stats = derived
+			self.orders = dict(orders)
+			self.stats = {owner: types.MappingProxyType(values)
+				for owner, values in stats.items()}
+			return
+
+		# when only some torrents have changed since `previous` (id ->
+		# torrent, and id -> owner for those removed) it's patched
+		# rather than worked out again
+		if previous is None or len(changed)+len(removed) > len(
+				self.torrents)//2:
+			self._build()
+		else:
+			self._patch(previous, changed, removed)
+		if self.columns:
+			self.order(self.columns[0])
+	def _build(self):
+		self.owners = {}
+		for id, torrent in self.torrents.items():
+			self.owners.setdefault(torrent["owner"], []).append(id)
+		# per-owner and overall totals, with None for overall
+		self.stats = {owner: make_stats(self.torrents[id] for id in ids
+			) for owner, ids in self.owners.items()}
+		self.stats[None] = make_stats(self.torrents.values())
+	def _patch(self, previous, changed, removed):
+		old = previous.torrents
+		# columns whose order has changed, and owners who've gained or
+		# lost torrents
+		dirty = set()
+		moved = set(removed.values())
+		for id, torrent in changed.items():
+			before = old.get(id)
+			if before is None:
+				dirty.update(self.columns)
+				moved.add(torrent["owner"])
+				continue
+			if not before["owner"] == torrent["owner"]:
+				moved.update([before["owner"], torrent["owner"]])
+			for column in self.columns:
+				if not column in dirty and not before[column] == torrent[
+						column]:
+					dirty.add(column)
+
+		self.owners = previous.owners
+		if moved:
+			self.owners = dict(self.owners)
+			for owner in moved:
+				self.owners[owner] = [id for id, torrent in
+					self.torrents.items() if torrent["owner"] == owner]
+				if not self.owners[owner]:
+					del self.owners[owner]
+
+		stats = {}
+		def patch(owner, torrent, sign):
+			for key in [owner, None]:
+				if not key in stats:
+					stats[key] = dict(previous.stats.get(key) or
+						make_stats([]))
+				add_stats(stats[key], torrent, sign)
+		for id, torrent in changed.items():
+			if id in old:
+				patch(old[id]["owner"], old[id], -1)
+			patch(torrent["owner"], torrent, 1)
+		for id in removed:
+			patch(old[id]["owner"], old[id], -1)
+		self.stats = dict(previous.stats)
+		for owner, values in stats.items():
+			self.stats[owner] = finish_stats(values)
+			if values["count"] <= 0 and not owner is None:
+				del self.stats[owner]
+
+		# orders of columns nothing's moved in stay as they were, less
+		# any torrents that have gone
+		with previous.sorting:
+			orders = dict(previous.orders)
+		for (owner, column), order in orders.items():
+			if column in dirty or not (owner is None or owner in
+					self.owners):
+				continue
+			if owner is None and removed:
+				order = tuple(id for id in order if not id in removed)
+			elif owner in moved:
+				order = tuple(id for id in order if id in self.torrents
+					and self.torrents[id]["owner"] == owner)
+				# not when it's gained some, they'd need sorting in
+				if not len(order) == len(self.owners[owner]):
+					continue
+			self.orders[(owner, column)] = order
+	def derived(self):
+		# the orders, owners and stats as plain data, for building the
+		# same snapshot elsewhere without sorting again
+		with self.sorting:
+			orders = dict(self.orders)
+		return orders, self.owners, {owner: dict(values) for
+			owner, values in self.stats.items()}
+	def get(self, id):
+		return self.torrents.get(id)
+	def __contains__(self, id):
+		return id in self.torrents
+	def __len__(self):
+		return len(self.torrents)
+
+	def count(self, owner=None):
+		if owner is None:
+			return len(self.torrents)
+		return len(self.owners.get(owner, []))
+	def owner_stats(self, owner=None):
+		if not owner in self.stats:
+			return make_stats([])
+		return self.stats[owner]
+	def order(self, column, owner=None):
+		# the ascending order of `column`, sorted the first time
+		# anyone asks for it in this snapshot
+		order = self.orders.get((owner, column))
+		if not order is None:
+			return order
+		if not column in self.columns or not (owner is None or
+				owner in self.owners):
+			return ()
+		with self.sorting:
+			order = self.orders.get((owner, column))
+			if order is None:
+				ids = self.torrents if owner is None else self.owners[
+					owner]
+				if column == "id":
+					# what ties are broken by anyway
+					order = tuple(sorted(ids))
+				else:
+					order = tuple(sorted(ids, key=sort_key(self.torrents,
+						column)))
+				self.orders[(owner, column)] = order
+			return order
+	def ordered(self, column, descending=False, owner=None):
+		order = self.order(column, owner)
+		return order[::-1] if descending else order
+	def select(self, column, descending=False, owner=None, ids=None,
+			predicate=None):
+		# ids in the same order as ordered(), narrowed to `ids` (when
+		# given) and to whatever `predicate` accepts.
+		if ids is None:
+			ids = self.ordered(column, descending, owner)
+		else:
+			ids = sorted((id for id in ids if id in self.torrents and (
+				owner is None or self.torrents[id]["owner"] == owner)),
+				key=sort_key(self.torrents, column), reverse=descending)
+		if predicate:
+			ids = [id for id in ids if predicate(self.torrents[id])]
+		return ids
+	def page(self, column, descending, start, stop, owner=None):
+		# ordered()[start:stop], except that pages before the first
+		# are empty rather than counted back from the end
+		order = self.order(column, owner)
+		start, stop = max(start, 0), max(stop, 0)
+		if descending:
+			start, stop = len(order)-stop, len(order)-start
+			ids = order[max(start, 0):max(stop, 0)][::-1]
+		else:
+			ids = order[start:stop]
+		return [self.torrents[id] for id in ids]
+
+class Delta(object):
+	def __init__(self, version, changed, removed):
+		self.version = version
+		self.changed = changed
+		self.removed = removed
+	def visible(self, owner=None):
+		# owner None means everything, as with Snapshot.page
+		changed = [torrent for torrent in self.changed.values(
+			) if owner is None or torrent["owner"] == owner]
+		removed = [id for id, torrent_owner in self.removed.items(
+			) if owner is None or torrent_owner == owner]
+		return changed, removed
+
+class Publisher(object):
+	def __init__(self, columns=[], history=32, epoch=None):
+		self.columns = list(columns)
+		# tells this publisher's versions apart from those of one
+		# before it (a restarted poller counting from 0 again)
+		self.epoch = time.time_ns() if epoch is None else epoch
+		self.current = Snapshot(0, {}, self.columns, self.epoch)
+		self.lock = threading.Lock()
+		self.deltas = collections.deque(maxlen=history)
+		self.names = Search.NameIndex()
+		self.condition = threading.Condition(self.lock)
+	def publish(self, torrents, version=None, epoch=None, derived=None):
+		# `version` and `epoch` are for following another publisher's
+		# numbering; within an epoch versions have to be ahead of
+		# ours, and a new epoch starts everything over.
+		with self.lock:
+			if not epoch is None and not epoch == self.epoch:
+				self.epoch = epoch
+				self.current = Snapshot(0, {}, self.columns, epoch)
+				self.deltas.clear()
+				self.names = Search.NameIndex()
+			return self._publish(torrents, version, derived)
+	def update(self, changes):
+		# publish what we already know a command did (id -> changed
+		# fields, or None when removed) without waiting for a poll;
+		# the next poll replaces it with what btpd says.
+		with self.lock:
+			torrents = dict(self.current.torrents)
+			for id, fields in changes.items():
+				if fields is None:
+					torrents.pop(id, None)
+				elif id in torrents:
+					torrents[id] = torrents[id].replace(**fields)
+			return self._publish(torrents, ids=changes)
+	def _publish(self, torrents, version=None, derived=None, ids=None):
+		# `ids` are the only torrents that can have changed, when
+		# that's known
+		old = self.current.torrents
+		if ids is None:
+			changed = {id: torrent for id, torrent in torrents.items(
+				) if not old.get(id) == torrent}
+			removed = {id: torrent["owner"] for id, torrent in
+				old.items() if not id in torrents}
+		else:
+			changed = {id: torrents[id] for id in ids if id in torrents
+				and not old.get(id) == torrents[id]}
+			removed = {id: old[id]["owner"] for id in ids if id in old
+				and not id in torrents}
+		# only move the version on when something changed, so
+		# anything keyed on it stays valid across idle polls.
+		if not changed and not removed:
+			return self.current
+		snapshot = Snapshot(version or self.current.version+1,
+			torrents, self.columns, self.epoch, derived, self.current,
+			changed, removed)
+		self.names.update([(id, torrent["name"]) for id, torrent in
+			changed.items()], removed)
+		self.current = snapshot
+		self.deltas.append(Delta(snapshot.version, changed, removed))
+		self.condition.notify_all()
+		return snapshot
+	def search(self, snapshot, column, descending=False, owner=None,
+			name=None, state=None, ranges={}):
+		ids = self.names.search(name.lower()) if name else None
+		return snapshot.select(column, descending, owner, ids,
+			Search.make_filter(name, state, ranges))
+	def wait(self, version, timeout=None, epoch=None):
+		# every delta published after `version`, or None when the
+		# caller has fallen further behind than we keep history for
+		# or is counting in another epoch.
+		with self.lock:
+			if not epoch is None and not epoch == self.epoch:
+				return None
+			if self.current.version <= version:
+				self.condition.wait(timeout)
+			if not epoch is None and not epoch == self.epoch:
+				return None
+			if self.current.version <= version:
+				return []
+			if not self.deltas or self.deltas[0].version > version+1:
+				return None
+			return [delta for delta in self.deltas
+				if delta.version > version]
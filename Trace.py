@@ -0,0 +1,156 @@
+import collections, glob, json, os, sys, threading, time
+
+def call_site(frame):
+	# where whatever `frame` is in was called from outside its own file
+	filename = frame.f_code.co_filename
+	while frame and frame.f_code.co_filename == filename:
+		frame = frame.f_back
+	if frame is None:
+		return "?"
+	return "%s:%d %s" % (os.path.basename(frame.f_code.co_filename),
+		frame.f_lineno, frame.f_code.co_name)
+def folded_stack(frame, limit=64):
+	# outermost first, the way flame graph tools take them
+	names = []
+	while frame and len(names) < limit:
+		names.append("%s:%s" % (os.path.basename(
+			frame.f_code.co_filename), frame.f_code.co_name))
+		frame = frame.f_back
+	return ";".join(reversed(names))
+
+def read(paths, count):
+	# the newest `count` traces across the given files, newest first
+	traces = []
+	for path in paths:
+		try:
+			with open(path) as file:
+				lines = file.readlines()
+		except FileNotFoundError:
+			continue
+		for line in lines[-count:]:
+			try:
+				traces.append(json.loads(line))
+			except ValueError:
+				pass
+	traces.sort(key=lambda trace: trace["time"], reverse=True)
+	return traces[:count]
+def trace_files(path):
+	# `path` and any per-process files next to it, but not old ones
+	return [name for name in glob.glob(glob.escape(path)+"*") if
+		name == path or not name.rsplit(".", 1)[1].isdigit()]
+
+class Tracer(object):
+	# records what each request did: every SQL statement and btpd call
+	# with how long it took and where it was made from, and for
+	# requests still running `profile_after` seconds in, samples of
+	# their stack every `interval` seconds. requests taking at least
+	# `slower_than` seconds are written to `path` as json lines, which
+	# is rotated at `max_bytes` with `backups` old files kept.
+	def __init__(self, enabled=False, path="btpd-web.trace",
+			slower_than=0, profile_after=None, interval=0.005,
+			max_bytes=1 << 20, backups=3, max_events=1000):
+		self.enabled = enabled
+		self.path = path
+		self.slower_than = slower_than
+		self.profile_after = profile_after
+		self.interval = interval
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.max_events = max_events
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		# thread id -> trace, for the sampler
+		self.active = {}
+		self.sampling = threading.Condition(self.lock)
+		self.sampler = None
+
+	def begin(self, name):
+		if not self.enabled:
+			return
+		trace = {"name": name, "time": time.time(), "start":
+			time.perf_counter(), "events": [], "dropped": 0,
+			"samples": collections.Counter()}
+		self.local.trace = trace
+		if not self.profile_after is None:
+			with self.lock:
+				self.active[threading.get_ident()] = trace
+				if self.sampler is None:
+					self.sampler = threading.Thread(target=self.sample)
+					self.sampler.daemon = True
+					self.sampler.start()
+				self.sampling.notify()
+	def event(self, kind, text, seconds, frame):
+		trace = getattr(self.local, "trace", None)
+		if trace is None:
+			return
+		if len(trace["events"]) >= self.max_events:
+			trace["dropped"] += 1
+			return
+		trace["events"].append((kind, text, round(seconds*1000, 3),
+			round((time.perf_counter()-seconds-trace["start"])*1000, 3),
+			call_site(frame)))
+	def query(self, frame, statement, seconds):
+		# a Database observer. parameters are left out, they can be
+		# passwords.
+		self.event("sql", " ".join(statement.split()), seconds, frame)
+	def btpd(self, frame, method, args, seconds):
+		# a Utils observer
+		self.event("btpd", "%s(%s)" % (method, ", ".join(repr(arg)
+			for arg in args if not callable(arg))), seconds, frame)
+	def end(self, **details):
+		trace = getattr(self.local, "trace", None)
+		if trace is None:
+			return
+		self.local.trace = None
+		with self.lock:
+			self.active.pop(threading.get_ident(), None)
+		seconds = time.perf_counter()-trace["start"]
+		if seconds < self.slower_than:
+			return
+		# the same statement from the same place over and over is
+		# usually a query per row that wants to be one query
+		repeated = collections.Counter((site, text) for kind, text, _, _,
+			site in trace["events"] if kind == "sql")
+		record = dict(details, name=trace["name"], time=trace["time"],
+			ms=round(seconds*1000, 3), events=trace["events"],
+			dropped=trace["dropped"], repeated=[(count, site, text) for (
+			site, text), count in repeated.most_common(10) if count > 1],
+			profile=trace["samples"].most_common(50))
+		self.write(record)
+	def write(self, record):
+		line = json.dumps(record)+"\n"
+		with self.lock:
+			try:
+				size = os.path.getsize(self.path)
+			except FileNotFoundError:
+				size = 0
+			if size and size+len(line) > self.max_bytes:
+				self.rotate()
+			with open(self.path, "a") as file:
+				file.write(line)
+	def rotate(self):
+		for n in range(self.backups-1, 0, -1):
+			older = "%s.%d" % (self.path, n)
+			if os.path.exists(older):
+				os.replace(older, "%s.%d" % (self.path, n+1))
+		if self.backups:
+			os.replace(self.path, "%s.1" % self.path)
+		else:
+			os.remove(self.path)
+
+	def sample(self):
+		while True:
+			with self.lock:
+				while not self.active:
+					self.sampling.wait()
+				now = time.perf_counter()
+				slow = [(ident, trace) for ident, trace in
+					self.active.items() if now-trace["start"] >=
+					self.profile_after]
+				if slow:
+					frames = sys._current_frames()
+					for ident, trace in slow:
+						frame = frames.get(ident)
+						if frame:
+							trace["samples"][folded_stack(frame)] += 1
+			time.sleep(self.interval)
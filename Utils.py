@@ -1,21 +1,53 @@
-import os, subprocess
+import concurrent.futures, contextlib, os, ssl, subprocess, sys, time
+import Btpd
 
-class Utils(object):
-	def __init__(self, app):
-		self.app = app
-		self.btpd_dir = app.config.get("BTPD_DIR"
-			) or os.path.join(os.path.expanduser("~"),
-			".btpd")
-	def get_torrent_list(self):
-		lines = subprocess.check_output(["btcli", "-d",
-			self.btpd_dir, "list", "-f",
-			"%n %# %t %p %S %r %s %h %P %^ %v %u %g "
-			"%H %T\\n"]
-			).decode("utf8").strip().split("\n")
-		return lines
+# get_torrent_list() takes a `timer(stage)` to time its "fetch" and
+# "parse" stages with; this one doesn't.
+NO_TIMER = contextlib.nullcontext()
+def no_timer(stage):
+	return NO_TIMER
+
+class Btcli(object):
+	def __init__(self, btpd_dir):
+		self.btpd_dir = btpd_dir
+	def get_torrent_list(self, timer=no_timer):
+		# the name goes last so it's whatever is left of the line once
+		# the other (space-free) fields are split off.
+		with timer("fetch"):
+			output = subprocess.check_output(["btcli", "-d",
+				self.btpd_dir, "list", "-f",
+				"%# %t %p %S %r %h %P %^ %v %u %g %H %T %n\\n"])
+		with timer("parse"):
+			return self.parse_torrent_list(output)
+	def parse_torrent_list(self, output):
+		torrents = []
+		for line in output.decode("utf8").split("\n"):
+			fields = line.split(None, 13)
+			if len(fields) < 13:
+				continue
+			(id, state, percent, size, ratio, info_hash, peers,
+				upload_speed, download_speed, uploaded, downloaded,
+				have_pieces, total_pieces) = fields[:13]
+			torrents.append(Btpd.Torrent(int(id), (fields[13:] or
+				[""])[0], state, info_hash, int(size), float(
+				percent.rstrip("%")), float(ratio), int(peers),
+				Btpd.parse_size(upload_speed), Btpd.parse_size(
+				download_speed), Btpd.parse_size(uploaded),
+				Btpd.parse_size(downloaded), int(have_pieces),
+				int(total_pieces)))
+		return torrents
 	def do_torrent_action(self, id, action):
 		subprocess.check_call(["btcli", "-d", self.btpd_dir,
 			 action, str(id)])
+	def do_torrent_actions(self, actions):
+		# btcli takes any number of torrents per command
+		by_action = {}
+		for id, action in actions.items():
+			by_action.setdefault(action, []).append(str(id))
+		for action, ids in by_action.items():
+			subprocess.check_call(["btcli", "-d", self.btpd_dir,
+				action]+ids)
+		return []
 	def add_torrent(self, directory, torrent_file, idle=False):
 		add_command = ["btcli", "-d", self.btpd_dir, "add",
 			"-d", directory, torrent_file]
@@ -25,11 +57,279 @@ class Utils(object):
 	def remove_torrent(self, id):
 		subprocess.check_call(["btcli", "-d", self.btpd_dir,
 			"del", str(id)])
-	def download_torrent(self, url, filename):
-		subprocess.check_call(["wget", "-O", filename, url])
-	def get_log(self, lines):
+	def remove_torrents(self, ids):
+		subprocess.check_call(["btcli", "-d", self.btpd_dir,
+			"del"]+[str(id) for id in ids])
+		return []
+
+class Ipc(object):
+	def __init__(self, btpd_dir):
+		self.client = Btpd.Client(btpd_dir)
+	def get_torrent_list(self, timer=no_timer):
+		with timer("fetch"):
+			results = self.client.tget(Btpd.LIST_KEYS)
+		with timer("parse"):
+			return Btpd.make_torrents(results)
+	def do_torrent_action(self, id, action):
+		if action == "start":
+			self.client.start(id)
+		elif action == "stop":
+			self.client.stop(id)
+		else:
+			raise ValueError("unknown torrent action %r" % action)
+	def add_torrent(self, directory, torrent_file, idle=False):
+		directory = os.path.abspath(directory)
+		os.makedirs(directory, exist_ok=True)
+		with open(torrent_file, "rb") as file:
+			id = self.client.add(directory, file.read())
+		if not idle:
+			self.client.start(id)
+	def remove_torrent(self, id):
+		self.client.delete(id)
+	def do_torrent_actions(self, actions):
+		# one request per torrent, but all down the one connection.
+		# returns the ids btpd refused.
+		failed = []
+		for id, action in actions.items():
+			try:
+				self.do_torrent_action(id, action)
+			except Btpd.BtpdError:
+				failed.append(id)
+		return failed
+	def remove_torrents(self, ids):
+		failed = []
+		for id in ids:
+			try:
+				self.client.delete(id)
+			except Btpd.BtpdError:
+				failed.append(id)
+		return failed
+
+BACKENDS = {"btcli": Btcli, "ipc": Ipc}
+
+# with several daemons, torrent ids are namespaced: daemon n's torrent
+# i is n*ID_STRIDE+i, so the first daemon's ids are btpd's own.
+ID_STRIDE = 10000000
+
+def tls_context(config):
+	if not config.get("TLS", False):
+		return None
+	assert "TLS_CERT" in config, "No TLS certificate specified."
+	assert "TLS_KEY" in config, "No TLS key specified."
+	context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+	context.options = (ssl.OP_CIPHER_SERVER_PREFERENCE|
+		ssl.OP_SINGLE_DH_USE|ssl.OP_SINGLE_ECDH_USE|
+		ssl.OP_NO_COMPRESSION)
+	context.load_cert_chain(config["TLS_CERT"], config["TLS_KEY"])
+	if "TLS_CIPHERS" in config:
+		context.set_ciphers(config["TLS_CIPHERS"])
+	return context
+
+class Daemon(object):
+	# one btpd, through its backend or, failing that, btcli
+	def __init__(self, index, btpd_dir, backend):
+		self.index = index
+		self.btpd_dir = btpd_dir
+		self.btcli = Btcli(btpd_dir)
+		self.backend = self.btcli if backend == "btcli" else BACKENDS[
+			backend](btpd_dir)
+		self.polling = None
+		self.error = None
+	def call(self, method, *args):
+		try:
+			return getattr(self.backend, method)(*args)
+		except (OSError, Btpd.ProtocolError):
+			# socket unusable (old btpd, permissions, etc.),
+			# try the same thing through btcli instead.
+			if self.backend is self.btcli:
+				raise
+			return getattr(self.btcli, method)(*args)
+
+class Utils(object):
+	def __init__(self, app, observers=()):
+		self.app = app
+		# each is told about every call made to btpd: observer(frame,
+		# method, args, seconds)
+		self.observers = list(observers)
+		btpd_dirs = app.config.get("BTPD_DIRS") or [app.config.get(
+			"BTPD_DIR") or os.path.join(os.path.expanduser("~"),
+			".btpd")]
+		backend = app.config.get("BTPD_BACKEND", "ipc")
+		if not backend in BACKENDS:
+			raise ValueError("unknown btpd backend %r" % backend)
+		self.daemons = [Daemon(index, btpd_dir, backend) for index,
+			btpd_dir in enumerate(btpd_dirs)]
+		self.poll_timeout = app.config.get("BTPD_POLL_TIMEOUT", 10)
+		self.pool = None
+		if len(self.daemons) > 1:
+			self.pool = concurrent.futures.ThreadPoolExecutor(
+				max_workers=len(self.daemons))
+	def _call(self, daemon, method, *args):
+		if not self.observers:
+			return daemon.call(method, *args)
+		start = time.perf_counter()
+		try:
+			return daemon.call(method, *args)
+		finally:
+			seconds = time.perf_counter()-start
+			for observer in self.observers:
+				observer(sys._getframe(), method, args, seconds)
+	def route(self, id):
+		# the daemon a torrent id belongs to and its id there
+		index, local_id = divmod(id, ID_STRIDE)
+		if not index < len(self.daemons):
+			raise ValueError("no btpd for torrent %d" % id)
+		return self.daemons[index], local_id
+	def route_all(self, ids):
+		by_daemon = {}
+		for id in ids:
+			daemon, local_id = self.route(id)
+			by_daemon.setdefault(daemon, []).append(local_id)
+		return by_daemon.items()
+
+	def metainfo_path(self, id, info_hash):
+		# where btpd keeps a copy of the torrent's .torrent
+		daemon, _ = self.route(id)
+		return os.path.join(daemon.btpd_dir, "torrents", info_hash,
+			"torrent")
+
+	def _poll(self, daemon, timer):
+		torrents = self._call(daemon, "get_torrent_list", timer)
+		if daemon.index:
+			offset = daemon.index*ID_STRIDE
+			for torrent in torrents:
+				torrent.id += offset
+		return torrents
+	def get_torrent_lists(self, timer=no_timer):
+		# each daemon's torrents, or None for those that didn't answer.
+		# they're all polled at once; one that's slower than
+		# poll_timeout is left to finish and its list used next time
+		# rather than being asked again.
+		if len(self.daemons) == 1:
+			return [self._poll(self.daemons[0], timer)]
+		for daemon in self.daemons:
+			if daemon.polling is None:
+				daemon.polling = self.pool.submit(self._poll, daemon,
+					timer)
+		concurrent.futures.wait([daemon.polling for daemon in
+			self.daemons], timeout=self.poll_timeout)
+		lists = []
+		for daemon in self.daemons:
+			torrents = None
+			if daemon.polling.done():
+				polling, daemon.polling = daemon.polling, None
+				try:
+					torrents = polling.result()
+					daemon.error = None
+				except Exception as e:
+					if daemon.error is None:
+						print("failed to poll btpd in %s: %s" % (
+							daemon.btpd_dir, e))
+					daemon.error = e
+			lists.append(torrents)
+		if all(torrents is None for torrents in lists):
+			raise OSError("no btpd answered")
+		return lists
+	def merge_torrent_lists(self, lists, previous):
+		# get_torrent_lists() as one list, in which a daemon that didn't
+		# answer keeps (copies of) its torrents from `previous`
+		torrents = [torrent for daemon_torrents in lists if
+			daemon_torrents for torrent in daemon_torrents]
+		silent = set(index for index, daemon_torrents in enumerate(
+			lists) if daemon_torrents is None)
+		if silent:
+			torrents.extend(torrent.replace() for torrent in previous
+				if torrent.id//ID_STRIDE in silent)
+		return torrents
+	def do_torrent_action(self, id, action):
+		daemon, local_id = self.route(id)
+		self._call(daemon, "do_torrent_action", local_id, action)
+	def add_torrent(self, directory, torrent_file, idle=False, daemon=0):
+		self._call(self.daemons[daemon], "add_torrent", directory,
+			torrent_file, idle)
+	def remove_torrent(self, id):
+		daemon, local_id = self.route(id)
+		self._call(daemon, "remove_torrent", local_id)
+	def do_torrent_actions(self, actions):
+		# returns the ids of the torrents btpd refused
+		failed = []
+		for daemon, local_ids in self.route_all(actions):
+			offset = daemon.index*ID_STRIDE
+			failed.extend(offset+local_id for local_id in self._call(
+				daemon, "do_torrent_actions", {local_id: actions[
+				offset+local_id] for local_id in local_ids}))
+		return failed
+	def remove_torrents(self, ids):
+		failed = []
+		for daemon, local_ids in self.route_all(ids):
+			failed.extend(daemon.index*ID_STRIDE+local_id for local_id
+				in self._call(daemon, "remove_torrents", local_ids))
+		return failed
+	def log_path(self, daemon=0):
+		return os.path.join(self.daemons[daemon].btpd_dir, "log")
+	def get_log(self, lines, daemon=0, block_size=1 << 16):
+		# read backwards from the end a block at a time until we've
+		# got enough lines, rather than reading the whole log.
 		lines = lines or self.app.config.get("LOG_LINES", 30)
-		with open(os.path.join(self.btpd_dir, "log"), "rb"
-				) as log:
-			return log.read().decode("utf8", "ignore"
-				).strip().split("\n")[-lines:][::-1]
+		chunks = []
+		newlines = 0
+		with open(self.log_path(daemon), "rb") as log:
+			position = log.seek(0, os.SEEK_END)
+			# a newline at the very end finishes the last line rather
+			# than starting another
+			ending = 0
+			if position > 0:
+				log.seek(position-1)
+				ending = int(log.read(1) == b"\n")
+			# the newline before the oldest line we want is the
+			# `lines`th from the end, not counting that one
+			while position > 0 and newlines-ending < lines:
+				size = min(block_size, position)
+				position -= size
+				log.seek(position)
+				chunk = log.read(size)
+				chunks.append(chunk)
+				newlines += chunk.count(b"\n")
+		data = b"".join(reversed(chunks))
+		if not data:
+			return []
+		if ending:
+			data = data[:-1]
+		# with the start of the log unread, the first line is partial,
+		# but there are more than `lines` of them
+		return data.decode("utf8", "ignore").split("\n")[-lines:][::-1]
+	def follow_log(self, interval=1, daemon=0):
+		# yields lists of lines as they're appended to the log (empty
+		# lists while nothing is happening), following the log across
+		# rotation and truncation.
+		path = self.log_path(daemon)
+		log = open(path, "rb")
+		log.seek(0, os.SEEK_END)
+		inode = os.fstat(log.fileno()).st_ino
+		buffer = b""
+		try:
+			while True:
+				data = log.read()
+				if data:
+					buffer += data
+					*complete, buffer = buffer.split(b"\n")
+					yield [line.decode("utf8", "ignore")
+						for line in complete]
+					continue
+				try:
+					stat = os.stat(path)
+				except FileNotFoundError:
+					stat = None
+				if stat and (not stat.st_ino == inode or
+						stat.st_size < log.tell()):
+					log.close()
+					log = open(path, "rb")
+					inode = os.fstat(log.fileno()).st_ino
+					if buffer:
+						yield [buffer.decode("utf8", "ignore")]
+					buffer = b""
+					continue
+				yield []
+				time.sleep(interval)
+		finally:
+			log.close()
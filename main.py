@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
-import copy, argparse, base64, codecs, datetime, hashlib
-import os, subprocess, sqlite3, threading, time
-import flask, scrypt, libtorrent, werkzeug
-import Config, Database, Utils
+import argparse, base64, collections, datetime, hmac, json
+import os, subprocess, sqlite3, tempfile, threading, time, urllib.parse
+import flask, scrypt, werkzeug
+import Bencode, Btpd, Cache, Config, Database, Fetcher, History, Login
+import Metrics, Scheduler, Search, Shared, Snapshot, Trace, Utils
 
 TORRENT_STATES = {"S": "seed", "I": "idle", "L": "leech", "+": "starting"}
 TORRENT_ACTIONS = {"seed": "stop", "idle": "start", "leech": "stop", "starting": "stop"}
+TORRENT_ACTION_STATES = {"start": "starting", "stop": "idle"}
 
 HEADINGS = ["ID", "Name", "State", "Percent", "Size", "Ratio", "Uploader"]
 ARROW_DOWN = "▾"
 ARROW_UP = "▴"
+API_MAX_PER_PAGE = 500
+STREAM_HEARTBEAT = 15
+STREAM_FIELDS = ["id", "title", "state", "pretty_percent", "pretty_size",
+	"pretty_ratio", "uploader"]
 
 ERROR_NO_ID = "No ID supplied."
 ERROR_INVALID_ID = "An invalid ID was provided."
@@ -22,92 +28,320 @@ ERROR_ACCESS_UNAUTHORISED = ("You are not authorised to "
 app = flask.Flask(__name__)
 app.config.from_object(Config)
 
-database = Database.Database()
-utils = Utils.Utils(app)
+# Serve.py runs one "poller" process that polls btpd and shares what it
+# finds with several "worker" processes serving requests. without a
+# role everything happens in this one process.
+ROLE = os.environ.get("BTPD_WEB_ROLE")
+# which of them this is, for telling their metrics apart
+PROCESS = ROLE and "%s%s" % (ROLE, os.environ.get("BTPD_WEB_WORKER", ""))
 
-torrent_list = {}
-last_list = 0
-list_lock = threading.Lock()
-list_condition = threading.Condition()
+metrics = Metrics.Metrics(app.config.get("METRICS", False))
+metrics.describe("btpdweb_poll_stage_seconds",
+	"Time spent in each stage of polling btpd's torrent list.")
+metrics.describe("btpdweb_db_query_seconds",
+	"Time spent on SQL statements, by the Database method running them.")
+metrics.describe("btpdweb_db_queries_per_request",
+	"SQL statements run while answering a request.")
+metrics.describe("btpdweb_request_seconds",
+	"Time taken to answer a request, by route.")
+metrics.describe("btpdweb_responses_total",
+	"Responses sent, by route and status code.")
+def poll_stage(stage):
+	return metrics.timer("btpdweb_poll_stage_seconds", stage=stage)
+
+trace_path = app.config.get("TRACE_FILE", "btpd-web.trace")
+tracer = Trace.Tracer(app.config.get("TRACE", False), "%s.%s" % (
+	trace_path, PROCESS) if ROLE else trace_path,
+	slower_than=app.config.get("TRACE_SLOWER_THAN", 0),
+	profile_after=app.config.get("TRACE_PROFILE_AFTER"),
+	max_bytes=app.config.get("TRACE_MAX_BYTES", 1 << 20),
+	backups=app.config.get("TRACE_BACKUPS", 3))
+
+query_observers = []
+if metrics.enabled:
+	query_observers.append(metrics.query)
+if tracer.enabled:
+	query_observers.append(tracer.query)
+database = Database.Database(scrypt_params=(
+	app.config.get("SCRYPT_N", 1 << 14), app.config.get("SCRYPT_R", 8),
+	app.config.get("SCRYPT_P", 1)), shared=bool(ROLE),
+	observers=query_observers, pool_size=app.config.get("DATABASE_POOL",
+	8))
+utils = Utils.Utils(app, observers=[tracer.btpd] if tracer.enabled
+	else [])
+
+run_dir = app.config.get("RUN_DIR", "btpd-web.run")
+shared_snapshot = Shared.SharedFile(os.path.join(run_dir, "snapshot"))
+shared_history = Shared.SharedFile(os.path.join(run_dir, "history"))
+control = Shared.Control(os.path.join(run_dir, "control"))
+shared_metrics = Shared.SharedFile(os.path.join(run_dir, "metrics.%s" %
+	PROCESS))
+if ROLE == "worker":
+	snapshots = Shared.FollowingPublisher([heading.lower() for
+		heading in HEADINGS], shared_snapshot, control)
+	scheduler = Shared.RemoteScheduler(control)
+	throttle = Shared.RemoteThrottle(control)
+else:
+	snapshots = Snapshot.Publisher(
+		[heading.lower() for heading in HEADINGS])
+	scheduler = Scheduler.Scheduler(
+		interval=app.config.get("LIST_INTERVAL", 4),
+		idle_interval=app.config.get("LIST_IDLE_INTERVAL", 60),
+		active_interval=app.config.get("LIST_ACTIVE_INTERVAL", 2),
+		idle_after=app.config.get("LIST_IDLE_AFTER", 120),
+		debounce=app.config.get("LIST_DEBOUNCE", 0.5))
+	throttle = None
+logins = Login.Login(database, workers=app.config.get(
+	"LOGIN_WORKERS", 2), queue=app.config.get("LOGIN_QUEUE", 8),
+	attempts=app.config.get("LOGIN_ATTEMPTS", 5),
+	window=app.config.get("LOGIN_WINDOW", 300), throttle=throttle)
+history = History.History(max_rows=app.config.get(
+	"HISTORY_MAX_TORRENTS", 10000), epoch=snapshots.epoch)
+fragments = Cache.FragmentCache(app.config.get("PAGE_CACHE_SIZE", 256))
+metainfo = Cache.MetainfoCache(app.config.get("METAINFO_CACHE_SIZE", 64),
+	app.config.get("METAINFO_CACHE_FILES", 500000))
+def poll_torrent_list():
+	try:
+		lists = utils.get_torrent_lists(poll_stage)
+	except:
+		lists = None
+	if lists is None:
+		# btpd didn't answer, which isn't the same as having no torrents
+		return snapshots.current.owner_stats()
+	lines = utils.merge_torrent_lists(lists,
+		snapshots.current.torrents.values())
+	with poll_stage("owners"):
+		info_hashes = set(torrent.info_hash for torrent in lines)
+		owners = database.torrent_owners()
+		added = [info_hash for info_hash in info_hashes
+			if not info_hash in owners]
+		removed = set(torrent.info_hash for torrent in
+			snapshots.current.torrents.values())-info_hashes
+		database.update_torrents(added, removed)
+		owners = database.torrent_owners()
+
+		torrents = {}
+		for torrent in lines:
+			torrent.owner, torrent.uploader = owners.get(
+				torrent.info_hash, (1, None))
+			torrent.state = TORRENT_STATES.get(torrent.state,
+				torrent.state)
+			torrents[torrent.id] = torrent
+	# building the snapshot is what holds the publisher's lock
+	with poll_stage("publish"):
+		snapshots.publish(torrents)
+	total = snapshots.current.owner_stats()
+	samples = {torrent.info_hash: (torrent.upload_rate,
+		torrent.download_rate, torrent.peers, torrent.uploaded_bytes,
+		torrent.downloaded_bytes) for torrent in torrents.values()}
+	samples[None] = (total["upload_rate"], total["download_rate"],
+		sum(sample[2] for sample in samples.values()), total["uploaded"],
+		total["downloaded"])
+	with poll_stage("history"):
+		history.record(samples)
+	return total
+def share():
+	current = snapshots.current
+	if current.version > shared_snapshot.written:
+		shared_snapshot.write(current.version, {"torrents": [
+			torrent.pack() for torrent in current.torrents.values()],
+			"derived": current.derived()}, current.epoch)
+	if history.version > shared_history.written:
+		shared_history.write(history.version, history.dump(),
+			history.epoch)
+def share_metrics():
+	if metrics.enabled:
+		shared_metrics.write(shared_metrics.written+1, metrics.dump())
+def shared_processes():
+	# the other processes' metrics, as last shared
+	processes = {}
+	for name in os.listdir(run_dir):
+		if name.startswith("metrics.") and not name.endswith(".tmp"
+				) and not name == "metrics.%s" % PROCESS:
+			_, version, dump = Shared.SharedFile(os.path.join(run_dir,
+				name)).read()
+			if not version is None:
+				processes[name[len("metrics."):]] = dump
+	return processes
 def fill_torrent_list():
-	global last_list
-	global torrent_list
 	while True:
-		try:
-			lines = utils.get_torrent_list()
-		except:
-			lines = []
-		torrents = {}
-		for i, line in enumerate(lines):
-			if not line:
-				continue
-			line = line.rsplit(None, 14)
-			owner = database.get_torrent_owner(line[-1])
-			if not owner:
-				database.add_torrent(line[-1], "root")
-				owner = 1
-			owner_username = database.username_from_id(
-				owner)
-			torrent = {"owner": owner, "name": line[0].lower(),
-				"id": int(line[1]), "state": line[2],
-				"percent": float(line[3][:-1]), "size":
-				int(line[4]), "ratio": float(line[5]),
-				"pretty_size": line[6], "info_hash": line[7],
-				"uploader": owner_username, "title":
-				line[0], "peers": line[8], "upload_speed":
-				line[9], "download_speed": line[10],
-				"uploaded": line[11], "downloaded": line[12],
-				"have_pieces": line[13], "total_pieces":
-				line[14]}
-			if torrent["state"] in TORRENT_STATES:
-				torrent["state"] = TORRENT_STATES[
-					torrent["state"]]
-			torrents[torrent["id"]] = torrent
-		if lines:
-			removed = set(torrent["info_hash"
-				] for torrent in torrent_list.values())-set(
-				torrent["info_hash"
-				] for torrent in torrents.values())
-			for info_hash in removed:
-				database.del_torrent(info_hash)
-			with list_lock:
-				torrent_list = torrents
-		since_last = time.time()-last_list
-		interval = app.config.get("LIST_INTERVAL", 4)
-		if last_list == 0 or since_last < interval:
-			sleep_time = interval-since_last
-			if last_list == 0:
-				sleep_time = interval
-			with list_condition:
-				list_condition.wait(sleep_time)
-		last_list = time.time()
+		total = poll_torrent_list()
+		if ROLE == "poller":
+			with poll_stage("share"):
+				share()
+			share_metrics()
+		scheduler.polled(bool(total["upload_rate"] or
+			total["download_rate"]))
+		scheduler.wait()
 list_thread = threading.Thread(target=fill_torrent_list)
 list_thread.daemon = True
 
+def handle_control(command, *args):
+	if command == "touch":
+		scheduler.touch()
+	elif command == "refresh":
+		scheduler.refresh()
+	elif command == "update":
+		snapshots.update(args[0])
+		share()
+	elif command == "fetch":
+		try:
+			return [job.id for job in fetcher.submit_many(*args)]
+		except Fetcher.Full:
+			return None
+	elif command == "jobs":
+		return [vars(job) for job in fetcher.list_jobs(*args)]
+	elif command == "login":
+		method, args = args[0], args[1:]
+		if not method in ["attempt", "withdraw", "succeeded"]:
+			raise ValueError("unknown login method %r" % method)
+		try:
+			return getattr(logins.throttle, method)(*args)
+		except Login.Throttled:
+			return None
+def serve_poller():
+	control_thread = threading.Thread(target=control.serve,
+		args=[handle_control])
+	control_thread.daemon = True
+	control_thread.start()
+	fill_torrent_list()
+def follow_shared():
+	shared = 0
+	while True:
+		try:
+			snapshots.follow()
+			epoch, version, state = shared_history.read()
+			if not version is None and (not epoch == history.epoch or
+					version > history.version):
+				history.load(state)
+			if time.monotonic()-shared >= app.config.get(
+					"METRICS_SHARE_INTERVAL", 5):
+				shared = time.monotonic()
+				share_metrics()
+		except Exception as e:
+			print("failed to follow the poller: %s" % e)
+		time.sleep(app.config.get("SHARED_INTERVAL", 0.25))
+if ROLE == "worker":
+	follow_thread = threading.Thread(target=follow_shared)
+	follow_thread.daemon = True
+	follow_thread.start()
+
+@app.before_request
+def activity():
+	scheduler.touch()
+	if metrics.enabled:
+		flask.g.started = time.perf_counter()
+		metrics.reset_queries()
+	if tracer.enabled:
+		tracer.begin("%s %s" % (flask.request.method,
+			flask.request.full_path.rstrip("?")))
+@app.after_request
+def measure(response):
+	if metrics.enabled and "started" in flask.g:
+		endpoint = flask.request.endpoint or "unknown"
+		metrics.observe("btpdweb_request_seconds", (("endpoint",
+			endpoint), ("method", flask.request.method)),
+			time.perf_counter()-flask.g.started)
+		metrics.observe("btpdweb_db_queries_per_request", (("endpoint",
+			endpoint),), metrics.queries(), Metrics.COUNT_BUCKETS)
+		metrics.count("btpdweb_responses_total", (("endpoint", endpoint),
+			("status", str(response.status_code))))
+	flask.g.status = response.status_code
+	return response
+@app.teardown_request
+def finish_trace(exception):
+	if tracer.enabled:
+		tracer.end(status=flask.g.get("status", 500), process=PROCESS,
+			error=None if exception is None else repr(exception))
+
+def auth():
+	# the session is resolved once per request; drop flask.g.auth to
+	# pick up changes made during the request.
+	if not "auth" in flask.g:
+		flask.g.auth = database.session_user(
+			flask.request.cookies.get("btpd-session"))
+	return flask.g.auth
 def is_authenticated():
-	return database.is_authenticated(
-		flask.request.cookies.get("btpd-session"))
+	return not auth() is None
 def is_admin():
-	return database.is_admin(flask.request.cookies["btpd-session"])
+	return is_authenticated() and auth().admin
 def user_id():
-	return database.id_from_session(flask.request.cookies[
-		"btpd-session"])
+	return auth().id if is_authenticated() else None
 def login_redirect():
 	return flask.redirect(flask.url_for("login"))
+def visibility_scope(admin, user_id):
+	return "admin" if admin else "user%s" % user_id
+def snapshot_position(snapshot):
+	# versions start over when the poller restarts, so they're only
+	# told apart along with the epoch they're from
+	return "%d-%d" % (snapshot.epoch, snapshot.version)
+def snapshot_etag(snapshot, admin, user_id):
+	# what a user can see only changes with the snapshot, so its
+	# position and their visibility scope identify the response.
+	return "%s-%s" % (snapshot_position(snapshot), visibility_scope(
+		admin, user_id))
+def not_modified(etag):
+	response = flask.Response(status=304)
+	response.set_etag(etag)
+	return response
+def json_response(data, etag):
+	response = flask.jsonify(data)
+	response.set_etag(etag)
+	response.headers["Cache-Control"] = "private, no-cache"
+	return response
 def make_page(fragment, **kwargs):
-	session = flask.request.cookies.get("btpd-session")
-	user_username = database.username_from_session(session)
-	user_admin = database.is_admin(session)
+	user = auth()
+	user_username = user.username if user else None
+	user_admin = user.admin if user else None
 	return flask.render_template("index.html", fragment=fragment,
 		user_username=user_username, user_admin=user_admin,
 		**kwargs)
+FILTER_ARGS = ["q", "state", "owner"]+["%s_%s" % (bound, column) for
+	column in Search.RANGE_COLUMNS for bound in ["min", "max"]]
+def list_filters():
+	# name/state/range filters from the query string, as keyword
+	# arguments for Publisher.search, or None when there are none.
+	args = flask.request.args
+	ranges = {}
+	for column in Search.RANGE_COLUMNS:
+		bounds = []
+		for bound in ["min", "max"]:
+			value = args.get("%s_%s" % (bound, column), "").strip()
+			try:
+				bounds.append(float(value) if value else None)
+			except ValueError:
+				flask.abort(400, description="Invalid %s_%s." % (
+					bound, column))
+		ranges[column] = tuple(bounds)
+	filters = {"name": args.get("q", "").strip() or None, "state":
+		args.get("state") or None, "ranges": ranges}
+	if not filters["name"] and not filters["state"] and all(
+			bounds == (None, None) for bounds in ranges.values()):
+		return None
+	return filters
+def list_owner(admin):
+	if not admin:
+		return user_id()
+	elif flask.request.args.get("owner", "").isdigit():
+		return int(flask.request.args["owner"])
+	return None
+def list_torrents(current, column, descending, owner, start, stop):
+	# (total, torrents[start:stop]) for the current request's filters
+	filters = list_filters()
+	if not filters:
+		return current.count(owner), current.page(column, descending,
+			start, stop, owner)
+	ids = snapshots.search(current, column, descending, owner,
+		**filters)
+	return len(ids), [current.torrents[id] for id in ids[
+		max(start, 0):max(stop, 0)]]
+
 @app.route("/")
 def index():
 	if not is_authenticated():
 		return login_redirect()
-	session = flask.request.cookies["btpd-session"]
-	admin = database.is_admin(session)
-	user_id = database.id_from_session(session)
+	admin = is_admin()
+	own_id = user_id()
 	orderby = flask.request.args.get("orderby", "0")
 	descending = True
 	headings = HEADINGS[:]
@@ -115,46 +349,43 @@ def index():
 		descending = False
 		orderby = orderby[1:]
 
-	with list_lock:
-		non_parsed_lines = copy.deepcopy(list(
-			torrent_list.values()))
 	if not orderby or not orderby.isdigit() or int(orderby
-			) >= len(non_parsed_lines)-1:
+			) >= len(HEADINGS):
 		orderby = 0
 	else:
 		orderby = int(orderby)
 
 	arrow = ARROW_DOWN if descending else ARROW_UP
 	headings[orderby] = "%s %s" % (headings[orderby], arrow)
-	parsed_lines = []
-	for line in non_parsed_lines:
-		if not admin and not line["owner"] == user_id:
-			continue
-		parsed_lines.append(line)
 	orders = ["%s%d" % ("-" if n == orderby and descending else "",
 		n) for n in range(len(HEADINGS))]
-	if not orderby == 0:
-		parsed_lines = sorted(parsed_lines,
-			key=lambda l: l[HEADINGS[0].lower()],
-			reverse=descending)
-	parsed_lines = sorted(parsed_lines, key=lambda l: l[HEADINGS[
-		orderby].lower()], reverse=descending)
 
+	current = snapshots.current
+	owner = list_owner(admin)
 	page = int(flask.request.args.get("page", 1))-1
 	next_page = page+1
-	pages = int(len(parsed_lines)/app.config["PER_PAGE"])
-	if len(parsed_lines)%app.config["PER_PAGE"] > 0:
-		pages += 1
-	parsed_lines = parsed_lines[app.config["PER_PAGE"
-		]*page:app.config["PER_PAGE"]*next_page]
-
-	for n, line in enumerate(parsed_lines):
-		line["percent"] = "%.1f%%" % line["percent"]
-		line["ratio"] = "%.2f" % line["ratio"]
-		parsed_lines[n] = line
-	return make_page("list.html", lines=parsed_lines, orders=orders,
-		headings=headings, pages=pages, page=page,
-		orderby=flask.request.args.get("orderby", 0))
+	filter_query = urllib.parse.urlencode([(arg, value) for arg, value
+		in flask.request.args.items(multi=True) if arg in FILTER_ARGS
+		and value])
+	def render():
+		count, parsed_lines = list_torrents(current, HEADINGS[orderby
+			].lower(), descending, owner, app.config["PER_PAGE"]*page,
+			app.config["PER_PAGE"]*next_page)
+		pages = int(count/app.config["PER_PAGE"])
+		if count%app.config["PER_PAGE"] > 0:
+			pages += 1
+		return flask.render_template("list.html", lines=parsed_lines,
+			orders=orders, headings=headings, pages=pages, page=page,
+			version=snapshot_position(current),
+			filter_query=filter_query,
+			filters=flask.request.args, states=sorted(set(
+			TORRENT_STATES.values())),
+			orderby=flask.request.args.get("orderby", 0))
+	# the list only depends on these, so everyone who can see the
+	# same torrents shares one rendering per snapshot.
+	return make_page("list.html", html=fragments.get(current.version,
+		("list", visibility_scope(admin, own_id), flask.request.args.get(
+		"orderby", 0), page, filter_query), render, current.epoch))
 
 @app.route("/action")
 def action():
@@ -163,6 +394,7 @@ def action():
 	if not "id" in flask.request.args:
 		flask.abort(400, description=ERROR_NO_ID)
 	id = flask.request.args["id"]
+	torrent_list = snapshots.current.torrents
 	if not id.isdigit() or not int(id) in torrent_list:
 		flask.abort(400, description=ERROR_INVALID_ID)
 	id = int(id)
@@ -174,11 +406,49 @@ def action():
 	state = torrent_list[id]["state"]
 	if not state in TORRENT_ACTIONS:
 		flask.abort(400, description="Unkown torrent state provided.")
-	utils.do_torrent_action(id, TORRENT_ACTIONS[state])
-	with list_condition:
-		list_condition.notify()
+	command = TORRENT_ACTIONS[state]
+	utils.do_torrent_action(id, command)
+	snapshots.update({id: {"state": TORRENT_ACTION_STATES[command]}})
+	scheduler.refresh()
 	return flask.redirect(flask.request.referrer)
 
+def torrent_info_hash(data):
+	return Bencode.info_hash(data)
+def torrent_exists(info_hash):
+	return info_hash in database.torrent_owners()
+def daemon_counts():
+	return collections.Counter(id//Utils.ID_STRIDE for id in
+		snapshots.current.torrents)
+def add_daemon():
+	# new torrents go to whichever btpd has the fewest
+	counts = daemon_counts()
+	return min(range(len(utils.daemons)), key=lambda index:
+		counts[index])
+def add_torrent_data(username, directory, data, idle,
+		info_hash=None):
+	info_hash = info_hash or torrent_info_hash(data)
+	descriptor, filename = tempfile.mkstemp(prefix="btpd.",
+		suffix=".torrent")
+	try:
+		with os.fdopen(descriptor, "wb") as file:
+			file.write(data)
+		utils.add_torrent(directory, filename, idle, add_daemon())
+	finally:
+		os.remove(filename)
+	database.add_torrent(info_hash, username)
+	scheduler.refresh()
+def add_fetched_torrent(job, data):
+	add_torrent_data(job.username, job.directory, data, job.idle,
+		job.info_hash)
+if ROLE == "worker":
+	fetcher = Shared.RemoteFetcher(control)
+else:
+	fetcher = Fetcher.Fetcher(torrent_info_hash, torrent_exists,
+		add_fetched_torrent, workers=app.config.get("FETCH_WORKERS", 4),
+		queue=app.config.get("FETCH_QUEUE", 64),
+		per_host=app.config.get("FETCH_PER_HOST", 2),
+		timeout=app.config.get("FETCH_TIMEOUT", 30))
+
 @app.route("/add", methods=["GET", "POST"])
 def add():
 	if not is_authenticated():
@@ -189,29 +459,8 @@ def add():
 			directory = directory[1:]
 		if "../" in directory:
 			return flask.abort(400, description="Invalid path provided")
-		filename = "/tmp/btpd.%d." % os.getpid()
-		if flask.request.form["torrenturl"].strip():
-			filename = "%surl.%s.torrent" % (filename,
-				hashlib.md5(flask.request.form[
-				"torrenturl"].encode("utf8")
-				).hexdigest())
-			utils.download_torrent(
-				flask.request.form["torrenturl"],
-				filename)
-		else:
-			file = flask.request.files["file"]
-			filename = "%sfile.%s.torrent" % (filename,
-				hashlib.md5(file.read()
-				).hexdigest())
-			file.save(filename)
 
-		torrent = libtorrent.bdecode(open(filename, "rb"
-			).read())
-		info_hash = codecs.encode(libtorrent.torrent_info(torrent
-			).info_hash().to_bytes(), "hex").decode("utf8")
-
-		username = database.username_from_session(
-			flask.request.cookies["btpd-session"])
+		username = auth().username
 
 		idle = "idle" in flask.request.form
 		if not database.has_setting(username, "base_dir"):
@@ -220,15 +469,35 @@ def add():
 		base_dir = database.get_setting(username, "base_dir")
 		directory = os.path.join(base_dir, directory)
 
-		utils.add_torrent(directory, filename, idle)
-		os.remove(filename)
-		with list_condition:
-			list_condition.notify()
+		urls = flask.request.form.get("torrenturl", "").split()
+		if urls:
+			try:
+				fetcher.submit_many(urls, username, directory, idle)
+			except ValueError as e:
+				flask.abort(400, description=str(e))
+			except Fetcher.Full:
+				flask.abort(503, description="Too many torrents "
+					"queued, try again later.")
+			return flask.redirect(flask.url_for("jobs"))
 
-		database.add_torrent(info_hash, username)
+		data = flask.request.files["file"].read()
+		try:
+			info_hash = torrent_info_hash(data)
+		except Bencode.BencodeError:
+			flask.abort(400, description="Invalid torrent file.")
+		if torrent_exists(info_hash):
+			flask.abort(400, description="Torrent already added.")
+		add_torrent_data(username, directory, data, idle, info_hash)
 		return flask.redirect(flask.url_for("index"))
 	return make_page("add.html")
 
+@app.route("/jobs")
+def jobs():
+	if not is_authenticated():
+		return login_redirect()
+	username = None if is_admin() else auth().username
+	return make_page("jobs.html", jobs=fetcher.list_jobs(username))
+
 @app.route("/remove")
 def remove():
 	if not is_authenticated():
@@ -236,6 +505,7 @@ def remove():
 	if not "id" in flask.request.args:
 		flask.abort(400, description=ERROR_NO_ID)
 	id = flask.request.args["id"]
+	torrent_list = snapshots.current.torrents
 	if not id.isdigit() or not int(id) in torrent_list:
 		flask.abort(400, description=ERROR_INVALID_ID)
 	id = int(id)
@@ -244,20 +514,62 @@ def remove():
 		return flask.abort(401, description=
 			ERROR_ACTION_UNAUTHORISED)
 	if "seriously" in flask.request.args:
-		with list_lock:
-			info_hash = torrent_list[id]["info_hash"]
+		info_hash = torrent_list[id]["info_hash"]
 		if flask.request.args["seriously"] == "1":
 			database.del_torrent(info_hash)
 			utils.remove_torrent(id)
-		with list_condition:
-			list_condition.notify()
+			snapshots.update({id: None})
+			scheduler.refresh()
 		return flask.redirect(flask.url_for("index"))
 	else:
-		with list_lock:
-			title = torrent_list[id]["title"]
+		title = torrent_list[id]["title"]
 		return make_page("seriously.html", id=id, title=title,
 			warning="Are you sure you want to remove this torrent?")
 
+@app.route("/bulk", methods=["POST"])
+def bulk():
+	if not is_authenticated():
+		return login_redirect()
+	command = flask.request.form.get("action")
+	if not command in ["start", "stop", "remove"]:
+		flask.abort(400, description="Unknown bulk action.")
+	ids = [int(id) for id in flask.request.form.getlist("id")
+		if id.isdigit()]
+	if not ids:
+		flask.abort(400, description=ERROR_NO_ID)
+	current = snapshots.current
+	admin = is_admin()
+	own_id = user_id()
+	torrents = []
+	for id in set(ids):
+		torrent = current.get(id)
+		if not torrent:
+			flask.abort(400, description=ERROR_INVALID_ID)
+		if not admin and not torrent["owner"] == own_id:
+			flask.abort(401, description=ERROR_ACTION_UNAUTHORISED)
+		torrents.append(torrent)
+	torrents.sort(key=lambda torrent: torrent["id"])
+
+	if command == "remove":
+		if not flask.request.form.get("seriously") == "1":
+			return make_page("bulkseriously.html", torrents=torrents,
+				warning="Are you sure you want to remove these "
+				"%d torrents?" % len(torrents))
+		failed = set(utils.remove_torrents([torrent["id"]
+			for torrent in torrents]))
+		database.del_torrents([torrent["info_hash"] for torrent in
+			torrents if not torrent["id"] in failed])
+		snapshots.update({torrent["id"]: None for torrent in torrents
+			if not torrent["id"] in failed})
+	else:
+		actions = {torrent["id"]: command for torrent in torrents if
+			TORRENT_ACTIONS.get(torrent["state"]) == command}
+		failed = set(utils.do_torrent_actions(actions))
+		snapshots.update({id: {"state": TORRENT_ACTION_STATES[command]}
+			for id in actions if not id in failed})
+	scheduler.refresh()
+	return flask.redirect(flask.url_for("index"))
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
 	if is_authenticated():
@@ -267,7 +579,18 @@ def login():
 	elif flask.request.method == "POST":
 		username = flask.request.form["username"]
 		password = flask.request.form["password"]
-		if database.authenticate(username, password):
+		try:
+			authenticated = logins.authenticate(username, password,
+				flask.request.remote_addr)
+		except Login.Throttled:
+			return make_page("login.html", loginfailed=True,
+				warning="Too many failed logins, try again later."
+				), 429
+		except Login.Busy:
+			return make_page("login.html", loginfailed=True,
+				warning="Too many logins in progress, try again."
+				), 503
+		if authenticated:
 			session = database.make_session()
 			database.add_session(username, session)
 			response = flask.make_response(
@@ -299,8 +622,7 @@ def settings():
 		"id", ""))
 	if not id.isdigit():
 		id = None
-	own_id = database.id_from_session(flask.request.cookies[
-		"btpd-session"])
+	own_id = user_id()
 	if not id:
 		id = own_id
 	username = database.username_from_id(id)
@@ -347,6 +669,7 @@ def settings():
 				saved = True
 		if saved:
 			settings = database.get_all_settings(username)
+			flask.g.pop("auth", None)
 	return make_page("settings.html", settings=settings,
 		username=username, id=id, admin=admin, error=error,
 		saved=saved)
@@ -355,16 +678,13 @@ def settings():
 def users():
 	if not is_admin():
 		return login_redirect()
-	users = database.list_users()
-	for i, user in enumerate(users):
-		user_dict = {}
-		user_dict["id"] = user[0]
-		user_dict["username"] = user[1]
-		user_dict["admin"] = "✓" if user[2] == 1 else "✘"
-		user_dict["torrent_count"] = database.torrent_count(
-			user_dict["id"])
-		users[i] = user_dict
-	return make_page("users.html", users=users)
+	current = snapshots.current
+	users = database.list_users_with_counts()
+	for user in users:
+		user["admin"] = "✓" if user["admin"] else "✘"
+		user["stats"] = current.owner_stats(user["id"])
+	return make_page("users.html", users=users,
+		total=current.owner_stats())
 
 @app.route("/adduser", methods=["GET", "POST"])
 def add_user():
@@ -416,6 +736,8 @@ def view():
 	if not "id" in flask.request.args:
 		flask.abort(400, description=ERROR_NO_ID)
 	id = flask.request.args["id"]
+	current = snapshots.current
+	torrent_list = current.torrents
 	if not id.isdigit() or not int(id) in torrent_list:
 		flask.abort(400, description=ERROR_INVALID_ID)
 	id = int(id)
@@ -424,36 +746,228 @@ def view():
 		return flask.abort(401, description=
 			ERROR_ACTION_UNAUTHORISED)
 	torrent = torrent_list[id]
-	return make_page("view.html", torrent=torrent)
+	files_page = flask.request.args.get("files", "")
+	files_page = max(int(files_page) if files_page.isdigit() else 1, 1)-1
+	def render():
+		per_page = app.config.get("FILES_PER_PAGE", 100)
+		metadata = metainfo.get(torrent["info_hash"], utils.metainfo_path(
+			id, torrent["info_hash"]))
+		files = []
+		file_pages = 0
+		if metadata:
+			file_pages = -(-metadata.file_count//per_page)
+			files = [(path, Btpd.pretty_size(length)) for path, length in
+				metadata.files(per_page*files_page, per_page*(files_page+1))]
+		return flask.render_template("view.html", torrent=torrent,
+			history=history.sparklines(torrent["info_hash"]),
+			metadata=metadata, files=files, files_page=files_page,
+			file_pages=file_pages, piece_length=Btpd.pretty_size(
+			metadata.piece_length) if metadata else None)
+	return make_page("view.html", html=fragments.get(current.version,
+		("view", id, history.epoch, history.version, files_page), render,
+		current.epoch))
+
+@app.route("/stats")
+def stats():
+	if not is_admin():
+		return login_redirect()
+	current = snapshots.current
+	states = collections.Counter(torrent["state"] for torrent in
+		current.torrents.values())
+	counts = daemon_counts()
+	return make_page("stats.html", total=current.owner_stats(),
+		states=sorted(states.items()), users=len(current.owners),
+		history=history.sparklines(None), tracked=len(history.rows),
+		memory=Btpd.pretty_size(history.memory()),
+		cache=fragments.stats(), metainfo=metainfo.stats(),
+		daemons=[(daemon.btpd_dir, counts[daemon.index]) for daemon in
+		utils.daemons] if len(utils.daemons) > 1 else [])
+
+@app.route("/metrics")
+def metrics_page():
+	if not metrics.enabled:
+		flask.abort(404)
+	token = app.config.get("METRICS_TOKEN")
+	if not is_admin() and not (token and hmac.compare_digest(
+			flask.request.headers.get("Authorization", ""),
+			"Bearer %s" % token)):
+		flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	if ROLE:
+		text = metrics.render(shared_processes(), PROCESS)
+	else:
+		text = metrics.render()
+	return flask.Response(text, mimetype="text/plain; version=0.0.4")
+
+@app.route("/traces")
+def traces():
+	if not is_admin():
+		return login_redirect()
+	if not tracer.enabled:
+		flask.abort(404)
+	count = flask.request.args.get("count", "")
+	count = int(count) if count.isdigit() else app.config.get(
+		"TRACE_VIEW", 50)
+	traces = Trace.read(Trace.trace_files(trace_path), count)
+	for trace in traces:
+		trace["when"] = datetime.datetime.fromtimestamp(trace["time"]
+			).strftime("%Y-%m-%d %H:%M:%S")
+		trace["kinds"] = collections.Counter(event[0] for event in
+			trace["events"])
+	return make_page("traces.html", traces=traces)
+
+@app.route("/api/torrents")
+def api_torrents():
+	if not is_authenticated():
+		flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	admin = is_admin()
+	current = snapshots.current
+	etag = snapshot_etag(current, admin, user_id())
+	if etag in flask.request.if_none_match:
+		return not_modified(etag)
+
+	owner = list_owner(admin)
+	sort = flask.request.args.get("sort", "id").lower()
+	if not sort in current.columns:
+		flask.abort(400, description="Unknown sort column.")
+	descending = not flask.request.args.get("order", "desc"
+		).lower() == "asc"
+	per_page = flask.request.args.get("per_page", "")
+	per_page = min(int(per_page) if per_page.isdigit() else
+		app.config["PER_PAGE"], API_MAX_PER_PAGE) or 1
+	page = flask.request.args.get("page", "")
+	page = max(int(page) if page.isdigit() else 1, 1)-1
 
+	total, torrents = list_torrents(current, sort, descending, owner,
+		per_page*page, per_page*(page+1))
+	return json_response({"version": current.version, "total": total,
+		"page": page+1, "per_page": per_page, "torrents": [dict(
+		torrent) for torrent in torrents]}, etag)
+
+@app.route("/api/torrent")
+def api_torrent():
+	if not is_authenticated():
+		flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	id = flask.request.args.get("id", "")
+	current = snapshots.current
+	if not id.isdigit() or not int(id) in current:
+		flask.abort(404, description=ERROR_INVALID_ID)
+	torrent = current.get(int(id))
+	admin = is_admin()
+	if not admin and not user_id() == torrent["owner"]:
+		flask.abort(401, description=ERROR_ACTION_UNAUTHORISED)
+	etag = snapshot_etag(current, admin, user_id())
+	if etag in flask.request.if_none_match:
+		return not_modified(etag)
+	return json_response({"version": current.version, "torrent":
+		dict(torrent)}, etag)
+
+@app.route("/api/history")
+def api_history():
+	# per-torrent history for its owner, everything for admins
+	if not is_authenticated():
+		flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	id = flask.request.args.get("id")
+	key = None
+	if id is None:
+		if not is_admin():
+			flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	else:
+		current = snapshots.current
+		if not id.isdigit() or not int(id) in current:
+			flask.abort(404, description=ERROR_INVALID_ID)
+		torrent = current.get(int(id))
+		if not is_admin() and not user_id() == torrent["owner"]:
+			flask.abort(401, description=ERROR_ACTION_UNAUTHORISED)
+		key = torrent["info_hash"]
+	response = flask.jsonify({"fields": History.FIELDS,
+		"tiers": history.series(key) or []})
+	response.headers["Cache-Control"] = "private, no-cache"
+	return response
+
+@app.route("/stream")
+def stream():
+	if not is_authenticated():
+		flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	owner = None if is_admin() else user_id()
+	# "<epoch>-<version>", as in snapshot_position()
+	position = flask.request.headers.get("Last-Event-ID",
+		flask.request.args.get("version", "")).split("-")
+	if len(position) == 2 and all(part.isdigit() for part in position):
+		epoch, version = (int(part) for part in position)
+	else:
+		epoch, version = snapshots.epoch, snapshots.current.version
+	def events(version):
+		while True:
+			scheduler.touch()
+			deltas = snapshots.wait(version, STREAM_HEARTBEAT, epoch)
+			if deltas is None:
+				yield "event: reset\ndata: {}\n\n"
+				return
+			elif not deltas:
+				yield ": heartbeat\n\n"
+				continue
+			changed = {}
+			removed = set()
+			for delta in deltas:
+				delta_changed, delta_removed = delta.visible(owner)
+				for torrent in delta_changed:
+					changed[torrent["id"]] = torrent
+					removed.discard(torrent["id"])
+				for id in delta_removed:
+					changed.pop(id, None)
+					removed.add(id)
+			version = deltas[-1].version
+			if changed or removed:
+				yield "id: %d-%d\nevent: delta\ndata: %s\n\n" % (
+					epoch, version, json.dumps({"changed": [{field:
+					torrent[field] for field in STREAM_FIELDS}
+					for torrent in changed.values()], "removed":
+					sorted(removed)}))
+	return flask.Response(events(version), mimetype=
+		"text/event-stream", headers={"Cache-Control": "no-cache",
+		"X-Accel-Buffering": "no"})
+
+def log_daemon():
+	daemon = flask.request.args.get("daemon", "")
+	if daemon.isdigit() and int(daemon) < len(utils.daemons):
+		return int(daemon)
+	return 0
 @app.route("/log")
 def log():
+	if not is_admin():
+		return login_redirect()
 	lines = None
 	if flask.request.args.get("lines") and flask.request.args[
 			"lines"].isdigit():
 		lines = int(flask.request.args["lines"])
-	loglines = utils.get_log(lines)
-	return make_page("log.html", lines=loglines)
+	loglines = utils.get_log(lines, log_daemon())
+	return make_page("log.html", lines=loglines, daemon=log_daemon(),
+		daemons=len(utils.daemons))
+
+@app.route("/log/stream")
+def log_stream():
+	if not is_admin():
+		flask.abort(401, description=ERROR_ACCESS_UNAUTHORISED)
+	daemon = log_daemon()
+	def events():
+		idle = 0
+		for lines in utils.follow_log(daemon=daemon):
+			if lines:
+				idle = 0
+				yield "event: lines\ndata: %s\n\n" % json.dumps(lines)
+			else:
+				idle += 1
+				if idle >= STREAM_HEARTBEAT:
+					idle = 0
+					yield ": heartbeat\n\n"
+	return flask.Response(events(), mimetype="text/event-stream",
+		headers={"Cache-Control": "no-cache",
+		"X-Accel-Buffering": "no"})
 
 if __name__ == "__main__":
-	import ssl
-	tls_context = None
-	if app.config.get("TLS", False):
-		assert "TLS_CERT" in app.config, ("No TLS certificate "
-			"specified.")
-		assert "TLS_KEY" in app.config, "No TLS key specified."
-		tls_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-		tls_context.options = (ssl.OP_CIPHER_SERVER_PREFERENCE|
-			ssl.OP_SINGLE_DH_USE|ssl.OP_SINGLE_ECDH_USE|
-			ssl.OP_NO_COMPRESSION)
-		tls_context.load_cert_chain(app.config["TLS_CERT"],
-			app.config["TLS_KEY"])
-		if "TLS_CIPHERS" in app.config:
-			tls_context.set_ciphers(app.config[
-				"TLS_CIPHERS"])
 	bindhost = app.config.get("BINDHOST", "127.0.0.1")
 	port = app.config.get("PORT", 5000)
 	debug = app.config.get("DEBUG", False)
 	list_thread.start()
 	app.run(host=bindhost, port=port, debug=debug,
-		ssl_context=tls_context)
+		ssl_context=Utils.tls_context(app.config))
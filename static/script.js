@@ -2,8 +2,53 @@ $(document).ready(function() {
 	if ($("#takefocus").length) {
 		$("#takefocus").focus();
 	}
+	$("#selectall").change(function() {
+		$(".torrent .torrentselect input").prop("checked",
+			$(this).prop("checked"));
+	});
+	if ($(".torrents").length && window.EventSource) {
+		var version = $(".torrents").data("version");
+		var source = new EventSource("stream?version=" + version);
+		source.addEventListener("delta", function(e) {
+			var delta = JSON.parse(e.data);
+			$.each(delta.changed, function(i, torrent) {
+				updateTorrentRow(torrent);
+			});
+			$.each(delta.removed, function(i, id) {
+				$("#torrent" + id).remove();
+			});
+		});
+		source.addEventListener("reset", function(e) {
+			source.close();
+			window.location.reload();
+		});
+	}
+	if ($("table.log").length && window.EventSource) {
+		var logSource = new EventSource("log/stream" + window.location.search);
+		logSource.addEventListener("lines", function(e) {
+			$.each(JSON.parse(e.data), function(i, line) {
+				$("table.log").prepend($("<tr>").append(
+					$("<td>").text(line)));
+			});
+		});
+	}
 });
 
+function updateTorrentRow(torrent) {
+	var row = $("#torrent" + torrent.id);
+	if (!row.length) {
+		return;
+	}
+	row.find(".torrentname").attr("title", torrent.title);
+	row.find(".torrentname a").text(torrent.title);
+	row.find(".torrentstatus a").attr("class", "state" + torrent.state
+		).text(torrent.state);
+	row.find(".torrentpercent").text(torrent.pretty_percent);
+	row.find(".torrentsize").text(torrent.pretty_size);
+	row.find(".torrentratio").text(torrent.pretty_ratio);
+	row.find(".torrentowner").text(torrent.uploader);
+}
+
 $(document).keydown(function(e) {
 	var target = e.target.tagName.toLowerCase();
 	if (target != "input") {
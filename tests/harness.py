@@ -0,0 +1,54 @@
+import atexit, os, shutil, sys, tempfile, threading, time
+import Benchmark, FakeBtpd
+
+# main.py reads Config when it's imported, so the tests that need the app
+# share one import of it, polling one fake btpd, with its database in a
+# scratch directory.
+
+fake = None
+
+def load_main():
+	global fake
+	if "main" in sys.modules:
+		return sys.modules["main"]
+	work = tempfile.mkdtemp()
+	atexit.register(shutil.rmtree, work, True)
+	btpd_dir = os.path.join(work, "btpd")
+	os.mkdir(btpd_dir)
+	fake = FakeBtpd.FakeBtpd(btpd_dir)
+	thread = threading.Thread(target=fake.serve_forever)
+	thread.daemon = True
+	thread.start()
+	for _ in range(200):
+		if os.path.exists(os.path.join(btpd_dir, "sock")):
+			break
+		time.sleep(0.01)
+	main = Benchmark.load_main(work, [btpd_dir], "ipc")
+	for daemon in main.utils.daemons:
+		# there's no btcli to fall back to
+		daemon.btcli = daemon.backend
+	return main
+
+def reset(main, count, seed=0):
+	# the fake btpd back to `count` fresh torrents, all root's, polled
+	with fake.lock:
+		fake.torrents.clear()
+		fake.next_num = 1
+	fake.populate(count, seed)
+	main.poll_torrent_list()
+	return main.snapshots.current
+
+def add_user(main, username, admin=False):
+	# a user with a session, and that session's cookie
+	database = main.database
+	if not database.has_username(username):
+		database.add_user(username, "password", admin)
+	session = database.make_session()
+	database.add_session(username, session)
+	return session
+
+def client(main, session=None):
+	client = main.app.test_client()
+	if session:
+		client.set_cookie("btpd-session", session)
+	return client
@@ -0,0 +1,94 @@
+import unittest
+import harness
+
+class ApiTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		current = harness.reset(self.main, 5)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"apiuser"))
+		# one torrent of the five is the user's
+		self.own = current.ordered("id")[0]
+		self.main.database.add_torrent(current.get(self.own)["info_hash"],
+			"apiuser")
+		self.main.poll_torrent_list()
+
+	def change(self):
+		with harness.fake.lock:
+			torrent = harness.fake.torrents[max(harness.fake.torrents)]
+			torrent.peers += 1
+		self.main.poll_torrent_list()
+
+	def test_unauthenticated(self):
+		client = harness.client(self.main)
+		self.assertEqual(client.get("/api/torrents").status_code, 401)
+		self.assertEqual(client.get("/api/torrent?id=%d" % self.own
+			).status_code, 401)
+
+	def test_list(self):
+		response = self.root.get("/api/torrents?sort=name&order=asc")
+		self.assertEqual(response.status_code, 200)
+		data = response.get_json()
+		self.assertEqual(data["version"], self.main.snapshots.current.version)
+		self.assertEqual(data["total"], 5)
+		names = [torrent["name"] for torrent in data["torrents"]]
+		self.assertEqual(names, sorted(names))
+		response = self.user.get("/api/torrents")
+		self.assertEqual([torrent["id"] for torrent in response.get_json(
+			)["torrents"]], [self.own])
+		self.assertEqual(self.root.get("/api/torrents?sort=nothing"
+			).status_code, 400)
+
+	def test_pages(self):
+		data = self.root.get("/api/torrents?sort=id&order=asc&per_page=2"
+			"&page=3").get_json()
+		self.assertEqual((data["total"], data["page"], data["per_page"]),
+			(5, 3, 2))
+		self.assertEqual([torrent["id"] for torrent in data["torrents"]],
+			list(self.main.snapshots.current.ordered("id")[4:]))
+
+	def test_not_modified(self):
+		response = self.root.get("/api/torrents")
+		etag = response.headers["ETag"]
+		response = self.root.get("/api/torrents", headers={
+			"If-None-Match": etag})
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response.headers["ETag"], etag)
+		self.assertEqual(response.data, b"")
+		# other users see something else for the same snapshot
+		response = self.user.get("/api/torrents", headers={
+			"If-None-Match": etag})
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response.headers["ETag"], etag)
+
+	def test_modified_after_a_change(self):
+		etag = self.root.get("/api/torrents").headers["ETag"]
+		self.main.poll_torrent_list()
+		self.assertEqual(self.root.get("/api/torrents", headers={
+			"If-None-Match": etag}).status_code, 304)
+		self.change()
+		response = self.root.get("/api/torrents", headers={
+			"If-None-Match": etag})
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response.headers["ETag"], etag)
+
+	def test_torrent(self):
+		url = "/api/torrent?id=%d" % self.own
+		response = self.user.get(url)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()["torrent"]["id"], self.own)
+		response = self.user.get(url, headers={"If-None-Match":
+			response.headers["ETag"]})
+		self.assertEqual(response.status_code, 304)
+		other = self.main.snapshots.current.ordered("id")[1]
+		self.assertEqual(self.user.get("/api/torrent?id=%d" % other
+			).status_code, 401)
+		self.assertEqual(self.root.get("/api/torrent?id=%d" % other
+			).status_code, 200)
+		self.assertEqual(self.root.get("/api/torrent?id=x").status_code,
+			404)
+
+if __name__ == "__main__":
+	unittest.main()
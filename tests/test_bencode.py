@@ -0,0 +1,98 @@
+import hashlib, os, unittest
+import Bencode, Cache
+
+# info dicts written out by hand, and the sha1 of exactly those bytes
+SINGLE_INFO = (b"d6:lengthi1048576e4:name8:file.bin12:piece lengthi262144e"
+	b"6:pieces80:"+bytes(range(80))+b"e")
+SINGLE_HASH = "589cc803dbcf24d786b08e8d8d39eb0719d3a572"
+MULTI_INFO = (b"d5:filesld6:lengthi100e4:pathl3:sub5:a.txteed6:lengthi2500e"
+	b"4:pathl5:b.bineee4:name5:album12:piece lengthi16384e6:pieces40:"+
+	bytes(range(100, 140))+b"e")
+MULTI_HASH = "b023dade744535755e274cfb69377009ea251a78"
+# name isn't utf-8 but name.utf-8 is
+UTF8_INFO = (b"d6:lengthi7e4:name4:\xe9t\xe9_10:name.utf-89:caf\xc3\xa9.txt"
+	b"12:piece lengthi16384e6:pieces20:"+bytes(20)+b"e")
+UTF8_HASH = "7f45681f09394c1aa833017ba3c89ed8bd2fa3bf"
+# keys out of order: the hash is of the bytes as they are, not of the
+# dict encoded again
+UNSORTED_INFO = b"d4:name1:x6:lengthi1e12:piece lengthi1e6:pieces0:e"
+UNSORTED_HASH = "38439518e78bc271fcbd8c48f45ff0dfe1733c47"
+
+def make_torrent(info):
+	return (b"d8:announce31:http://tracker.example/announce"
+		b"13:creation datei1700000000e4:info"+info+b"e")
+
+class InfoHashTest(unittest.TestCase):
+	def test_reference_hashes(self):
+		for info, expected in [(SINGLE_INFO, SINGLE_HASH), (MULTI_INFO,
+				MULTI_HASH), (UTF8_INFO, UTF8_HASH), (UNSORTED_INFO,
+				UNSORTED_HASH)]:
+			data = make_torrent(info)
+			self.assertEqual(Bencode.info_hash(data), expected)
+			self.assertEqual(Bencode.Metainfo(data).info_hash, expected)
+
+	def test_single_file(self):
+		metainfo = Bencode.Metainfo(make_torrent(SINGLE_INFO))
+		self.assertEqual(metainfo.name, "file.bin")
+		self.assertEqual(metainfo.files, [("file.bin", 1048576)])
+		self.assertEqual(metainfo.size, 1048576)
+		self.assertEqual(metainfo.piece_length, 262144)
+		self.assertEqual(metainfo.piece_count, 4)
+		self.assertEqual(metainfo.get(b"creation date"), 1700000000)
+
+	def test_multi_file(self):
+		metainfo = Bencode.Metainfo(make_torrent(MULTI_INFO))
+		self.assertEqual(metainfo.name, "album")
+		self.assertEqual(metainfo.files, [(os.path.join("album", "sub",
+			"a.txt"), 100), (os.path.join("album", "b.bin"), 2500)])
+		self.assertEqual(metainfo.size, 2600)
+		self.assertEqual(metainfo.piece_count, 2)
+		metadata = Cache.Metadata(metainfo)
+		self.assertEqual(metadata.files(0, 2), [(os.path.join("sub",
+			"a.txt"), 100), ("b.bin", 2500)])
+
+	def test_name_utf8(self):
+		metainfo = Bencode.Metainfo(make_torrent(UTF8_INFO))
+		self.assertEqual(metainfo.name, "caf\xe9.txt")
+		self.assertEqual(metainfo.files, [("caf\xe9.txt", 7)])
+
+	def test_round_trip(self):
+		value = {b"a": [1, -2, b"x", {b"b": b""}], b"c": 0}
+		self.assertEqual(Bencode.decode(Bencode.encode(value)), value)
+		self.assertEqual(Bencode.encode({"b": 1, "a": "\xe9"}),
+			b"d1:a2:\xc3\xa91:bi1ee")
+		self.assertEqual(Bencode.skip(b"li1ed1:ale0:ee4:spam"), 14)
+
+class MalformedTest(unittest.TestCase):
+	# none of these are a torrent; all but the last three aren't even
+	# bencoding
+	MALFORMED = [b"", b"i12", b"ie", b"i1x2e", b"5:ab", b"x", b"l",
+		b"li1e", b"d", b"d3:foo", b"d3:fooi1e", b"di1ei2ee", b"-1:a",
+		b"e", b"1a:b", b"d4:infod4:name", b"d4:infol1:xee", b"d4:infoi1ee",
+		b"le"]
+
+	def test_decode(self):
+		for data in self.MALFORMED[:-3]+[b"i1ei2e", b"le ", b"i-e"]:
+			with self.assertRaises(Bencode.BencodeError, msg=data):
+				Bencode.decode(data)
+
+	def test_info_hash(self):
+		for data in self.MALFORMED:
+			with self.assertRaises(Bencode.BencodeError, msg=data):
+				Bencode.info_hash(data)
+
+	def test_metainfo(self):
+		for data in self.MALFORMED:
+			with self.assertRaises(Bencode.BencodeError, msg=data):
+				Bencode.Metainfo(data)
+
+	def test_truncated(self):
+		data = make_torrent(MULTI_INFO)
+		for length in range(len(data)):
+			with self.assertRaises(Bencode.BencodeError, msg=length):
+				Bencode.info_hash(data[:length])
+			with self.assertRaises(Bencode.BencodeError, msg=length):
+				Bencode.Metainfo(data[:length])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,189 @@
+import os, shutil, socket, tempfile, threading, time, unittest
+import Bencode, Btpd, FakeBtpd, Utils
+
+def wait_for_socket(path):
+	for _ in range(200):
+		if os.path.exists(path):
+			return
+		time.sleep(0.01)
+	raise RuntimeError("%s never appeared" % path)
+
+class ScriptedBtpd(object):
+	# answers each request with the next of `responses` (bytes, sent as
+	# they are), closing the connection after each one when `drop`
+	def __init__(self, path, responses, drop=False):
+		self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.server.bind(path)
+		self.server.listen(4)
+		self.responses = list(responses)
+		self.drop = drop
+		self.requests = []
+		self.connections = 0
+		thread = threading.Thread(target=self.serve)
+		thread.daemon = True
+		thread.start()
+	def serve(self):
+		while self.responses:
+			connection, _ = self.server.accept()
+			self.connections += 1
+			with connection:
+				while self.responses:
+					header = connection.recv(Btpd.LENGTH.size,
+						socket.MSG_WAITALL)
+					if not header:
+						break
+					size, = Btpd.LENGTH.unpack(header)
+					self.requests.append(Bencode.decode(connection.recv(
+						size, socket.MSG_WAITALL)))
+					response = self.responses.pop(0)
+					connection.sendall(Btpd.LENGTH.pack(len(response))+
+						response)
+					if self.drop:
+						break
+	def close(self):
+		self.server.close()
+
+class ClientTest(unittest.TestCase):
+	def setUp(self):
+		self.btpd_dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.btpd_dir, "sock")
+		self.addCleanup(shutil.rmtree, self.btpd_dir)
+		self.client = Btpd.Client(self.btpd_dir, timeout=5)
+		self.addCleanup(self.client.close)
+	def start_fake(self):
+		fake = FakeBtpd.FakeBtpd(self.btpd_dir)
+		thread = threading.Thread(target=fake.serve_forever)
+		thread.daemon = True
+		thread.start()
+		wait_for_socket(self.path)
+		self.addCleanup(thread.join)
+		self.addCleanup(fake.server.shutdown)
+		return fake
+
+	def test_tget(self):
+		fake = self.start_fake()
+		fake.populate(2, seed=1)
+		first = fake.torrents[1]
+		first.name = "caf\xe9"
+		results = self.client.tget([Btpd.TVAL_NUM, Btpd.TVAL_NAME,
+			Btpd.TVAL_IHASH, Btpd.TVAL_CSIZE], [1, 99, 2])
+		self.assertEqual(results[0], {Btpd.TVAL_NUM: 1, Btpd.TVAL_NAME:
+			"caf\xe9", Btpd.TVAL_IHASH: first.info_hash, Btpd.TVAL_CSIZE:
+			first.size})
+		# a torrent btpd doesn't have
+		self.assertIsNone(results[1])
+		self.assertEqual(results[2][Btpd.TVAL_NUM], 2)
+
+	def test_list(self):
+		fake = self.start_fake()
+		fake.populate(3, seed=2)
+		torrent = fake.torrents[2]
+		torrent.state = 4
+		torrent.size = 1000
+		torrent.got = 505
+		torrent.total_up = 1505
+		torrent.total_down = 505
+		torrent.peers = 7
+		torrent.rate_up = 2048
+		torrent.rate_down = 1024
+		torrents = self.client.list()
+		self.assertEqual([torrent.id for torrent in torrents], [1, 2, 3])
+		listed = torrents[1]
+		self.assertEqual((listed.title, listed.name, listed.state,
+			listed.info_hash, listed.size, listed.percent, listed.ratio,
+			listed.peers, listed.upload_rate, listed.download_rate,
+			listed.uploaded_bytes, listed.downloaded_bytes,
+			listed.total_pieces), ("synthetic torrent 2",
+			"synthetic torrent 2", "S", torrent.info_hash.hex(), 1000,
+			50.5, 1.5, 7, 2048, 1024, 1505, 505, torrent.piece_count))
+
+	def test_error_code(self):
+		self.start_fake()
+		with self.assertRaises(Btpd.BtpdError) as raised:
+			self.client.start(99)
+		self.assertEqual(raised.exception.code, 8)
+
+	def test_add_and_delete(self):
+		fake = self.start_fake()
+		torrent = Bencode.encode({"info": {"name": "x", "length": 5,
+			"piece length": 16384, "pieces": bytes(20)}})
+		id = self.client.add("/tmp", torrent)
+		self.assertEqual(fake.torrents[id].name, "x")
+		self.client.delete(id)
+		self.assertEqual(fake.torrents, {})
+
+	def test_reconnects_when_dropped(self):
+		ok = Bencode.encode({"code": Btpd.IPC_OK})
+		server = ScriptedBtpd(self.path, [ok, ok, ok], drop=True)
+		self.addCleanup(server.close)
+		self.client.start(1)
+		self.client.stop(2)
+		self.client.delete(3)
+		self.assertEqual(server.connections, 3)
+		self.assertEqual(server.requests, [[b"start", 1], [b"stop", 2],
+			[b"del", 3]])
+
+	def test_gives_up_after_one_reconnect(self):
+		self.client.timeout = 0.5
+		with self.assertRaises(OSError):
+			self.client.start(1)
+		self.assertIsNone(self.client.socket)
+
+	def test_malformed_response(self):
+		server = ScriptedBtpd(self.path, [b"not bencoding",
+			Bencode.encode({"nocode": 0}), Bencode.encode([1])])
+		self.addCleanup(server.close)
+		for _ in range(3):
+			with self.assertRaises(Btpd.ProtocolError):
+				self.client.start(1)
+
+class FailingBackend(object):
+	def __init__(self, error):
+		self.error = error
+	def get_torrent_list(self, timer=Utils.no_timer):
+		raise self.error
+class RecordingBtcli(object):
+	def __init__(self):
+		self.calls = []
+	def get_torrent_list(self, timer=Utils.no_timer):
+		self.calls.append("get_torrent_list")
+		return ["from btcli"]
+
+class DaemonTest(unittest.TestCase):
+	def make_daemon(self, error):
+		daemon = Utils.Daemon(0, "/nonexistent", "ipc")
+		daemon.backend = FailingBackend(error)
+		daemon.btcli = RecordingBtcli()
+		return daemon
+
+	def test_falls_back_to_btcli(self):
+		for error in [ConnectionRefusedError(), FileNotFoundError(),
+				Btpd.ProtocolError("malformed")]:
+			daemon = self.make_daemon(error)
+			self.assertEqual(daemon.call("get_torrent_list"), [
+				"from btcli"])
+			self.assertEqual(daemon.btcli.calls, ["get_torrent_list"])
+
+	def test_btpd_errors_are_not_retried(self):
+		daemon = self.make_daemon(Btpd.BtpdError(8))
+		with self.assertRaises(Btpd.BtpdError):
+			daemon.call("get_torrent_list")
+		self.assertEqual(daemon.btcli.calls, [])
+
+	def test_unreachable_socket(self):
+		# a real ipc backend with no btpd behind it
+		btpd_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, btpd_dir)
+		daemon = Utils.Daemon(0, btpd_dir, "ipc")
+		daemon.btcli = RecordingBtcli()
+		self.assertEqual(daemon.call("get_torrent_list"), ["from btcli"])
+
+	def test_btcli_backend_raises(self):
+		daemon = Utils.Daemon(0, "/nonexistent", "btcli")
+		daemon.backend = daemon.btcli = FailingBackend(
+			ConnectionRefusedError())
+		with self.assertRaises(ConnectionRefusedError):
+			daemon.call("get_torrent_list")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,187 @@
+import os, shutil, tempfile, unittest, unittest.mock
+import Bencode, Cache
+import harness
+
+def make_torrent(name, lengths):
+	# a multi-file .torrent with a file of each length
+	return Bencode.encode({b"info": {b"name": name.encode("utf8"),
+		b"piece length": 16384, b"pieces": bytes(20), b"files": [{
+		b"length": length, b"path": [b"dir", b"%d.bin" % n]} for n,
+		length in enumerate(lengths)]}})
+
+class FragmentCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.cache = Cache.FragmentCache(size=2)
+		self.renders = []
+
+	def get(self, version, key, epoch=0):
+		def render():
+			self.renders.append((epoch, version, key))
+			return "%d-%d-%s" % (epoch, version, key)
+		return self.cache.get(version, key, render, epoch)
+
+	def test_rendered_once_per_version(self):
+		self.assertEqual(self.get(1, "a"), "0-1-a")
+		self.assertEqual(self.get(1, "a"), "0-1-a")
+		self.assertEqual(self.renders, [(0, 1, "a")])
+		self.assertEqual(self.get(2, "a"), "0-2-a")
+		self.assertEqual(self.get(2, "a"), "0-2-a")
+		self.assertEqual(len(self.renders), 2)
+		self.assertEqual(self.cache.stats(), {"hits": 2, "misses": 2,
+			"entries": 1, "version": 2})
+
+	def test_older_versions_are_not_kept(self):
+		self.get(2, "a")
+		self.assertEqual(self.get(1, "a"), "0-1-a")
+		self.assertEqual(self.get(1, "a"), "0-1-a")
+		self.assertEqual(self.get(2, "a"), "0-2-a")
+		self.assertEqual(self.renders, [(0, 2, "a"), (0, 1, "a"), (0, 1,
+			"a")])
+
+	def test_epochs(self):
+		self.get(5, "a", epoch=1)
+		# a restarted poller counts from the start again
+		self.assertEqual(self.get(1, "a", epoch=2), "2-1-a")
+		self.assertEqual(self.get(1, "a", epoch=2), "2-1-a")
+		self.assertEqual(len(self.renders), 2)
+		self.assertEqual(self.get(5, "a", epoch=1), "1-5-a")
+		self.assertEqual(len(self.renders), 3)
+
+	def test_least_recently_used_go(self):
+		for key in ["a", "b", "a", "c"]:
+			self.get(1, key)
+		self.assertEqual(list(self.cache.entries), ["a", "c"])
+
+	def test_failed_renders_are_not_kept(self):
+		def render():
+			raise ValueError("broken template")
+		with self.assertRaises(ValueError):
+			self.cache.get(1, "a", render)
+		self.assertEqual(self.get(1, "a"), "0-1-a")
+
+class PageCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		harness.reset(self.main, 4)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"cacheuser"))
+		self.fragments = self.main.fragments
+
+	def misses(self, client, url):
+		misses = self.fragments.misses
+		response = client.get(url)
+		self.assertEqual(response.status_code, 200)
+		return self.fragments.misses-misses, response.get_data(
+			as_text=True)
+
+	def test_list(self):
+		misses, page = self.misses(self.root, "/?orderby=1")
+		self.assertEqual(misses, 1)
+		self.assertEqual(self.misses(self.root, "/?orderby=1"), (0, page))
+		self.assertEqual(self.misses(self.root, "/?orderby=2")[0], 1)
+		# other users see other torrents
+		misses, user_page = self.misses(self.user, "/?orderby=1")
+		self.assertEqual(misses, 1)
+		self.assertNotEqual(user_page, page)
+		self.main.poll_torrent_list()
+		self.assertEqual(self.misses(self.root, "/?orderby=1")[0], 0)
+		with harness.fake.lock:
+			harness.fake.torrents[1].peers += 1
+		self.main.poll_torrent_list()
+		self.assertEqual(self.misses(self.root, "/?orderby=1")[0], 1)
+
+	def test_view(self):
+		self.assertEqual(self.misses(self.root, "/view?id=1")[0], 1)
+		self.assertEqual(self.misses(self.root, "/view?id=1")[0], 0)
+		self.assertEqual(self.misses(self.root, "/view?id=2")[0], 1)
+
+class MetainfoCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory, True)
+
+	def write(self, name, data):
+		path = os.path.join(self.directory, name)
+		with open(path, "wb") as file:
+			file.write(data)
+		return path
+
+	def test_read_once(self):
+		cache = Cache.MetainfoCache()
+		path = self.write("a", make_torrent("a", [1, 2]))
+		metadata = cache.get("a", path)
+		self.assertEqual(metadata.files(0, 2), [("dir/0.bin", 1), (
+			"dir/1.bin", 2)])
+		self.assertIs(cache.get("a", path), metadata)
+		self.assertEqual(cache.stats(), {"hits": 1, "misses": 1,
+			"entries": 1, "files": 2})
+
+	def test_changed_files_are_read_again(self):
+		cache = Cache.MetainfoCache()
+		path = self.write("a", make_torrent("a", [1]))
+		cache.get("a", path)
+		self.write("a", make_torrent("a", [1, 2, 3]))
+		self.assertEqual(cache.get("a", path).file_count, 3)
+		self.assertEqual(cache.stats()["files"], 3)
+
+	def test_unreadable(self):
+		cache = Cache.MetainfoCache()
+		self.assertIsNone(cache.get("a", os.path.join(self.directory,
+			"nothing")))
+		self.assertIsNone(cache.get("b", self.write("b", b"d4:infoi1ee")))
+		self.assertIsNone(cache.get("c", self.write("c", b"garbage")))
+		self.assertEqual(cache.stats()["entries"], 0)
+
+	def test_least_recently_used_go(self):
+		cache = Cache.MetainfoCache(size=2, max_files=5)
+		paths = {name: self.write(name, make_torrent(name, [1]*count))
+			for name, count in [("a", 1), ("b", 2), ("c", 1), ("d", 4),
+			("e", 9)]}
+		for name in ["a", "b", "a", "c"]:
+			cache.get(name, paths[name])
+		self.assertEqual(list(cache.entries), ["a", "c"])
+		# too many files between them
+		cache.get("d", paths["d"])
+		self.assertEqual(list(cache.entries), ["c", "d"])
+		cache.get("a", paths["a"])
+		self.assertEqual(list(cache.entries), ["d", "a"])
+		# more than the limit on its own is still kept, by itself
+		cache.get("e", paths["e"])
+		self.assertEqual(list(cache.entries), ["e"])
+		self.assertEqual(cache.stats()["files"], 9)
+
+class ViewFilesTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		harness.reset(self.main, 1)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.id = harness.fake.handle([b"add", {b"torrent": make_torrent(
+			"view", [100, 2500, 7]), b"content": b"/tmp"}])["num"]
+		self.main.poll_torrent_list()
+
+	def test_files(self):
+		page = self.root.get("/view?id=%d" % self.id).get_data(
+			as_text=True)
+		self.assertIn("3 files", page)
+		for path in ["dir/0.bin", "dir/1.bin", "dir/2.bin"]:
+			self.assertIn('<td class="filepath">%s</td>' % path, page)
+		self.assertNotIn("filepagesdiv", page)
+
+	def test_pages(self):
+		with unittest.mock.patch.dict(self.main.app.config, {
+				"FILES_PER_PAGE": 2}):
+			page = self.root.get("/view?id=%d&files=2" % self.id
+				).get_data(as_text=True)
+		self.assertNotIn("dir/0.bin", page)
+		self.assertIn('<td class="filepath">dir/2.bin</td>', page)
+		self.assertIn("<span>2/2</span>", page)
+
+	def test_no_metainfo(self):
+		page = self.root.get("/view?id=1").get_data(as_text=True)
+		self.assertNotIn("filepath", page)
+
+if __name__ == "__main__":
+	unittest.main()
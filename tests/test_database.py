@@ -0,0 +1,300 @@
+import os, shutil, sqlite3, tempfile, threading, unittest
+import unittest.mock
+import Database, harness
+
+# the cheapest costs scrypt takes, the tests make a few users
+SCRYPT_PARAMS = (2, 1, 1)
+
+def scratch(test):
+	# a database file in a directory the test cleans up
+	directory = tempfile.mkdtemp()
+	test.addCleanup(shutil.rmtree, directory, True)
+	return os.path.join(directory, "btpd-web.db")
+
+def make_database(test, location=None, **kwargs):
+	return Database.Database(scrypt_params=SCRYPT_PARAMS,
+		location=location or scratch(test), **kwargs)
+
+class OwnersTest(unittest.TestCase):
+	def setUp(self):
+		self.statements = []
+		self.database = make_database(self, observers=[
+			self.observe])
+		self.database.add_user("user", "password")
+		self.user = self.database.id_from_username("user")
+
+	def observe(self, frame, statement, seconds):
+		self.statements.append(statement)
+
+	def stored(self):
+		# what torrent_owners() would load if it started over
+		self.database.cursor().execute("""SELECT torrents.info_hash,
+			users.id, users.username FROM torrents JOIN users ON
+			torrents.user_id=users.id""")
+		return {info_hash: (id, username) for info_hash, id, username
+			in self.database.cursor().fetchall()}
+
+	def test_loaded_once(self):
+		self.database.add_torrent("a", "user")
+		self.assertEqual(self.database.torrent_owners(), {"a": (
+			self.user, "user")})
+		del self.statements[:]
+		self.database.torrent_owners()
+		self.assertEqual(self.statements, [])
+
+	def test_writes_keep_it_in_step(self):
+		self.database.torrent_owners()
+		self.database.add_torrent("a", "user")
+		self.database.add_torrent("b", "root")
+		self.database.add_torrent("a", "root")
+		self.database.del_torrent("b")
+		self.database.update_torrents(["c", "d", "a"], ["d"])
+		del self.statements[:]
+		self.assertEqual(self.database.torrent_owners(), {"a": (1,
+			"root"), "c": (1, "root")})
+		self.assertEqual(self.statements, [])
+		self.assertEqual(self.database.torrent_owners(), self.stored())
+
+	def test_adoptions_keep_their_owner(self):
+		self.database.add_torrent("a", "user")
+		self.database.torrent_owners()
+		self.database.update_torrents(["a", "b"], [])
+		self.assertEqual(self.database.torrent_owners(), {"a": (
+			self.user, "user"), "b": (1, "root")})
+		self.assertEqual(self.database.torrent_owners(), self.stored())
+
+	def test_nothing_to_do_runs_nothing(self):
+		self.database.torrent_owners()
+		del self.statements[:]
+		self.database.update_torrents([], [])
+		self.assertEqual(self.statements, [])
+
+	def test_batch_is_one_transaction(self):
+		self.database.update_torrents(["a", "b"], [])
+		self.database.torrent_owners()
+		def fail(frame, statement, seconds):
+			if statement.startswith("DELETE FROM torrents"):
+				self.database.observers.remove(fail)
+				raise OSError("disk gone")
+		self.database.observers.append(fail)
+		with self.assertRaises(OSError):
+			self.database.update_torrents(["c"], ["a"])
+		self.assertEqual(self.stored(), {"a": (1, "root"), "b": (1,
+			"root")})
+		self.assertEqual(self.database.torrent_owners(), self.stored())
+
+	def test_users_changing(self):
+		self.database.add_torrent("a", "user")
+		self.database.add_torrent("b", "root")
+		self.database.torrent_owners()
+		self.database.change_username("user", "renamed")
+		self.assertEqual(self.database.torrent_owners()["a"], (
+			self.user, "renamed"))
+		self.database.del_user(self.user)
+		self.assertEqual(self.database.torrent_owners(), {"b": (1,
+			"root")})
+		self.assertEqual(self.database.torrent_owners(), self.stored())
+
+class SessionsTest(unittest.TestCase):
+	def setUp(self):
+		self.statements = []
+		self.database = make_database(self, session_cache_size=2,
+			observers=[self.observe])
+		self.database.add_user("user", "password")
+		self.user = self.database.id_from_username("user")
+		self.session = self.start("user")
+
+	def observe(self, frame, statement, seconds):
+		self.statements.append(statement)
+
+	def start(self, username):
+		session = self.database.make_session()
+		self.database.add_session(username, session)
+		return session
+
+	def test_cached(self):
+		self.assertEqual(self.database.session_user(self.session),
+			Database.SessionUser(self.user, "user", False))
+		del self.statements[:]
+		self.database.session_user(self.session)
+		self.assertEqual(self.statements, [])
+		self.assertIsNone(self.database.session_user(None))
+		self.assertIsNone(self.database.session_user("nothing"))
+		self.assertNotIn("nothing", self.database.sessions)
+
+	def test_least_recently_used_go(self):
+		sessions = [self.session, self.start("user"), self.start("root")]
+		for session in sessions[:2]:
+			self.database.session_user(session)
+		self.database.session_user(sessions[0])
+		self.database.session_user(sessions[2])
+		self.assertEqual(list(self.database.sessions), [sessions[0],
+			sessions[2]])
+
+	def test_set_admin(self):
+		self.database.session_user(self.session)
+		self.database.set_admin(self.user, True)
+		self.assertTrue(self.database.session_user(self.session).admin)
+		# ids from forms are strings
+		self.database.set_admin(str(self.user), False)
+		self.assertFalse(self.database.session_user(self.session).admin)
+
+	def test_change_username(self):
+		self.database.session_user(self.session)
+		self.database.change_username("user", "renamed")
+		self.assertEqual(self.database.session_user(self.session
+			).username, "renamed")
+
+	def test_del_user(self):
+		root = self.start("root")
+		self.database.session_user(root)
+		self.database.session_user(self.session)
+		self.database.del_user(str(self.user))
+		self.assertIsNone(self.database.session_user(self.session))
+		self.assertIn(root, self.database.sessions)
+
+	def test_del_session(self):
+		self.database.session_user(self.session)
+		self.database.del_session(self.session)
+		self.assertIsNone(self.database.session_user(self.session))
+
+class MigrationsTest(unittest.TestCase):
+	def setUp(self):
+		self.location = scratch(self)
+
+	def version(self, database):
+		return database.cursor().execute("PRAGMA user_version"
+			).fetchone()[0]
+
+	def indexes(self, database):
+		database.cursor().execute(
+			"SELECT name FROM sqlite_master WHERE type='index'")
+		return set(name for name, in database.cursor().fetchall() if
+			not name.startswith("sqlite_"))
+
+	def test_new(self):
+		database = make_database(self, self.location)
+		self.assertEqual(self.version(database), len(Database.MIGRATIONS))
+		self.assertEqual(database.cursor().execute("PRAGMA journal_mode"
+			).fetchone()[0], "wal")
+		self.assertEqual(len(self.indexes(database)), 4)
+		self.assertTrue(database.has_username("root"))
+
+	def test_from_before_versions(self):
+		# a database from before migrations: the tables, but
+		# user_version still 0
+		old = sqlite3.connect(self.location, isolation_level=None)
+		for statement in Database.MIGRATIONS[0]:
+			old.execute(statement)
+		old.execute("""INSERT INTO users (id, username, hash, salt,
+			admin) VALUES (1, 'root', 'x', 'y', 1)""")
+		old.execute("INSERT INTO torrents VALUES ('a', 1)")
+		old.close()
+		database = make_database(self, self.location)
+		self.assertEqual(self.version(database), len(Database.MIGRATIONS))
+		self.assertEqual(len(self.indexes(database)), 4)
+		self.assertEqual(database.torrent_owners(), {"a": (1, "root")})
+
+	def test_only_whats_missing(self):
+		database = make_database(self, self.location)
+		database.add_user("user", "password")
+		statements = []
+		def observe(frame, statement, seconds):
+			statements.append(statement)
+		later = ["CREATE TABLE later (a)"]
+		with unittest.mock.patch.object(Database, "MIGRATIONS",
+				Database.MIGRATIONS+[later]):
+			database = make_database(self, self.location, observers=[
+				observe])
+		self.assertEqual(self.version(database), len(Database.MIGRATIONS
+			)+1)
+		for statement in Database.MIGRATIONS[-1]:
+			self.assertNotIn(statement, statements)
+		self.assertIn(later[0], statements)
+		self.assertTrue(database.has_username("user"))
+
+	def test_failures_roll_back(self):
+		make_database(self, self.location)
+		broken = ["CREATE TABLE later (a)", "NOT SQL"]
+		with unittest.mock.patch.object(Database, "MIGRATIONS",
+				Database.MIGRATIONS+[broken]):
+			with self.assertRaises(sqlite3.OperationalError):
+				make_database(self, self.location)
+		database = make_database(self, self.location)
+		self.assertEqual(self.version(database), len(Database.MIGRATIONS))
+		database.cursor().execute("SELECT name FROM sqlite_master")
+		self.assertNotIn(("later",), database.cursor().fetchall())
+
+class ConnectionsTest(unittest.TestCase):
+	def setUp(self):
+		self.database = make_database(self, pool_size=1)
+
+	def connection(self):
+		# the connection a new thread is given, which it gives back
+		# when it finishes
+		connections = []
+		def run():
+			self.database.cursor()
+			connections.append(self.database.connections.database)
+		thread = threading.Thread(target=run)
+		thread.start()
+		thread.join()
+		return connections[0]
+
+	def test_per_thread(self):
+		self.database.cursor()
+		self.assertIs(self.database.cursor(), self.database.cursor())
+		self.assertIsNot(self.connection(),
+			self.database.connections.database)
+
+	def test_reused(self):
+		first = self.connection()
+		self.assertEqual([database for database, cursor in
+			self.database.pool], [first])
+		self.assertIs(self.connection(), first)
+
+	def test_pool_is_bounded(self):
+		connections = []
+		ready = threading.Barrier(3)
+		def run():
+			self.database.cursor()
+			connections.append(self.database.connections.database)
+			ready.wait()
+		threads = [threading.Thread(target=run) for _ in range(2)]
+		for thread in threads:
+			thread.start()
+		ready.wait()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(len(self.database.pool), 1)
+		connections.remove(self.database.pool[0][0])
+		with self.assertRaises(sqlite3.ProgrammingError):
+			connections[0].execute("SELECT 1")
+
+class RouteSessionsTest(unittest.TestCase):
+	# a request made straight after an admin's change sees it
+	def setUp(self):
+		self.main = harness.load_main()
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.session = harness.add_user(self.main, "sessionuser", True)
+		self.user = harness.client(self.main, self.session)
+		self.id = self.main.database.id_from_username("sessionuser")
+
+	def tearDown(self):
+		if self.main.database.has_username("sessionuser"):
+			self.main.database.del_user(self.id)
+
+	def test_demoted(self):
+		self.assertEqual(self.user.get("/users").status_code, 200)
+		self.main.database.set_admin(self.id, False)
+		self.assertEqual(self.user.get("/users").status_code, 302)
+
+	def test_removed(self):
+		self.assertEqual(self.user.get("/api/torrents").status_code, 200)
+		self.assertEqual(self.root.get("/removeuser?id=%d&seriously=1" %
+			self.id).status_code, 302)
+		self.assertEqual(self.user.get("/api/torrents").status_code, 401)
+
+if __name__ == "__main__":
+	unittest.main()
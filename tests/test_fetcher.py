@@ -0,0 +1,209 @@
+import http.server, threading, time, unittest
+import Bencode, Fetcher
+
+def make_torrent(name):
+	return Bencode.encode({"announce": "http://tracker.example/announce",
+		"info": {"name": name, "length": 1, "piece length": 16384,
+		"pieces": bytes(20)}})
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	# /torrent/<name>, /slow/<name> (held until `release` is set),
+	# /sleep/<seconds>, /size/<bytes> and /trickle/<bytes> (sent a
+	# byte every 0.05s)
+	def do_GET(self):
+		server = self.server
+		_, kind, argument = self.path.split("/", 2)
+		with server.lock:
+			server.active += 1
+			server.most_active = max(server.most_active, server.active)
+			server.started.append(self.path)
+		try:
+			if kind == "slow":
+				server.release.wait(10)
+			elif kind == "sleep":
+				time.sleep(float(argument))
+			if kind in ["size", "trickle"]:
+				body = b"x"*int(argument)
+			else:
+				body = make_torrent(argument.split("?")[0])
+			self.send_response(200)
+			self.send_header("Content-Length", str(len(body)))
+			self.end_headers()
+			if kind == "trickle":
+				for byte in range(len(body)):
+					self.wfile.write(body[byte:byte+1])
+					self.wfile.flush()
+					time.sleep(0.05)
+			else:
+				self.wfile.write(body)
+		except OSError:
+			pass
+		finally:
+			with server.lock:
+				server.active -= 1
+	def log_message(self, *args):
+		pass
+
+class FetcherTest(unittest.TestCase):
+	def setUp(self):
+		self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+			Handler)
+		self.server.daemon_threads = True
+		self.server.lock = threading.Lock()
+		self.server.active = 0
+		self.server.most_active = 0
+		self.server.started = []
+		self.server.release = threading.Event()
+		thread = threading.Thread(target=self.server.serve_forever,
+			args=[0.05])
+		thread.daemon = True
+		thread.start()
+		self.port = self.server.server_address[1]
+		self.added = []
+		self.existing = set()
+		self.adding = threading.Event()
+		self.adding.set()
+	def tearDown(self):
+		self.server.release.set()
+		self.server.shutdown()
+		self.server.server_close()
+
+	def url(self, path, host="127.0.0.1"):
+		return "http://%s:%d/%s" % (host, self.port, path)
+	def make_fetcher(self, **kwargs):
+		def add(job, data):
+			self.adding.wait(10)
+			self.added.append(job.url)
+		return Fetcher.Fetcher(Bencode.info_hash, self.existing.__contains__,
+			add, **kwargs)
+	def wait_for(self, condition, timeout=10):
+		deadline = time.monotonic()+timeout
+		while not condition():
+			if time.monotonic() > deadline:
+				self.fail("timed out")
+			time.sleep(0.01)
+	def finish(self, jobs):
+		self.wait_for(lambda: all(job.finished for job in jobs))
+		return [job.state for job in jobs]
+
+	def test_done(self):
+		fetcher = self.make_fetcher()
+		job = fetcher.submit(self.url("torrent/a"), "user", "/tmp")
+		self.assertEqual(self.finish([job]), [Fetcher.DONE])
+		self.assertEqual(job.info_hash, Bencode.info_hash(make_torrent("a")))
+		self.assertEqual(self.added, [job.url])
+
+	def test_duplicate_info_hash(self):
+		# the same torrent from two urls while the first is being added
+		self.adding.clear()
+		fetcher = self.make_fetcher(workers=2)
+		jobs = [fetcher.submit(self.url("torrent/a"), "user", "/tmp"),
+			fetcher.submit(self.url("torrent/a?again"), "user", "/tmp")]
+		# whichever is fetched second is a duplicate, while the other
+		# is still being added
+		self.wait_for(lambda: any(job.finished for job in jobs))
+		self.assertEqual(sorted(job.state for job in jobs), [
+			Fetcher.DUPLICATE, Fetcher.FETCHING])
+		self.adding.set()
+		self.assertEqual(sorted(self.finish(jobs)), [Fetcher.DONE,
+			Fetcher.DUPLICATE])
+		first = [job for job in jobs if job.state == Fetcher.DONE][0]
+		# and one we already have
+		self.existing.add(Bencode.info_hash(make_torrent("b")))
+		job = fetcher.submit(self.url("torrent/b"), "user", "/tmp")
+		self.assertEqual(self.finish([job]), [Fetcher.DUPLICATE])
+		self.assertEqual(self.added, [first.url])
+
+	def test_same_url_is_one_job(self):
+		fetcher = self.make_fetcher(workers=1)
+		first = fetcher.submit(self.url("slow/a"), "user", "/tmp")
+		self.assertIs(fetcher.submit(self.url("slow/a"), "other", "/"), first)
+		self.server.release.set()
+		self.finish([first])
+
+	def test_per_host_limit(self):
+		fetcher = self.make_fetcher(workers=8, per_host=2)
+		jobs = [fetcher.submit(self.url("slow/%d" % index), "user", "/tmp")
+			for index in range(5)]
+		self.wait_for(lambda: len(self.server.started) >= 2)
+		time.sleep(0.2)
+		self.assertEqual(self.server.active, 2)
+		# another host isn't held up by the first
+		other = fetcher.submit(self.url("slow/other", "localhost"), "user",
+			"/tmp")
+		self.wait_for(lambda: self.server.active == 3)
+		self.assertEqual(other.state, Fetcher.FETCHING)
+		self.assertEqual([job.state for job in jobs].count(
+			Fetcher.FETCHING), 2)
+		self.server.release.set()
+		self.finish(jobs+[other])
+		self.assertEqual(self.server.most_active, 3)
+
+	def test_full(self):
+		fetcher = self.make_fetcher(workers=1, queue=2)
+		busy = fetcher.submit(self.url("slow/busy"), "user", "/tmp")
+		self.wait_for(lambda: self.server.active == 1)
+		queued = [fetcher.submit(self.url("torrent/%d" % index), "user",
+			"/tmp") for index in range(2)]
+		with self.assertRaises(Fetcher.Full):
+			fetcher.submit(self.url("torrent/2"), "user", "/tmp")
+		self.server.release.set()
+		self.assertEqual(self.finish([busy]+queued), [Fetcher.DONE]*3)
+
+	def test_full_batch_queues_nothing(self):
+		fetcher = self.make_fetcher(workers=1, queue=3)
+		busy = fetcher.submit(self.url("slow/busy"), "user", "/tmp")
+		self.wait_for(lambda: self.server.active == 1)
+		queued = fetcher.submit(self.url("torrent/0"), "user", "/tmp")
+		with self.assertRaises(Fetcher.Full):
+			fetcher.submit_many([self.url("torrent/%d" % index) for index
+				in range(1, 4)], "user", "/tmp")
+		self.assertEqual(len(fetcher.list_jobs()), 2)
+		# repeats and urls already queued don't take any room
+		jobs = fetcher.submit_many([self.url("torrent/0"), self.url(
+			"torrent/1"), self.url("torrent/2"), self.url("torrent/1")],
+			"user", "/tmp")
+		self.assertIs(jobs[0], queued)
+		self.assertIs(jobs[1], jobs[3])
+		self.assertEqual(len(fetcher.list_jobs()), 4)
+		self.server.release.set()
+		self.assertEqual(self.finish([busy]+jobs[:3]), [Fetcher.DONE]*4)
+
+	def test_not_http_batch_queues_nothing(self):
+		fetcher = self.make_fetcher()
+		with self.assertRaises(ValueError):
+			fetcher.submit_many([self.url("torrent/0"), "ftp://x/y"],
+				"user", "/tmp")
+		self.assertEqual(fetcher.list_jobs(), [])
+
+	def test_deadline(self):
+		# every byte comes well within the timeout, the whole doesn't
+		fetcher = self.make_fetcher(timeout=0.3)
+		start = time.monotonic()
+		job = fetcher.submit(self.url("trickle/40"), "user", "/tmp")
+		self.assertEqual(self.finish([job]), [Fetcher.FAILED])
+		self.assertIn("timed out", job.error)
+		self.assertLess(time.monotonic()-start, 1)
+
+	def test_timeout(self):
+		fetcher = self.make_fetcher(timeout=0.2)
+		job = fetcher.submit(self.url("sleep/1"), "user", "/tmp")
+		self.assertEqual(self.finish([job]), [Fetcher.FAILED])
+		self.assertIn("timed out", job.error)
+
+	def test_too_large(self):
+		fetcher = self.make_fetcher(max_size=1000)
+		jobs = [fetcher.submit(self.url("size/%d" % size), "user", "/tmp")
+			for size in [1000, 1001]]
+		# 1000 bytes of x is fetched, then fails to parse
+		self.assertEqual(self.finish(jobs), [Fetcher.FAILED]*2)
+		self.assertNotIn("too large", jobs[0].error)
+		self.assertIn("too large", jobs[1].error)
+
+	def test_not_http(self):
+		fetcher = self.make_fetcher()
+		with self.assertRaises(ValueError):
+			fetcher.submit("file:///etc/passwd", "user", "/tmp")
+
+if __name__ == "__main__":
+	unittest.main()
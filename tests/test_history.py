@@ -0,0 +1,96 @@
+import unittest
+import History
+import harness
+
+TIERS = [(60, 4), (240, 3)]
+
+class HistoryTest(unittest.TestCase):
+	def setUp(self):
+		self.history = History.History(TIERS, max_rows=4, grow_by=2)
+
+	def record(self, minute, samples):
+		self.history.record(samples, now=minute*60)
+
+	def test_rates_are_averaged_and_totals_kept(self):
+		for second, uploaded in [(0, 1 << 40), (30, (1 << 40)+100)]:
+			self.history.record({"a": (10+second, 4, 2, uploaded, 7)},
+				now=second)
+		self.record(1, {"a": (0, 0, 0, 1 << 41, 7)})
+		hour = self.history.series("a")[0]["values"]
+		self.assertEqual(hour["upload_rate"][-1], 25)
+		self.assertEqual(hour["peers"][-1], 2)
+		self.assertEqual(hour["uploaded"][-1], (1 << 40)+100)
+		self.assertEqual(hour["downloaded"][-1], 7)
+		self.assertEqual(hour["uploaded"][:-1], [None]*3)
+
+	def test_totals_roll_up_as_the_latest(self):
+		for minute in range(9):
+			self.record(minute, {"a": (minute, 0, 0, minute*1000, 0)})
+		day = self.history.series("a")[1]["values"]
+		self.assertEqual(day["uploaded"], [None, 3000, 7000])
+		self.assertEqual(day["upload_rate"], [None, 1, 5])
+
+	def test_reused_rows_start_empty(self):
+		for minute in range(3):
+			self.record(minute, {"a": (5, 5, 5, 5, 5)})
+		# a goes, and b gets its row
+		self.record(3, {"b": (1, 1, 1, 1, 1)})
+		self.assertEqual(self.history.rows["b"], 1)
+		self.record(4, {"b": (1, 1, 1, 1, 1)})
+		for field, values in self.history.series("b")[0][
+				"values"].items():
+			self.assertEqual(values, [None, None, None, 1], field)
+		# a row that's never been used before starts empty too
+		self.record(5, {"b": (1, 1, 1, 1, 1), "c": (2, 2, 2, 2, 2)})
+		self.record(6, {"b": (1, 1, 1, 1, 1), "c": (2, 2, 2, 2, 2)})
+		self.assertEqual(self.history.series("c")[0]["values"][
+			"uploaded"], [None, None, None, 2])
+
+	def test_dump_and_load(self):
+		for minute in range(6):
+			self.record(minute, {"a": (minute, 1, 2, 1 << 50, 4)})
+		self.record(6, {"b": (3, 3, 3, 3, 3)})
+		self.record(7, {"b": (3, 3, 3, 3, 3)})
+		loaded = History.History(TIERS)
+		loaded.load(self.history.dump())
+		for key in [None, "b"]:
+			self.assertEqual(loaded.series(key), self.history.series(key))
+
+class HistoryRouteTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		current = harness.reset(self.main, 3)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"historyuser"))
+		self.own, self.other = current.ordered("id")[:2]
+		self.main.database.add_torrent(current.get(self.own)["info_hash"],
+			"historyuser")
+		self.main.poll_torrent_list()
+
+	def test_series(self):
+		for client, url in [(self.user, "/api/history?id=%d" % self.own),
+				(self.root, "/api/history?id=%d" % self.other),
+				(self.root, "/api/history")]:
+			response = client.get(url)
+			self.assertEqual(response.status_code, 200, url)
+			data = response.get_json()
+			self.assertEqual(data["fields"], History.FIELDS)
+			self.assertEqual([tier["name"] for tier in data["tiers"]],
+				History.TIER_NAMES)
+			for tier in data["tiers"]:
+				self.assertEqual(sorted(tier["values"]), sorted(
+					History.FIELDS))
+
+	def test_access(self):
+		self.assertEqual(self.user.get("/api/history").status_code, 401)
+		self.assertEqual(self.user.get("/api/history?id=%d" % self.other
+			).status_code, 401)
+		self.assertEqual(self.root.get("/api/history?id=x").status_code,
+			404)
+		self.assertEqual(harness.client(self.main).get("/api/history?id="
+			"%d" % self.own).status_code, 401)
+
+if __name__ == "__main__":
+	unittest.main()
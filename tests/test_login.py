@@ -0,0 +1,69 @@
+import threading, time, unittest
+import Login
+
+class SlowDatabase(object):
+	def __init__(self, seconds=0.1):
+		self.seconds = seconds
+		self.calls = 0
+		self.lock = threading.Lock()
+	def authenticate(self, username, password):
+		with self.lock:
+			self.calls += 1
+		time.sleep(self.seconds)
+		return password == "right"
+
+class LoginTest(unittest.TestCase):
+	def attempt(self, logins, results, password="wrong", address="a"):
+		try:
+			results.append(logins.authenticate("user", password, address))
+		except (Login.Busy, Login.Throttled) as e:
+			results.append(type(e))
+
+	def test_concurrent_failures_are_throttled(self):
+		database = SlowDatabase()
+		logins = Login.Login(database, workers=8, queue=32, attempts=3)
+		results = []
+		threads = [threading.Thread(target=self.attempt, args=[logins,
+			results]) for _ in range(12)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(database.calls, 3)
+		self.assertEqual((results.count(False), results.count(
+			Login.Throttled)), (3, 9))
+
+	def test_success_clears_the_user(self):
+		logins = Login.Login(SlowDatabase(0), attempts=3)
+		results = []
+		for password in ["wrong", "wrong", "right", "wrong"]:
+			self.attempt(logins, results, password)
+		self.assertEqual(results, [False, False, True, False])
+		# the address still has its three failures against it, the
+		# user only the one since logging in
+		self.attempt(logins, results, "right", "a")
+		self.assertEqual(results[-1], Login.Throttled)
+		self.attempt(logins, results, "right", "b")
+		self.assertEqual(results[-1], True)
+
+	def test_busy(self):
+		database = SlowDatabase(0.3)
+		logins = Login.Login(database, workers=1, queue=0, attempts=3)
+		results = []
+		thread = threading.Thread(target=self.attempt, args=[logins,
+			results, "right"])
+		thread.start()
+		time.sleep(0.1)
+		self.attempt(logins, results, "right", "b")
+		thread.join()
+		self.assertEqual(results, [Login.Busy, True])
+		# turned away as busy isn't a failed attempt
+		self.assertEqual(logins.throttle.failures, {})
+
+	def test_timeout_is_busy(self):
+		logins = Login.Login(SlowDatabase(0.3), attempts=3)
+		with self.assertRaises(Login.Busy):
+			logins.authenticate("user", "right", "a", timeout=0.05)
+
+if __name__ == "__main__":
+	unittest.main()
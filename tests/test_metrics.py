@@ -0,0 +1,114 @@
+import sys, threading, unittest, unittest.mock
+import Metrics
+import harness
+
+class MetricsTest(unittest.TestCase):
+	def test_disabled(self):
+		metrics = Metrics.Metrics()
+		with metrics.timer("seconds", stage="a") as timer:
+			pass
+		self.assertIs(timer, None)
+		self.assertEqual(metrics.dump()["histograms"], {})
+		self.assertEqual(metrics.render(), "\n")
+
+	def test_histogram(self):
+		metrics = Metrics.Metrics(True)
+		metrics.describe("seconds", "How long.")
+		labels = (("stage", 'say "hi"\n'),)
+		for value in [0.0001, 0.003, 0.003, 100]:
+			metrics.observe("seconds", labels, value)
+		lines = metrics.render().splitlines()
+		self.assertEqual(lines[:2], ["# HELP seconds How long.",
+			"# TYPE seconds histogram"])
+		label = 'stage="say \\"hi\\"\\n"'
+		self.assertIn('seconds_bucket{%s,le="0.0005"} 1' % label, lines)
+		self.assertIn('seconds_bucket{%s,le="0.0025"} 1' % label, lines)
+		self.assertIn('seconds_bucket{%s,le="0.005"} 3' % label, lines)
+		self.assertIn('seconds_bucket{%s,le="30"} 3' % label, lines)
+		self.assertIn('seconds_bucket{%s,le="+Inf"} 4' % label, lines)
+		self.assertIn("seconds_sum{%s} 100.0061" % label, lines)
+		self.assertIn("seconds_count{%s} 4" % label, lines)
+		self.assertEqual(len(lines), 2+len(Metrics.SECONDS_BUCKETS)+3)
+
+	def test_timer(self):
+		metrics = Metrics.Metrics(True)
+		with metrics.timer("seconds", b=2, a=1):
+			pass
+		(key, value), = metrics.dump()["histograms"].items()
+		self.assertEqual(key, ("seconds", (("a", 1), ("b", 2))))
+		self.assertEqual(value[3], 1)
+
+	def test_counters_and_processes(self):
+		metrics = Metrics.Metrics(True)
+		metrics.count("total", (("status", "200"),))
+		metrics.count("total", (("status", "200"),), 2)
+		other = Metrics.Metrics(True)
+		other.count("total", (("status", "404"),))
+		lines = metrics.render({"worker1": other.dump()}, "poller"
+			).splitlines()
+		self.assertEqual(lines, ["# TYPE total counter",
+			'total{status="200",process="poller"} 3',
+			'total{status="404",process="worker1"} 1'])
+
+	def test_queries_per_thread(self):
+		metrics = Metrics.Metrics(True)
+		frame = sys._getframe()
+		metrics.query(frame, "SELECT 1", 0.001)
+		metrics.query(frame, "SELECT 1", 0.001)
+		counts = []
+		thread = threading.Thread(target=lambda: counts.append(
+			metrics.queries()))
+		thread.start()
+		thread.join()
+		self.assertEqual((metrics.queries(), counts), (2, [0]))
+		metrics.reset_queries()
+		self.assertEqual(metrics.queries(), 0)
+		key = ("btpdweb_db_query_seconds", (("method",
+			"test_queries_per_thread"),))
+		self.assertEqual(metrics.dump()["histograms"][key][3], 2)
+
+class MetricsPageTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		harness.reset(self.main, 2)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"metricsuser"))
+
+	def enable(self):
+		patches = [unittest.mock.patch.object(self.main, "metrics",
+			Metrics.Metrics(True)), unittest.mock.patch.dict(
+			self.main.app.config, {"METRICS_TOKEN": "secret"})]
+		for patch in patches:
+			patch.start()
+			self.addCleanup(patch.stop)
+
+	def test_disabled(self):
+		self.assertEqual(self.root.get("/metrics").status_code, 404)
+
+	def test_access(self):
+		self.enable()
+		self.assertEqual(self.user.get("/metrics").status_code, 401)
+		self.assertEqual(self.user.get("/metrics", headers={
+			"Authorization": "Bearer wrong"}).status_code, 401)
+		client = harness.client(self.main)
+		self.assertEqual(client.get("/metrics", headers={
+			"Authorization": "Bearer secret"}).status_code, 200)
+		self.assertEqual(self.root.get("/metrics").status_code, 200)
+
+	def test_requests_are_measured(self):
+		self.enable()
+		self.assertEqual(self.user.get("/api/torrents").status_code, 200)
+		response = self.root.get("/metrics")
+		self.assertEqual(response.mimetype, "text/plain")
+		text = response.get_data(as_text=True)
+		self.assertIn('btpdweb_request_seconds_count{endpoint='
+			'"api_torrents",method="GET"} 1\n', text)
+		self.assertIn('btpdweb_responses_total{endpoint="api_torrents",'
+			'status="200"} 1\n', text)
+		self.assertIn('btpdweb_db_queries_per_request_count{endpoint='
+			'"api_torrents"} 1\n', text)
+
+if __name__ == "__main__":
+	unittest.main()
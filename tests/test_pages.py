@@ -0,0 +1,138 @@
+import re, unittest
+import harness
+
+class UsersPageTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		current = harness.reset(self.main, 6)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		harness.add_user(self.main, "pagesuser")
+		harness.add_user(self.main, "emptyuser")
+		for id in current.ordered("id")[:2]:
+			self.main.database.add_torrent(current.get(id)["info_hash"],
+				"pagesuser")
+		self.main.poll_torrent_list()
+
+	def rows(self, page):
+		# user id -> (torrent count, size) as listed
+		return {int(id): (int(count), size) for id, count, size in
+			re.findall(r'<td class="userid">(\d+)</td>.*?<td class='
+			r'"usertorrents">(\d+)</td>\s*<td class="usersize">([^<]*)'
+			r'</td>', page, re.S)}
+
+	def test_counts_and_stats(self):
+		users = self.main.database.list_users_with_counts()
+		self.assertEqual([user["id"] for user in users], sorted(
+			user["id"] for user in users))
+		counts = {user["username"]: user["torrent_count"] for user in
+			users}
+		self.assertEqual((counts["pagesuser"], counts["emptyuser"]), (2,
+			0))
+		self.assertEqual(sum(counts.values()), 6)
+
+		response = self.root.get("/users")
+		self.assertEqual(response.status_code, 200)
+		rows = self.rows(response.get_data(as_text=True))
+		current = self.main.snapshots.current
+		for user in users:
+			stats = current.owner_stats(user["id"])
+			self.assertEqual(rows[user["id"]], (user["torrent_count"],
+				stats["pretty_size"]+"B"))
+		self.assertIn('<td class="usertorrents">6</td>',
+			response.get_data(as_text=True))
+
+	def test_admins_only(self):
+		client = harness.client(self.main, harness.add_user(self.main,
+			"pagesuser"))
+		self.assertEqual(client.get("/users").status_code, 302)
+
+class BulkTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		current = harness.reset(self.main, 6)
+		self.ids = list(current.ordered("id"))
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"bulkuser"))
+		self.own = self.ids[0]
+		self.main.database.add_torrent(current.get(self.own)["info_hash"],
+			"bulkuser")
+		self.main.poll_torrent_list()
+
+	def post(self, client, action, ids, **form):
+		form.update(action=action, id=[str(id) for id in ids])
+		return client.post("/bulk", data=form)
+
+	def set_states(self, ids, state):
+		with harness.fake.lock:
+			for id in ids:
+				harness.fake.torrents[id].state = state
+		self.main.poll_torrent_list()
+
+	def states(self, ids):
+		current = self.main.snapshots.current
+		return [current.get(id)["state"] for id in ids]
+
+	def test_remove_asks_first(self):
+		ids = self.ids[1:4]
+		response = self.post(self.root, "remove", ids)
+		self.assertEqual(response.status_code, 200)
+		page = response.get_data(as_text=True)
+		self.assertIn("these 3 torrents", page)
+		self.assertEqual(sorted(int(id) for id in re.findall(
+			r'name="id" value="(\d+)"', page)), ids)
+		self.assertEqual(len(harness.fake.torrents), 6)
+
+	def test_remove(self):
+		ids = self.ids[1:4]
+		current = self.main.snapshots.current
+		info_hashes = [current.get(id)["info_hash"] for id in ids]
+		response = self.post(self.root, "remove", ids+ids[:1],
+			seriously="1")
+		self.assertEqual(response.status_code, 302)
+		current = self.main.snapshots.current
+		for id, info_hash in zip(ids, info_hashes):
+			self.assertNotIn(id, harness.fake.torrents)
+			self.assertNotIn(id, current)
+			self.assertIsNone(self.main.database.get_torrent_owner(
+				info_hash))
+		self.assertEqual(len(current), 3)
+
+	def test_start_and_stop(self):
+		ids = self.ids[:4]
+		self.set_states(ids, 3)
+		self.set_states(ids[:1], 0)
+		self.assertEqual(self.post(self.root, "stop", ids).status_code,
+			302)
+		self.assertEqual(self.states(ids), ["idle"]*4)
+		self.assertEqual([harness.fake.torrents[id].state for id in ids],
+			[0]*4)
+		self.assertEqual(self.post(self.root, "start", ids).status_code,
+			302)
+		self.assertEqual(self.states(ids), ["starting"]*4)
+		self.assertEqual([harness.fake.torrents[id].state for id in ids],
+			[3]*4)
+
+	def test_others_torrents(self):
+		self.set_states(self.ids[:2], 0)
+		self.assertEqual(self.post(self.user, "start", self.ids[:2]
+			).status_code, 401)
+		self.assertEqual(self.states(self.ids[:2]), ["idle"]*2)
+		self.assertEqual(self.post(self.user, "start", self.ids[:1]
+			).status_code, 302)
+		self.assertEqual(self.states(self.ids[:2]), ["starting", "idle"])
+
+	def test_bad_requests(self):
+		self.assertEqual(self.post(self.root, "pause", self.ids[:1]
+			).status_code, 400)
+		self.assertEqual(self.post(self.root, "stop", []).status_code,
+			400)
+		self.assertEqual(self.post(self.root, "stop", [max(self.ids)+1]
+			).status_code, 400)
+		self.assertEqual(self.post(harness.client(self.main), "stop",
+			self.ids[:1]).status_code, 302)
+
+if __name__ == "__main__":
+	unittest.main()
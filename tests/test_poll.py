@@ -0,0 +1,31 @@
+import unittest, unittest.mock
+import harness
+
+class PollTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		harness.reset(self.main, 2)
+
+	def test_no_torrents_is_an_answer(self):
+		with harness.fake.lock:
+			harness.fake.torrents.clear()
+		version = self.main.snapshots.current.version
+		self.main.poll_torrent_list()
+		current = self.main.snapshots.current
+		self.assertEqual(current.version, version+1)
+		self.assertEqual(len(current), 0)
+		self.assertEqual(current.owner_stats()["count"], 0)
+		self.assertEqual(self.main.database.torrent_owners(), {})
+		self.assertEqual(self.main.database.torrent_count(), 0)
+
+	def test_no_answer_keeps_the_torrents(self):
+		current = self.main.snapshots.current
+		with unittest.mock.patch.object(self.main.utils,
+				"get_torrent_lists", side_effect=OSError("no btpd")):
+			total = self.main.poll_torrent_list()
+		self.assertIs(self.main.snapshots.current, current)
+		self.assertEqual(total["count"], 2)
+		self.assertEqual(self.main.database.torrent_count(), 2)
+
+if __name__ == "__main__":
+	unittest.main()
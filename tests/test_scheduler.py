@@ -0,0 +1,76 @@
+import threading, time, unittest
+import Scheduler
+
+class SchedulerTest(unittest.TestCase):
+	def setUp(self):
+		# long enough intervals that reaching them fails the test
+		self.scheduler = Scheduler.Scheduler(interval=30,
+			idle_interval=60, active_interval=20, idle_after=120,
+			debounce=0.05)
+
+	def timed_wait(self):
+		start = time.monotonic()
+		self.scheduler.wait()
+		return time.monotonic()-start
+
+	def later(self, seconds, method):
+		timer = threading.Timer(seconds, method)
+		timer.start()
+		self.addCleanup(timer.cancel)
+
+	def test_intervals(self):
+		now = time.monotonic()
+		self.assertEqual(self.scheduler.next_interval(now), 30)
+		self.scheduler.polled(True)
+		self.assertEqual(self.scheduler.next_interval(now), 20)
+		self.assertEqual(self.scheduler.next_interval(now+121), 60)
+		self.scheduler.polled(False)
+		self.assertEqual(self.scheduler.next_interval(now), 30)
+
+	def test_first_poll_is_straight_away(self):
+		self.assertLess(self.timed_wait(), 0.05)
+
+	def test_interval_after_a_poll(self):
+		scheduler = Scheduler.Scheduler(interval=0.1, debounce=0.05)
+		scheduler.polled(False)
+		start = time.monotonic()
+		scheduler.wait()
+		self.assertGreaterEqual(time.monotonic()-start, 0.09)
+
+	def test_refreshes_are_coalesced(self):
+		self.scheduler.polled(False)
+		self.scheduler.refresh()
+		refresh_at = self.scheduler.refresh_at
+		self.scheduler.refresh()
+		self.later(0.01, self.scheduler.refresh)
+		self.assertEqual(self.scheduler.refresh_at, refresh_at)
+		seconds = self.timed_wait()
+		self.assertGreaterEqual(seconds, 0.04)
+		self.assertLess(seconds, 1)
+		self.assertIsNone(self.scheduler.refresh_at)
+		# all of them answered by that one poll
+		self.scheduler.polled(False)
+		self.later(0.2, self.scheduler.refresh)
+		self.assertGreaterEqual(self.timed_wait(), 0.2)
+
+	def test_coming_back_from_idle(self):
+		# polled longer ago than the interval, not the idle one
+		self.scheduler.polled(False)
+		self.scheduler.last_poll -= 40
+		self.scheduler.last_activity -= 121
+		self.later(0.05, self.scheduler.touch)
+		seconds = self.timed_wait()
+		self.assertGreaterEqual(seconds, 0.04)
+		self.assertLess(seconds, 1)
+		self.assertFalse(self.scheduler.idle())
+
+	def test_touch_while_active_waits(self):
+		scheduler = Scheduler.Scheduler(interval=0.2)
+		scheduler.polled(False)
+		self.later(0.01, scheduler.touch)
+		start = time.monotonic()
+		scheduler.wait()
+		self.assertGreaterEqual(time.monotonic()-start, 0.19)
+
+if __name__ == "__main__":
+	unittest.main()
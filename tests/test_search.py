@@ -0,0 +1,128 @@
+import random, re, unittest
+import Btpd, Search, Snapshot
+import harness
+
+COLUMNS = ["id", "name", "state", "percent", "size", "ratio"]
+WORDS = ["linux", "debian", "iso", "amd64", "Arch", "live", "x", "2024"]
+
+def make_torrents(count, seed=0):
+	random_ = random.Random(seed)
+	torrents = {}
+	for id in range(1, count+1):
+		title = " ".join(random_.sample(WORDS, random_.randint(1, 4)))
+		torrents[id] = Btpd.Torrent(id, title, random_.choice(["seed",
+			"idle", "leech"]), "%040x" % id, random_.choice([1 << 20,
+			1 << 30]), random_.choice([0.0, 50.0, 100.0]),
+			random_.choice([0.0, 1.5]), 0, 0, 0, 0, 0, 0, 1)
+	return torrents
+
+class NameIndexTest(unittest.TestCase):
+	def test_candidates_include_every_match(self):
+		torrents = make_torrents(200)
+		index = Search.NameIndex()
+		index.update([(id, torrent["name"]) for id, torrent in
+			torrents.items()], [])
+		random_ = random.Random(1)
+		for _ in range(200):
+			word = random_.choice(WORDS).lower()
+			start = random_.randrange(len(word))
+			query = word[start:start+random_.randint(1, len(word))]
+			matches = set(id for id, torrent in torrents.items() if
+				query in torrent["name"])
+			candidates = index.search(query)
+			if len(query) < 3:
+				self.assertIsNone(candidates)
+			else:
+				self.assertTrue(matches <= candidates, query)
+
+	def test_changes(self):
+		index = Search.NameIndex()
+		index.update([(1, "debian live"), (2, "arch live")], [])
+		self.assertEqual(index.search("live"), set([1, 2]))
+		index.update([(1, "debian netinst")], [2])
+		self.assertEqual(index.search("live"), set())
+		self.assertEqual(index.search("deb net"), set([1]))
+		self.assertEqual(set(index.names), set([1]))
+		self.assertNotIn("liv", index.trigrams)
+
+class FilterTest(unittest.TestCase):
+	def test_nothing_to_filter(self):
+		self.assertIsNone(Search.make_filter())
+		self.assertIsNone(Search.make_filter("", None, {"size": (None,
+			None)}))
+
+	def test_filters(self):
+		torrent = make_torrents(1)[1].replace(title="Debian Live ISO",
+			state="seed", size=100, percent=50.0, ratio=1.5)
+		for name, state, ranges, expected in [
+				("debian iso", None, {}, True),
+				("live  DEBIAN", None, {}, True),
+				("debian arch", None, {}, False),
+				(None, "seed", {}, True),
+				(None, "idle", {}, False),
+				(None, None, {"size": (100, 100)}, True),
+				(None, None, {"size": (101, None)}, False),
+				(None, None, {"percent": (None, 49.9)}, False),
+				("live", "seed", {"ratio": (1.0, 2.0)}, True)]:
+			self.assertEqual(Search.make_filter(name, state, ranges)(
+				torrent), expected, (name, state, ranges))
+
+	def test_search_matches_a_scan(self):
+		torrents = make_torrents(300, 2)
+		publisher = Snapshot.Publisher(COLUMNS)
+		publisher.publish(torrents)
+		current = publisher.current
+		random_ = random.Random(3)
+		for _ in range(100):
+			name = random_.choice([None, "iso", "LINUX live", "li"])
+			state = random_.choice([None, "seed", "idle"])
+			ranges = {"size": (random_.choice([None, 1 << 25]), None),
+				"percent": (None, random_.choice([None, 50.0]))}
+			column = random_.choice(COLUMNS)
+			descending = random_.random() < 0.5
+			predicate = Search.make_filter(name, state, ranges)
+			expected = [id for id in current.ordered(column, descending)
+				if predicate is None or predicate(current.get(id))]
+			self.assertEqual(list(publisher.search(current, column,
+				descending, None, name, state, ranges)), expected, (name,
+				state, ranges, column, descending))
+
+class ListFilterTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		self.current = harness.reset(self.main, 20)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+
+	def total(self, query):
+		response = self.root.get("/api/torrents?"+query)
+		self.assertEqual(response.status_code, 200)
+		return response.get_json()["total"]
+
+	def test_api(self):
+		torrents = list(self.current.torrents.values())
+		# every word, anywhere in the name
+		self.assertEqual(self.total("q=1+Torrent"), len([torrent for
+			torrent in torrents if "1" in torrent["name"]]))
+		self.assertEqual(self.total("state=seed"), len([torrent for
+			torrent in torrents if torrent["state"] == "seed"]))
+		middle = sorted(torrent["size"] for torrent in torrents)[10]
+		self.assertEqual(self.total("min_size=%d" % middle), 10)
+		self.assertEqual(self.total("max_size=%d&q=synthetic" % middle),
+			11)
+		self.assertEqual(self.root.get("/api/torrents?min_size=big"
+			).status_code, 400)
+
+	def test_list_page(self):
+		# words match anywhere in the name, so "4" matches 14 too
+		page = self.root.get("/?orderby=-0&q=synthetic+4&state=idle"
+			).get_data(as_text=True)
+		predicate = Search.make_filter("synthetic 4", "idle")
+		expected = [id for id in self.current.ordered("id") if
+			predicate(self.current.get(id))]
+		self.assertTrue(expected)
+		self.assertEqual([int(id) for id in re.findall(
+			r'id="torrent(\d+)"', page)], expected)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,139 @@
+import os, shutil, tempfile, threading, time, unittest
+import Btpd, Cache, Fetcher, Login, Shared, Snapshot
+import harness
+
+COLUMNS = ["name", "size"]
+
+def make_torrents(count, size=1):
+	return {id: Btpd.Torrent(id, "torrent %d" % id, "S", "%040x" % id,
+		size*id, 100.0, 1.0, 0, 0, 0, 0, 0, 1, 1, owner=1+id%2) for id in
+		range(1, count+1)}
+
+class SharedSnapshotTest(unittest.TestCase):
+	def setUp(self):
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		self.path = os.path.join(directory, "snapshot")
+
+	def share(self, publisher):
+		# what the poller does, see main.share()
+		current = publisher.current
+		Shared.SharedFile(self.path).write(current.version, {"torrents": [
+			torrent.pack() for torrent in current.torrents.values()],
+			"derived": current.derived()}, current.epoch)
+	def follower(self):
+		return Shared.FollowingPublisher(COLUMNS, Shared.SharedFile(
+			self.path), None)
+
+	def test_follows_with_the_pollers_orders(self):
+		poller = Snapshot.Publisher(COLUMNS)
+		poller.publish(make_torrents(5))
+		poller.publish(make_torrents(6))
+		self.share(poller)
+		worker = self.follower()
+		self.assertTrue(worker.follow())
+		self.assertFalse(worker.follow())
+		self.assertEqual((worker.epoch, worker.current.version), (
+			poller.epoch, 2))
+		self.assertEqual(worker.current.orders, poller.current.orders)
+		self.assertEqual(worker.current.owner_stats(2), poller.current.
+			owner_stats(2))
+		self.assertEqual(dict(worker.current.torrents), dict(
+			poller.current.torrents))
+
+	def test_restarted_poller(self):
+		poller = Snapshot.Publisher(COLUMNS)
+		for count in range(1, 6):
+			poller.publish(make_torrents(count))
+		self.share(poller)
+		worker = self.follower()
+		worker.follow()
+		self.assertEqual(worker.wait(5, 0, poller.epoch), [])
+		fragments = Cache.FragmentCache()
+		fragments.get(worker.current.version, "page", lambda: "old",
+			worker.current.epoch)
+
+		# starts counting from 1 again, behind where the worker is
+		restarted = Snapshot.Publisher(COLUMNS, epoch=poller.epoch+1)
+		restarted.publish(make_torrents(2, size=7))
+		self.share(restarted)
+		self.assertTrue(worker.follow())
+		self.assertEqual((worker.epoch, worker.current.version), (
+			restarted.epoch, 1))
+		self.assertEqual(dict(worker.current.torrents), dict(
+			restarted.current.torrents))
+		# streams still on the old epoch are told to start over
+		self.assertIsNone(worker.wait(5, 0, poller.epoch))
+		self.assertEqual(worker.wait(0, 0, restarted.epoch)[0].version, 1)
+		self.assertEqual(worker.search(worker.current, "name", name=
+			"torrent 1"), [1])
+		self.assertEqual(fragments.get(worker.current.version, "page",
+			lambda: "new", worker.current.epoch), "new")
+
+class Passwords(object):
+	def authenticate(self, username, password):
+		return password == "right"
+
+class WorkersTest(unittest.TestCase):
+	# two workers' stand-ins talking to one poller over its control
+	# socket, the poller being main.py's handle_control()
+	def setUp(self):
+		self.main = harness.load_main()
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		control = Shared.Control(os.path.join(directory, "control"))
+		thread = threading.Thread(target=control.serve, args=[
+			self.main.handle_control])
+		thread.daemon = True
+		thread.start()
+		while not os.path.exists(control.path):
+			time.sleep(0.01)
+		self.workers = [Shared.Control(control.path) for _ in range(2)]
+
+	def test_jobs_are_seen_by_every_worker(self):
+		first, second = [Shared.RemoteFetcher(control) for control in
+			self.workers]
+		url = "http://127.0.0.1:1/shared.torrent"
+		id, = first.submit_many([url], "user", "/tmp")
+		jobs = [job for job in second.list_jobs("user") if job.id == id]
+		self.assertEqual([job.url for job in jobs], [url])
+		self.assertEqual(self.main.fetcher.jobs[id].url, url)
+		self.assertEqual(second.list_jobs("nobody"), [])
+		with self.assertRaises(ValueError):
+			second.submit_many(["file:///etc/passwd"], "user", "/tmp")
+
+	def test_a_full_queue_is_full_for_every_worker(self):
+		fetcher = Shared.RemoteFetcher(self.workers[0])
+		queue = self.main.fetcher.queue
+		self.main.fetcher.queue = len(self.main.fetcher.pending)
+		try:
+			with self.assertRaises(Fetcher.Full):
+				fetcher.submit_many(["http://127.0.0.1:1/full.torrent"],
+					"user", "/tmp")
+		finally:
+			self.main.fetcher.queue = queue
+
+	def test_failed_logins_count_across_workers(self):
+		attempts = self.main.logins.throttle.attempts
+		logins = [Login.Login(Passwords(), throttle=Shared.RemoteThrottle(
+			control)) for control in self.workers]
+		for attempt in range(attempts):
+			self.assertFalse(logins[attempt%2].authenticate("shared",
+				"wrong", "10.0.0.1"))
+		for worker in logins:
+			with self.assertRaises(Login.Throttled):
+				worker.authenticate("shared", "right", "10.0.0.2")
+		self.assertTrue(logins[0].authenticate("other", "right",
+			"10.0.0.3"))
+
+	def test_no_poller(self):
+		control = Shared.Control(self.workers[0].path+".missing")
+		with self.assertRaises(Fetcher.Full):
+			Shared.RemoteFetcher(control).submit_many([
+				"http://127.0.0.1:1/x.torrent"], "user", "/tmp")
+		with self.assertRaises(Login.Busy):
+			Login.Login(Passwords(), throttle=Shared.RemoteThrottle(
+				control)).authenticate("user", "right", "a")
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,196 @@
+import random, unittest
+import Btpd, Snapshot
+
+COLUMNS = ["id", "name", "state", "percent", "size", "ratio", "uploader"]
+
+def make_torrents(count, seed=0):
+	# few distinct values per column, so there are plenty of ties
+	random_ = random.Random(seed)
+	torrents = {}
+	for id in random_.sample(range(count*3), count):
+		torrents[id] = Btpd.Torrent(id, random_.choice(["a", "B", "c"]),
+			random_.choice("SIL+"), "%040x" % id, random_.choice([0, 1,
+			1 << 20]), random_.choice([0.0, 50.0, 100.0]),
+			random_.choice([0.0, 1.5]), 0, 0, 0, 0, 0, 0, 1,
+			owner=random_.choice([1, 2, 3]), uploader=random_.choice([
+			"root", "user"]))
+	return torrents
+
+def old_order(torrents, column, descending, owner=None):
+	# how index() ordered the list before snapshots kept orders: by id,
+	# then stably by the column, both reversed when descending
+	lines = [torrent for torrent in torrents.values() if owner is None
+		or torrent["owner"] == owner]
+	lines = sorted(lines, key=lambda line: line["id"], reverse=descending)
+	lines = sorted(lines, key=lambda line: line[column],
+		reverse=descending)
+	return [line["id"] for line in lines]
+
+class SnapshotOrderTest(unittest.TestCase):
+	def setUp(self):
+		self.torrents = make_torrents(200)
+		self.snapshot = Snapshot.Snapshot(1, self.torrents, COLUMNS)
+
+	def test_ordered_matches_old_sort(self):
+		for column in COLUMNS:
+			for descending in [False, True]:
+				for owner in [None, 1, 2, 3, 4]:
+					self.assertEqual(list(self.snapshot.ordered(column,
+						descending, owner)), old_order(self.torrents,
+						column, descending, owner), (column, descending,
+						owner))
+
+	def test_page_matches_old_slices(self):
+		per_page = 40
+		for column in COLUMNS:
+			for descending in [False, True]:
+				for owner in [None, 2, 4]:
+					expected = old_order(self.torrents, column,
+						descending, owner)
+					for page in range(8):
+						ids = [torrent["id"] for torrent in
+							self.snapshot.page(column, descending,
+							per_page*page, per_page*(page+1), owner)]
+						self.assertEqual(ids, expected[per_page*page:
+							per_page*(page+1)], (column, descending,
+							owner, page))
+
+	def test_negative_pages_are_empty(self):
+		for descending in [False, True]:
+			for page in [-1, -2, -5]:
+				self.assertEqual(self.snapshot.page("name", descending,
+					40*page, 40*(page+1)), [])
+
+	def test_none_sorts_as_empty(self):
+		torrents = make_torrents(10)
+		first = min(torrents)
+		torrents[first] = torrents[first].replace(uploader=None)
+		snapshot = Snapshot.Snapshot(1, torrents, COLUMNS)
+		self.assertEqual(snapshot.ordered("uploader")[0], first)
+		self.assertEqual(snapshot.ordered("uploader", True)[-1], first)
+
+	def test_orders_are_sorted_when_asked_for(self):
+		self.assertEqual(list(self.snapshot.orders), [(None, "id")])
+		order = self.snapshot.ordered("name", owner=2)
+		self.assertEqual(set(self.snapshot.orders), set([(None, "id"),
+			(2, "name")]))
+		self.assertIs(self.snapshot.ordered("name", owner=2), order)
+		self.assertEqual(self.snapshot.ordered("nothing"), ())
+		self.assertEqual(self.snapshot.ordered("name", owner=4), ())
+		self.assertEqual(len(self.snapshot.orders), 2)
+
+	def test_derived_rebuilds_the_same_snapshot(self):
+		self.snapshot.ordered("name", owner=1)
+		self.snapshot.ordered("ratio")
+		rebuilt = Snapshot.Snapshot(2, self.torrents, COLUMNS,
+			derived=self.snapshot.derived())
+		self.assertEqual(rebuilt.orders, self.snapshot.orders)
+		self.assertEqual(rebuilt.owners, self.snapshot.owners)
+		for owner in [None, 1, 2, 3]:
+			self.assertEqual(dict(rebuilt.owner_stats(owner)), dict(
+				self.snapshot.owner_stats(owner)))
+
+class PatchTest(unittest.TestCase):
+	# snapshots published after a few changes are patched from the one
+	# before, and have to match one built from scratch
+	def assertSameAsBuilt(self, snapshot):
+		built = Snapshot.Snapshot(snapshot.version, snapshot.torrents,
+			COLUMNS)
+		self.assertEqual({owner: sorted(ids) for owner, ids in
+			snapshot.owners.items()}, {owner: sorted(ids) for owner, ids
+			in built.owners.items()})
+		self.assertEqual({owner: dict(stats) for owner, stats in
+			snapshot.stats.items()}, {owner: dict(stats) for owner, stats
+			in built.stats.items()})
+		for (owner, column), order in list(snapshot.orders.items()):
+			self.assertEqual(order, built.ordered(column, owner=owner),
+				(owner, column))
+		for column in COLUMNS:
+			for owner in [None, 1, 2, 3, 4]:
+				self.assertEqual(snapshot.ordered(column, owner=owner),
+					built.ordered(column, owner=owner), (owner, column))
+
+	def test_updates(self):
+		publisher = Snapshot.Publisher(COLUMNS)
+		torrents = make_torrents(100)
+		publisher.publish(torrents)
+		random_ = random.Random(1)
+		for _ in range(30):
+			current = publisher.current
+			for column in random_.sample(COLUMNS, 3):
+				current.ordered(column, owner=random_.choice([None, 1, 2,
+					3]))
+			ids = random_.sample(sorted(current.torrents), 3)
+			changes = {ids[0]: {"state": random_.choice("SIL+")},
+				ids[1]: {"owner": random_.choice([1, 2, 3, 4])}}
+			if random_.random() < 0.3:
+				changes[ids[2]] = None
+			publisher.update(changes)
+			self.assertSameAsBuilt(publisher.current)
+
+	def test_polls(self):
+		publisher = Snapshot.Publisher(COLUMNS)
+		torrents = make_torrents(100)
+		publisher.publish(torrents)
+		random_ = random.Random(2)
+		next_id = 1000
+		for _ in range(30):
+			for column in COLUMNS:
+				publisher.current.ordered(column)
+				publisher.current.ordered(column, owner=2)
+			torrents = dict(publisher.current.torrents)
+			for id in random_.sample(sorted(torrents), 2):
+				torrents[id] = torrents[id].replace(percent=random_.choice(
+					[0.0, 50.0, 100.0]), upload_rate=random_.randrange(100))
+			if random_.random() < 0.3:
+				del torrents[random_.choice(sorted(torrents))]
+			if random_.random() < 0.3:
+				torrent, = make_torrents(1, next_id).values()
+				torrents[next_id] = torrent.replace(id=next_id)
+				next_id += 1
+			publisher.publish(torrents)
+			self.assertSameAsBuilt(publisher.current)
+
+class PublisherTest(unittest.TestCase):
+	def setUp(self):
+		self.publisher = Snapshot.Publisher(COLUMNS, epoch=1)
+		self.torrents = make_torrents(20)
+		self.first = self.publisher.publish(self.torrents)
+
+	def test_versions_move_on_changes_only(self):
+		self.assertEqual(self.first.version, 1)
+		self.assertIs(self.publisher.publish(dict(self.torrents)),
+			self.first)
+		id = min(self.torrents)
+		self.assertIs(self.publisher.update({id: {"state": self.torrents[
+			id]["state"]}}), self.first)
+		self.assertIs(self.publisher.update({-1: None}), self.first)
+		second = self.publisher.update({id: {"state": "?"}})
+		self.assertEqual(second.version, 2)
+		self.assertIs(self.publisher.current, second)
+
+	def test_snapshots_are_not_changed(self):
+		torrents = dict(self.first.torrents)
+		order = self.first.ordered("name")
+		with self.assertRaises(TypeError):
+			self.first.torrents[-1] = None
+		self.torrents.clear()
+		id = min(torrents)
+		self.publisher.update({id: {"name": "z"}})
+		self.publisher.update({id: None})
+		self.assertEqual(dict(self.first.torrents), torrents)
+		self.assertEqual(self.first.ordered("name"), order)
+		self.assertEqual(self.first.version, 1)
+		self.assertNotIn(id, self.publisher.current)
+
+	def test_following_another_numbering(self):
+		id = min(self.torrents)
+		torrents = dict(self.torrents)
+		torrents[id] = torrents[id].replace(name="z")
+		self.assertEqual(self.publisher.publish(torrents, 7, 1).version, 7)
+		snapshot = self.publisher.publish(self.torrents, 3, 2)
+		self.assertEqual((snapshot.epoch, snapshot.version), (2, 3))
+		self.assertIsNone(self.publisher.wait(0, 0, 1))
+
+if __name__ == "__main__":
+	unittest.main()
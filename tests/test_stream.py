@@ -0,0 +1,91 @@
+import json, unittest, unittest.mock
+import harness
+
+class StreamTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		current = harness.reset(self.main, 4)
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"streamuser"))
+		self.own, self.other = current.ordered("id")[:2]
+		self.main.database.add_torrent(current.get(self.own)["info_hash"],
+			"streamuser")
+		self.main.poll_torrent_list()
+		# don't wait long for what isn't coming
+		patch = unittest.mock.patch.object(self.main, "STREAM_HEARTBEAT",
+			0.05)
+		patch.start()
+		self.addCleanup(patch.stop)
+
+	def position(self):
+		current = self.main.snapshots.current
+		return "%d-%d" % (current.epoch, current.version)
+
+	def events(self, client, position):
+		response = client.get("/stream", headers={"Last-Event-ID":
+			position})
+		self.addCleanup(response.close)
+		self.assertEqual(response.mimetype, "text/event-stream")
+		return (chunk.decode("utf8") for chunk in response.response)
+
+	def parse(self, event):
+		fields = dict(line.split(": ", 1) for line in event.strip(
+			).split("\n"))
+		return fields["id"], fields["event"], json.loads(fields["data"])
+
+	def fake_torrent(self, id):
+		# ids are btpd's torrent numbers
+		return harness.fake.torrents[id]
+
+	def test_deltas(self):
+		position = self.position()
+		with harness.fake.lock:
+			self.fake_torrent(self.own).peers += 1
+			self.fake_torrent(self.other).peers += 1
+		self.main.poll_torrent_list()
+		id, event, data = self.parse(next(self.events(self.root,
+			position)))
+		self.assertEqual((id, event), (self.position(), "delta"))
+		self.assertEqual(sorted(torrent["id"] for torrent in
+			data["changed"]), sorted([self.own, self.other]))
+		self.assertEqual(set(data["changed"][0]), set(
+			self.main.STREAM_FIELDS))
+		self.assertEqual(data["removed"], [])
+
+	def test_only_whats_visible(self):
+		position = self.position()
+		events = self.events(self.user, position)
+		with harness.fake.lock:
+			self.fake_torrent(self.other).peers += 1
+		self.main.poll_torrent_list()
+		self.assertEqual(next(events), ": heartbeat\n\n")
+		with harness.fake.lock:
+			del harness.fake.torrents[self.own]
+		self.main.poll_torrent_list()
+		id, event, data = self.parse(next(events))
+		self.assertEqual((id, event), (self.position(), "delta"))
+		self.assertEqual(data, {"changed": [], "removed": [self.own]})
+
+	def test_reset(self):
+		current = self.main.snapshots.current
+		events = self.events(self.root, "%d-%d" % (current.epoch+1,
+			current.version))
+		self.assertEqual(next(events), "event: reset\ndata: {}\n\n")
+		self.assertRaises(StopIteration, next, events)
+		# further behind than the deltas kept
+		for _ in range(self.main.snapshots.deltas.maxlen+1):
+			with harness.fake.lock:
+				self.fake_torrent(self.other).peers += 1
+			self.main.poll_torrent_list()
+		events = self.events(self.root, "%d-%d" % (current.epoch,
+			current.version))
+		self.assertEqual(next(events), "event: reset\ndata: {}\n\n")
+
+	def test_unauthenticated(self):
+		self.assertEqual(harness.client(self.main).get("/stream"
+			).status_code, 401)
+
+if __name__ == "__main__":
+	unittest.main()
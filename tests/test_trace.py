@@ -0,0 +1,127 @@
+import json, os, shutil, sys, tempfile, time, unittest, unittest.mock
+import Database, Trace
+import harness
+
+class TracerTest(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.directory, True)
+		self.path = os.path.join(self.directory, "btpd-web.trace")
+
+	def tracer(self, **kwargs):
+		return Trace.Tracer(True, self.path, **kwargs)
+
+	def traces(self):
+		return Trace.read([self.path], 100)
+
+	def test_disabled(self):
+		tracer = Trace.Tracer(False, self.path)
+		tracer.begin("GET /")
+		tracer.query(None, "SELECT 1", 0.1)
+		tracer.end(status=200)
+		self.assertFalse(os.path.exists(self.path))
+
+	def test_statements_and_where_from(self):
+		tracer = self.tracer()
+		database = Database.Database(scrypt_params=(2, 1, 1), location=
+			os.path.join(self.directory, "btpd-web.db"), observers=[
+			tracer.query])
+		tracer.begin("GET /users")
+		for _ in range(3):
+			database.has_username("root")
+		tracer.btpd(sys._getframe(), "tget", [[1, 2], len], 0.002)
+		tracer.end(status=200, process="test")
+		trace, = self.traces()
+		self.assertEqual((trace["name"], trace["status"],
+			trace["process"], trace["dropped"]), ("GET /users", 200,
+			"test", 0))
+		statement = "SELECT 1 FROM users WHERE UPPER(username)=?"
+		kinds = [(kind, text) for kind, text, ms, at, site in
+			trace["events"]]
+		self.assertEqual(kinds, [("sql", statement)]*3+[("btpd",
+			"tget([1, 2])")])
+		site = trace["events"][0][4]
+		self.assertTrue(site.startswith("test_trace.py:"), site)
+		self.assertTrue(site.endswith(" test_statements_and_where_from"))
+		self.assertEqual(trace["repeated"], [[3, site, statement]])
+
+	def test_fast_requests_are_left_out(self):
+		tracer = self.tracer(slower_than=10)
+		tracer.begin("GET /")
+		tracer.end(status=200)
+		self.assertEqual(self.traces(), [])
+
+	def test_events_are_bounded(self):
+		tracer = self.tracer(max_events=2)
+		tracer.begin("GET /")
+		for _ in range(5):
+			tracer.query(sys._getframe(), "SELECT 1", 0)
+		tracer.end()
+		trace, = self.traces()
+		self.assertEqual((len(trace["events"]), trace["dropped"]), (2, 3))
+
+	def test_rotation(self):
+		tracer = self.tracer(max_bytes=1, backups=2)
+		for n in range(4):
+			tracer.write({"time": n, "name": "GET /%d" % n})
+		self.assertEqual(sorted(os.listdir(self.directory)), [
+			"btpd-web.trace", "btpd-web.trace.1", "btpd-web.trace.2"])
+		# rotated files aren't read as another process'
+		self.assertEqual(Trace.trace_files(self.path), [self.path])
+		with open(self.path+".2") as file:
+			self.assertEqual(json.loads(file.read())["time"], 1)
+
+	def test_reading_several_files(self):
+		for n, path in enumerate([self.path, self.path+".worker1",
+				self.path, self.path+".worker1"]):
+			with open(path, "a") as file:
+				file.write(json.dumps({"time": n})+"\n")
+		with open(self.path, "a") as file:
+			file.write("{not json\n")
+		self.assertEqual(sorted(Trace.trace_files(self.path)), [self.path,
+			self.path+".worker1"])
+		self.assertEqual([trace["time"] for trace in Trace.read(
+			Trace.trace_files(self.path), 3)], [3, 2, 1])
+
+	def test_slow_requests_are_sampled(self):
+		def waiting_around():
+			time.sleep(0.1)
+		tracer = self.tracer(profile_after=0.01, interval=0.002)
+		tracer.begin("GET /")
+		waiting_around()
+		tracer.end()
+		trace, = self.traces()
+		self.assertTrue(trace["profile"])
+		self.assertTrue(any(stack.endswith(
+			"test_trace.py:waiting_around") for stack, count in
+			trace["profile"]), trace["profile"])
+
+class TracesPageTest(unittest.TestCase):
+	def setUp(self):
+		self.main = harness.load_main()
+		self.root = harness.client(self.main, harness.add_user(self.main,
+			"root"))
+		self.user = harness.client(self.main, harness.add_user(self.main,
+			"traceuser"))
+
+	def test_disabled(self):
+		self.assertEqual(self.root.get("/traces").status_code, 404)
+
+	def test_traces(self):
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory, True)
+		path = os.path.join(directory, "btpd-web.trace")
+		for name, value in [("tracer", Trace.Tracer(True, path)),
+				("trace_path", path)]:
+			patch = unittest.mock.patch.object(self.main, name, value)
+			patch.start()
+			self.addCleanup(patch.stop)
+		self.assertEqual(self.user.get("/api/torrents?sort=nothing"
+			).status_code, 400)
+		self.assertEqual(self.user.get("/traces").status_code, 302)
+		page = self.root.get("/traces").get_data(as_text=True)
+		self.assertIn("GET /api/torrents?sort=nothing", page)
+		self.assertIn("<td>400</td>", page)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,157 @@
+import os, random, shutil, tempfile, threading, time, types, unittest
+import Btpd, FakeBtpd, Utils
+
+class MultiDaemonTest(unittest.TestCase):
+	# three btpds: two fakes, the second `delay` seconds slow to list,
+	# and one that isn't running at all
+	def setUp(self):
+		self.fakes = []
+		btpd_dirs = []
+		for index, delay in enumerate([0, 0.5, None]):
+			btpd_dir = tempfile.mkdtemp()
+			self.addCleanup(shutil.rmtree, btpd_dir)
+			btpd_dirs.append(btpd_dir)
+			if delay is None:
+				continue
+			fake = FakeBtpd.FakeBtpd(btpd_dir, delay=delay)
+			fake.populate(3, seed=index)
+			thread = threading.Thread(target=fake.serve_forever)
+			thread.daemon = True
+			thread.start()
+			for _ in range(200):
+				if os.path.exists(os.path.join(btpd_dir, "sock")):
+					break
+				time.sleep(0.01)
+			self.addCleanup(thread.join)
+			self.addCleanup(fake.server.shutdown)
+			self.fakes.append(fake)
+		self.utils = Utils.Utils(types.SimpleNamespace(config={
+			"BTPD_DIRS": btpd_dirs, "BTPD_POLL_TIMEOUT": 0.1}))
+		for daemon in self.utils.daemons:
+			# there's no btcli to fall back to
+			daemon.btcli = daemon.backend
+		self.addCleanup(self.utils.pool.shutdown)
+
+	def wait_for_slow(self):
+		self.utils.daemons[1].polling.result(5)
+
+	def test_route(self):
+		daemon, id = self.utils.route(Utils.ID_STRIDE+5)
+		self.assertEqual((daemon.index, id), (1, 5))
+		daemon, id = self.utils.route(7)
+		self.assertEqual((daemon.index, id), (0, 7))
+		with self.assertRaises(ValueError):
+			self.utils.route(3*Utils.ID_STRIDE+1)
+		self.assertEqual(self.utils.metainfo_path(Utils.ID_STRIDE+5,
+			"ab"*20), os.path.join(self.utils.daemons[1].btpd_dir,
+			"torrents", "ab"*20, "torrent"))
+
+	def test_slow_and_dead_daemons_dont_hold_up_the_rest(self):
+		start = time.monotonic()
+		lists = self.utils.get_torrent_lists()
+		self.assertLess(time.monotonic()-start, 0.4)
+		self.assertEqual([torrent.id for torrent in lists[0]], [1, 2, 3])
+		self.assertIsNone(lists[1])
+		self.assertIsNone(lists[2])
+		self.assertIsInstance(self.utils.daemons[2].error, OSError)
+		# the slow one isn't asked again, its answer is used next time
+		self.wait_for_slow()
+		lists = self.utils.get_torrent_lists()
+		self.assertEqual([torrent.id for torrent in lists[1]], [
+			Utils.ID_STRIDE+1, Utils.ID_STRIDE+2, Utils.ID_STRIDE+3])
+		self.assertEqual(lists[1][0].info_hash, self.fakes[1].torrents[
+			1].info_hash.hex())
+		self.assertIsNone(lists[2])
+
+	def test_silent_daemons_keep_their_torrents(self):
+		self.utils.get_torrent_lists()
+		self.wait_for_slow()
+		previous = self.utils.merge_torrent_lists(
+			self.utils.get_torrent_lists(), [])
+		self.assertEqual(len(previous), 6)
+		# the slow one is being asked again and the first has lost one
+		del self.fakes[0].torrents[2]
+		lists = self.utils.get_torrent_lists()
+		self.assertIsNone(lists[1])
+		merged = self.utils.merge_torrent_lists(lists, previous)
+		self.assertEqual(sorted(torrent.id for torrent in merged), [1, 3,
+			Utils.ID_STRIDE+1, Utils.ID_STRIDE+2, Utils.ID_STRIDE+3])
+		kept = [torrent for torrent in merged if torrent.id >
+			Utils.ID_STRIDE]
+		self.assertEqual(kept, [torrent for torrent in previous if
+			torrent.id > Utils.ID_STRIDE])
+		self.assertFalse(any(torrent is old for torrent in kept for old
+			in previous))
+
+	def test_nobody_answering(self):
+		for fake in self.fakes:
+			fake.server.shutdown()
+			fake.server.server_close()
+		for daemon in self.utils.daemons:
+			daemon.backend.client.close()
+			daemon.polling = None
+		self.fakes[1].delay = 0
+		with self.assertRaises(OSError):
+			self.utils.get_torrent_lists()
+
+	def test_actions_are_routed_and_failures_mapped_back(self):
+		failed = self.utils.do_torrent_actions({1: "start",
+			Utils.ID_STRIDE+2: "start", Utils.ID_STRIDE+99: "stop"})
+		self.assertEqual(failed, [Utils.ID_STRIDE+99])
+		self.assertEqual(self.fakes[0].torrents[1].state, 3)
+		self.assertEqual(self.fakes[1].torrents[2].state, 3)
+		failed = self.utils.remove_torrents([3, 98, Utils.ID_STRIDE+1])
+		self.assertEqual(failed, [98])
+		self.assertEqual(sorted(self.fakes[0].torrents), [1, 2])
+		self.assertEqual(sorted(self.fakes[1].torrents), [2, 3])
+		self.utils.do_torrent_action(Utils.ID_STRIDE+3, "stop")
+		self.assertEqual(self.fakes[1].torrents[3].state, 0)
+		with self.assertRaises(Btpd.BtpdError):
+			self.utils.remove_torrent(Utils.ID_STRIDE+99)
+
+class LogTest(unittest.TestCase):
+	def setUp(self):
+		btpd_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, btpd_dir)
+		self.path = os.path.join(btpd_dir, "log")
+		self.utils = Utils.Utils(types.SimpleNamespace(config={
+			"BTPD_DIRS": [btpd_dir]}))
+
+	def write(self, data, mode="wb"):
+		with open(self.path, mode) as log:
+			log.write(data)
+
+	def test_get_log_matches_splitlines(self):
+		# whitespace-only lines, leading whitespace and lines split
+		# across blocks all come back as they are
+		random_ = random.Random(0)
+		pieces = ["x", "\xe9", " ", "\t", "\n", "\n", "  \n", "\n\n"]
+		for case in range(3000):
+			text = "".join(random_.choice(pieces) for _ in range(
+				random_.randrange(40)))
+			self.write(text.encode("utf8"))
+			lines = random_.randrange(1, 12)
+			block_size = random_.randrange(1, 9)
+			self.assertEqual(self.utils.get_log(lines,
+				block_size=block_size), text.splitlines()[-lines:][::-1],
+				(case, text, lines, block_size))
+
+	def test_follow_log(self):
+		self.write(b"old\n")
+		follow = self.utils.follow_log(interval=0.01)
+		self.assertEqual(next(follow), [])
+		self.write(b"  indented\n\n \nhalf", "ab")
+		self.assertEqual(next(follow), ["  indented", "", " "])
+		self.write(b" a line\n", "ab")
+		self.assertEqual(next(follow), ["half a line"])
+		# rotated, with the old log's last line left unfinished
+		self.write(b" \t", "ab")
+		self.assertEqual(next(follow), [])
+		os.rename(self.path, self.path+".1")
+		self.write(b"new\n")
+		self.assertEqual(next(follow), [" \t"])
+		self.assertEqual(next(follow), ["new"])
+		follow.close()
+
+if __name__ == "__main__":
+	unittest.main()